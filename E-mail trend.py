@@ -1,5 +1,6 @@
 import os
 import sys
+import argparse
 import subprocess
 import asyncio
 import re
@@ -9,10 +10,32 @@ import datetime
 from collections import defaultdict
 from urllib.parse import quote
 import logging
+import logging.handlers
 import email.utils
-from contextlib import asynccontextmanager
-
-required_modules = ["requests", "msal", "openpyxl", "tqdm", "aiohttp"]
+import concurrent.futures
+import queue
+import threading
+import gzip
+import time
+import heapq
+import itertools
+import gc
+import random
+import tracemalloc
+import statistics
+import atexit
+import copy
+import contextvars
+import sqlite3
+import multiprocessing
+import zlib
+import marshal
+import tempfile
+from array import array
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+
+required_modules = ["requests", "msal", "openpyxl", "tqdm", "aiohttp", "numpy"]
 
 
 def install_and_restart():
@@ -34,12 +57,17 @@ def check_modules():
             install_and_restart()
 
 
-check_modules()
+# Procesy robocze puli uruchamiane metodą spawn importują skrypt ponownie
+# (jako `__mp_main__`), a testy importują go jako moduł – w obu przypadkach
+# bez instalowania pakietów, tworzenia pliku logu ani uruchamiania wątków.
+if __name__ == "__main__":
+    check_modules()
 
 import msal
 import openpyxl
 from tqdm import tqdm
 import aiohttp
+import numpy as np
 
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -61,6 +89,12 @@ DEFAULT_CONFIG = {
     "log_filename": "email_trend_app_only.log",
     # Poziom szczegółowości logów (np. DEBUG, INFO, WARNING).
     "log_level": "INFO",
+    # Format logów: "text" (czytelny) lub "json" (jeden obiekt JSON na wiersz
+    # z polami mailbox, folder, url_kind, status i latency_ms).
+    "log_format": "text",
+    # Okno w sekundach, w którym powtarzające się ostrzeżenia i błędy z tego
+    # samego miejsca są zwijane do jednego wpisu. 0 wyłącza zwijanie.
+    "log_repeat_window_seconds": 60,
     # Limit czasu na pobranie danych pojedynczego żądania w sekundach.
     "fetch_timeout_seconds": 30,
     # Opóźnienie między ponownymi próbami w sekundach po wystąpieniu błędu.
@@ -70,6 +104,72 @@ DEFAULT_CONFIG = {
     # Maksymalna liczba równoległych żądań wysyłanych do Graph API.
     "semaphore_limit": 7,
     "max_folder_batch_size": 3,
+    # Liczba prób ponowienia stron, których nie udało się pobrać w trakcie
+    # przebiegu. Strony te trafiają do kolejki błędów i są ponawiane na końcu.
+    "dead_letter_retries": 5,
+    # Liczba procesów przetwarzających strony wiadomości (dekodowanie JSON i
+    # wyliczanie rozmiarów). 0 oznacza przetwarzanie w pętli zdarzeń.
+    "page_processing_workers": 0,
+    # Maksymalna liczba pobranych, a jeszcze nieprzetworzonych stron
+    # (ma znaczenie tylko przy włączonej puli procesów).
+    "page_processing_max_in_flight": 4,
+    # Liczba paczek wierszy oczekujących na zapis do plików Excel. Po jej
+    # osiągnięciu potoki skrzynek czekają z przekazaniem kolejnych stron.
+    "export_queue_size": 16,
+    # Pojemność każdej z kolejek potoku skrzynki (pobieranie → normalizacja →
+    # agregacja → zapis) liczona w stronach. Gdy kolejka jest pełna,
+    # wcześniejszy etap czeka, zamiast gromadzić dane w pamięci.
+    "pipeline_queue_size": 8,
+    # Katalog pamięci podręcznej struktury folderów (token mailFolders/delta)
+    # i pobranych rozmiarów wiadomości. Pusta wartość wyłącza pamięć podręczną.
+    "folder_cache_dir": "",
+    # Zbiorczy panel postępu (wiadomości/s, żądania/s, 429/min, ETA) zamiast
+    # osobnych pasków tqdm dla każdej skrzynki.
+    "live_dashboard": False,
+    # Częstotliwość odświeżania panelu postępu w sekundach.
+    "dashboard_refresh_seconds": 1,
+    # Dodatkowe rejestracje aplikacji (lista obiektów z kluczami name,
+    # client_id, client_secret i opcjonalnie tenant_id). Każda ma własny token
+    # i własny limit żądań; skrzynki są rozdzielane pomiędzy nie.
+    "credentials": [],
+    # Tryb archiwum odpowiedzi HTTP: "record" zapisuje każdą udaną odpowiedź,
+    # "replay" odtwarza je z dysku bez łączenia z Graph. Pusta wartość wyłącza.
+    "http_cassette_mode": "",
+    # Plik archiwum odpowiedzi (SQLite, treści skompresowane zlib).
+    "http_cassette_path": "http_cassette.sqlite",
+    # Symulowane opóźnienie każdej odtwarzanej odpowiedzi w milisekundach.
+    "http_cassette_replay_latency_ms": 0,
+    # Plik bazy SQLite z rozmiarami wiadomości, z której polecenie `report`
+    # odtwarza raporty bez ponownego pobierania. Pusta wartość wyłącza zapis.
+    "message_store_path": "",
+    # Dodatkowe arkusze skoroszytu skrzynki: rozkład rozmiarów wiadomości,
+    # percentyle rozmiaru w miesiącach i nadawcy o największym wolumenie.
+    "size_analytics": True,
+    # Liczba nadawców w arkuszu największych nadawców.
+    "top_senders_limit": 20,
+    # Maksymalna liczba miesięcy wstecz sprawdzanych w trybie --count-only.
+    "count_max_months": 120,
+    # Początkowa liczba wiadomości na stronę ($top).
+    "message_page_size": 100,
+    # Dopasowywanie rozmiaru strony do czasu odpowiedzi i jej wielkości.
+    "adaptive_page_size": True,
+    # Docelowy czas pobrania jednej strony wiadomości w sekundach.
+    "page_target_seconds": 5,
+    # Maksymalny pożądany rozmiar odpowiedzi jednej strony w megabajtach.
+    "page_max_megabytes": 8,
+    # Liczba skrzynek przetwarzanych jednocześnie. Kolejne skrzynki czekają
+    # w kolejce i są pobierane, gdy zwolni się miejsce.
+    "max_concurrent_mailboxes": 10,
+    # Tryb usługi (`serve`): lista skrzynek odświeżanych w tle. Pusta lista
+    # oznacza wykrywanie wszystkich skrzynek dzierżawy.
+    "service_mailboxes": [],
+    # Odstęp między kolejnymi odświeżeniami statystyk w minutach.
+    "service_refresh_minutes": 360,
+    # Plik, w którym usługa utrwala zagregowane statystyki.
+    "service_cache_path": "service_cache.json",
+    # Adres i port lokalnego API HTTP usługi.
+    "service_host": "127.0.0.1",
+    "service_port": 8765,
 }
 
 REQUIRED_CONFIG_KEYS = ["client_id", "tenant_id", "client_secret"]
@@ -84,23 +184,7 @@ def _write_config(config_data):
         sys.exit(1)
 
 
-def load_config():
-    if not os.path.exists(CONFIG_PATH):
-        try:
-            with open(CONFIG_PATH, "w", encoding="utf-8") as config_file:
-                json.dump(DEFAULT_CONFIG, config_file, indent=4, ensure_ascii=False)
-        except OSError as error:
-            print(
-                f"Nie można utworzyć pliku konfiguracyjnego {CONFIG_FILENAME}: {error}"
-            )
-            sys.exit(1)
-
-        print(
-            f"Utworzono plik konfiguracyjny {CONFIG_FILENAME} w lokalizacji {CONFIG_PATH}."
-        )
-        print("Uzupełnij wymagane dane i uruchom ponownie skrypt.")
-        sys.exit(0)
-
+def _read_config_file():
     try:
         with open(CONFIG_PATH, "r", encoding="utf-8") as config_file:
             config_data = json.load(config_file)
@@ -119,25 +203,54 @@ def load_config():
             f"Plik {CONFIG_FILENAME} ma nieprawidłowy format. Oczekiwano obiektu JSON."
         )
         sys.exit(1)
+    return config_data
 
-    updated = False
+
+def load_config():
+    """Zwraca ustawienia z pliku uzupełnione wartościami domyślnymi.
+
+    Plik nie jest tu tworzony ani zmieniany, a brak danych logowania nie
+    przerywa działania – sprawdza je `prepare_config` przed poleceniami, które
+    łączą się z Graph. Polecenia offline działają dzięki temu bez pliku.
+    """
+    if not os.path.exists(CONFIG_PATH):
+        return copy.deepcopy(DEFAULT_CONFIG)
+    config_data = _read_config_file()
     for key, default_value in DEFAULT_CONFIG.items():
-        if key not in config_data:
-            config_data[key] = default_value
-            updated = True
+        config_data.setdefault(key, copy.deepcopy(default_value))
+    return config_data
+
 
-    if updated:
+def prepare_config():
+    """Tworzy lub uzupełnia plik konfiguracyjny i sprawdza dane logowania."""
+    if not os.path.exists(CONFIG_PATH):
         try:
-            _write_config(config_data)
-        except SystemExit:
-            raise
-        else:
+            with open(CONFIG_PATH, "w", encoding="utf-8") as config_file:
+                json.dump(DEFAULT_CONFIG, config_file, indent=4, ensure_ascii=False)
+        except OSError as error:
             print(
-                "Plik konfiguracyjny został uzupełniony brakującymi ustawieniami."
+                f"Nie można utworzyć pliku konfiguracyjnego {CONFIG_FILENAME}: {error}"
             )
+            sys.exit(1)
+
+        print(
+            f"Utworzono plik konfiguracyjny {CONFIG_FILENAME} w lokalizacji {CONFIG_PATH}."
+        )
+        print("Uzupełnij wymagane dane i uruchom ponownie skrypt.")
+        sys.exit(0)
 
+    stored_config = _read_config_file()
+    if any(key not in stored_config for key in DEFAULT_CONFIG):
+        _write_config(CONFIG)
+        print(
+            "Plik konfiguracyjny został uzupełniony brakującymi ustawieniami."
+        )
+
+    required_keys = REQUIRED_CONFIG_KEYS
+    if isinstance(CONFIG.get("credentials"), list) and CONFIG["credentials"]:
+        required_keys = ["tenant_id"]
     missing = [
-        key for key in REQUIRED_CONFIG_KEYS if not str(config_data.get(key, "")).strip()
+        key for key in required_keys if not str(CONFIG.get(key, "")).strip()
     ]
     if missing:
         missing_values = ", ".join(missing)
@@ -147,8 +260,6 @@ def load_config():
         print("Uzupełnij dane i uruchom ponownie skrypt.")
         sys.exit(1)
 
-    return config_data
-
 
 CONFIG = load_config()
 
@@ -216,6 +327,35 @@ def _get_float_setting(key):
     return parsed_value
 
 
+def _get_bool_setting(key):
+    raw_value = CONFIG.get(key, DEFAULT_CONFIG[key])
+    if isinstance(raw_value, bool):
+        return raw_value
+    raw_str = str(raw_value).strip().lower()
+    if raw_str in {"1", "true", "yes", "tak", "on"}:
+        return True
+    if raw_str in {"0", "false", "no", "nie", "off", ""}:
+        return False
+    logging.warning(
+        "Nieprawidłowa wartość %s w pliku konfiguracyjnym: %r. Używam domyślnej: %s.",
+        key,
+        raw_value,
+        DEFAULT_CONFIG[key],
+    )
+    return DEFAULT_CONFIG[key]
+
+
+def _get_non_negative_int_setting(key):
+    raw_value = CONFIG.get(key, DEFAULT_CONFIG[key])
+    if not isinstance(raw_value, bool):
+        try:
+            if float(str(raw_value).strip()) == 0:
+                return 0
+        except (TypeError, ValueError):
+            pass
+    return _get_int_setting(key)
+
+
 def _get_int_setting(key):
     raw_value = CONFIG.get(key, DEFAULT_CONFIG[key])
     parsed_value = _read_positive_int(raw_value, DEFAULT_CONFIG[key])
@@ -253,23 +393,174 @@ LOG_FILE_PATH = (
     else os.path.join(SCRIPT_DIR, LOG_FILENAME)
 )
 
-log_directory = os.path.dirname(LOG_FILE_PATH)
-if log_directory:
-    os.makedirs(log_directory, exist_ok=True)
-
 raw_log_level = str(
     CONFIG.get("log_level", DEFAULT_CONFIG["log_level"])
 ).strip().upper()
 LOG_LEVEL = getattr(logging, raw_log_level, logging.INFO)
 
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
+raw_log_format = str(
+    CONFIG.get("log_format", DEFAULT_CONFIG["log_format"])
+).strip().lower()
+LOG_FORMAT = raw_log_format if raw_log_format in {"text", "json"} else "text"
+
+LOG_MAILBOX = contextvars.ContextVar("log_mailbox", default="")
+LOG_FOLDER = contextvars.ContextVar("log_folder", default="")
+LOG_RECORD_FIELDS = ("mailbox", "folder", "url_kind", "status", "latency_ms")
+
+
+class LogContextFilter(logging.Filter):
+    """Uzupełnia rekord o skrzynkę i folder z kontekstu bieżącego zadania.
+
+    Filtr działa na `QueueHandler`, czyli jeszcze w wątku i zadaniu, które
+    zapisuje komunikat – tylko tam widoczne są zmienne kontekstowe.
+    """
+
+    def filter(self, record):
+        if not getattr(record, "mailbox", None):
+            record.mailbox = LOG_MAILBOX.get()
+        if not getattr(record, "folder", None):
+            record.folder = LOG_FOLDER.get()
+        return True
+
+
+class RepeatedLogFilter(logging.Filter):
+    """Zwija powtarzające się ostrzeżenia i błędy z tego samego miejsca.
+
+    Komunikaty ze statusem HTTP są grupowane według wiersza kodu i statusu
+    (np. seria odpowiedzi 429 dla różnych adresów), pozostałe według pełnej
+    treści. Pierwszy komunikat grupy jest zapisywany, kolejne w ciągu
+    `window_seconds` są jedynie liczone. Liczba pominiętych trafia do
+    następnego zapisanego komunikatu grupy lub do podsumowania `flush`.
+    """
+
+    def __init__(self, window_seconds=0):
+        super().__init__()
+        self.window_seconds = window_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if (
+            self.window_seconds <= 0
+            or record.levelno < logging.WARNING
+            or record.exc_info
+            or not getattr(record, "collapse", True)
+        ):
+            return True
+        status = getattr(record, "status", None)
+        key = (record.pathname, record.lineno, status if status is not None else record.getMessage())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["first"] < self.window_seconds:
+                entry["suppressed"] += 1
+                return False
+            suppressed = entry["suppressed"] if entry is not None else 0
+            self._entries[key] = {"first": now, "suppressed": 0, "template": record.msg}
+        if suppressed:
+            record.msg = f"{record.getMessage()} (pominięte podobne komunikaty: {suppressed})"
+            record.args = None
+        return True
+
+    def flush(self):
+        with self._lock:
+            pending = [
+                (entry["template"], entry["suppressed"])
+                for entry in self._entries.values()
+                if entry["suppressed"]
+            ]
+            self._entries.clear()
+        for template, suppressed in pending:
+            logging.warning(
+                "Pominięte powtórzenia komunikatu (%s): %s",
+                suppressed,
+                template,
+                extra={"collapse": False},
+            )
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in LOG_RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value not in (None, ""):
+                entry[field] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Przekazuje rekord do kolejki z treścią i śladem wyjątku jako tekstem.
+
+    W odróżnieniu od `QueueHandler.prepare` ślad wyjątku nie jest doklejany
+    do treści, więc format JSON może zapisać go w osobnym polu.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+# Rekordy trafiają do kolejki, a zapis do pliku i na konsolę wykonuje wątek
+# QueueListener, więc logowanie nie blokuje pętli zdarzeń.
+LOG_HANDLERS = []
+LOG_QUEUE = queue.SimpleQueue()
+LOG_LISTENER = None
+LOG_REPEAT_FILTER = RepeatedLogFilter()
+log_queue_handler = LogQueueHandler(LOG_QUEUE)
+log_queue_handler.addFilter(LogContextFilter())
+log_queue_handler.addFilter(LOG_REPEAT_FILTER)
+
+
+def setup_logging():
+    global LOG_LISTENER
+    log_directory = os.path.dirname(LOG_FILE_PATH)
+    if log_directory:
+        os.makedirs(log_directory, exist_ok=True)
+    if LOG_FORMAT == "json":
+        log_formatter = JsonLogFormatter()
+    else:
+        log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    LOG_HANDLERS[:] = [
         logging.FileHandler(LOG_FILE_PATH, encoding="utf-8"),
         logging.StreamHandler(sys.stdout),
-    ],
-)
+    ]
+    for log_handler in LOG_HANDLERS:
+        log_handler.setFormatter(log_formatter)
+    LOG_LISTENER = logging.handlers.QueueListener(
+        LOG_QUEUE, *LOG_HANDLERS, respect_handler_level=True
+    )
+    LOG_LISTENER.start()
+    logging.basicConfig(level=LOG_LEVEL, handlers=[log_queue_handler], force=True)
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    global LOG_LISTENER
+    LOG_REPEAT_FILTER.flush()
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        LOG_LISTENER = None
+
+
+if __name__ == "__main__":
+    setup_logging()
+else:
+    logging.getLogger().addHandler(logging.NullHandler())
 
 if raw_log_level and raw_log_level != logging.getLevelName(LOG_LEVEL):
     logging.warning(
@@ -278,11 +569,65 @@ if raw_log_level and raw_log_level != logging.getLevelName(LOG_LEVEL):
         logging.getLevelName(LOG_LEVEL),
     )
 
+if raw_log_format and raw_log_format != LOG_FORMAT:
+    logging.warning(
+        "Nieprawidłowa wartość log_format w pliku konfiguracyjnym: %s. Używam %s.",
+        raw_log_format,
+        LOG_FORMAT,
+    )
+
+LOG_REPEAT_FILTER.window_seconds = _get_non_negative_int_setting("log_repeat_window_seconds")
+
 logging.info("Logi zapisywane do pliku: %s", LOG_FILE_PATH)
 
 CLIENT_ID = CONFIG["client_id"]
 TENANT_ID = CONFIG["tenant_id"]
 CLIENT_SECRET = CONFIG["client_secret"]
+
+
+def _parse_credentials(value):
+    credentials = []
+    if isinstance(value, list):
+        for index, item in enumerate(value, start=1):
+            if not isinstance(item, dict):
+                logging.warning(
+                    "Pominięto nieprawidłowy wpis nr %s w credentials: %r.", index, item
+                )
+                continue
+            client_id = str(item.get("client_id") or "").strip()
+            client_secret = str(item.get("client_secret") or "").strip()
+            if not client_id or not client_secret:
+                logging.warning(
+                    "Pominięto wpis nr %s w credentials bez client_id lub client_secret.",
+                    index,
+                )
+                continue
+            credentials.append(
+                {
+                    "name": str(item.get("name") or "").strip() or f"app{index}",
+                    "client_id": client_id,
+                    "client_secret": client_secret,
+                    "tenant_id": str(item.get("tenant_id") or "").strip() or TENANT_ID,
+                }
+            )
+    elif value:
+        logging.warning(
+            "Nieprawidłowa wartość credentials w pliku konfiguracyjnym. Oczekiwano listy."
+        )
+
+    if not credentials:
+        credentials.append(
+            {
+                "name": "default",
+                "client_id": CLIENT_ID,
+                "client_secret": CLIENT_SECRET,
+                "tenant_id": TENANT_ID,
+            }
+        )
+    return credentials
+
+
+CREDENTIALS = _parse_credentials(CONFIG.get("credentials"))
 scopes_raw = CONFIG.get("scopes", DEFAULT_CONFIG["scopes"])
 SCOPES = _parse_scopes(scopes_raw)
 
@@ -317,68 +662,205 @@ FOLDER_BATCH_SIZE = _get_int_setting("max_folder_batch_size")
 if FOLDER_BATCH_SIZE <= 0:
     FOLDER_BATCH_SIZE = 1
 
+DEAD_LETTER_RETRIES = _get_int_setting("dead_letter_retries")
+
+PAGE_PROCESSING_WORKERS = _get_non_negative_int_setting("page_processing_workers")
+PAGE_PROCESSING_MAX_IN_FLIGHT = _get_int_setting("page_processing_max_in_flight")
+EXPORT_QUEUE_SIZE = _get_int_setting("export_queue_size")
+PIPELINE_QUEUE_SIZE = _get_int_setting("pipeline_queue_size")
+
+raw_folder_cache_dir = str(CONFIG.get("folder_cache_dir") or "").strip()
+FOLDER_CACHE_DIR = (
+    ""
+    if not raw_folder_cache_dir
+    else raw_folder_cache_dir
+    if os.path.isabs(raw_folder_cache_dir)
+    else os.path.join(SCRIPT_DIR, raw_folder_cache_dir)
+)
+
+LIVE_DASHBOARD = _get_bool_setting("live_dashboard")
+DASHBOARD_REFRESH_SECONDS = _get_float_setting("dashboard_refresh_seconds")
+
+raw_cassette_mode = str(CONFIG.get("http_cassette_mode") or "").strip().lower()
+HTTP_CASSETTE_MODE = raw_cassette_mode if raw_cassette_mode in {"record", "replay"} else ""
+if raw_cassette_mode and not HTTP_CASSETTE_MODE:
+    logging.warning(
+        "Nieprawidłowa wartość http_cassette_mode w pliku konfiguracyjnym: %s. Archiwum wyłączone.",
+        raw_cassette_mode,
+    )
+raw_cassette_path = (
+    str(CONFIG.get("http_cassette_path") or "").strip()
+    or DEFAULT_CONFIG["http_cassette_path"]
+)
+HTTP_CASSETTE_PATH = (
+    raw_cassette_path
+    if os.path.isabs(raw_cassette_path)
+    else os.path.join(SCRIPT_DIR, raw_cassette_path)
+)
+HTTP_CASSETTE_REPLAY_LATENCY_MS = _get_non_negative_int_setting(
+    "http_cassette_replay_latency_ms"
+)
+
+raw_message_store_path = str(CONFIG.get("message_store_path") or "").strip()
+MESSAGE_STORE_PATH = (
+    ""
+    if not raw_message_store_path
+    else raw_message_store_path
+    if os.path.isabs(raw_message_store_path)
+    else os.path.join(SCRIPT_DIR, raw_message_store_path)
+)
+
+COUNT_MAX_MONTHS = _get_int_setting("count_max_months")
+SIZE_ANALYTICS = _get_bool_setting("size_analytics")
+TOP_SENDERS_LIMIT = _get_int_setting("top_senders_limit")
+
+MESSAGE_PAGE_SIZE_LIMIT = 1000
+MESSAGE_PAGE_SIZE_MINIMUM = 10
+MESSAGE_PAGE_SIZE = min(_get_int_setting("message_page_size"), MESSAGE_PAGE_SIZE_LIMIT)
+ADAPTIVE_PAGE_SIZE = _get_bool_setting("adaptive_page_size")
+PAGE_TARGET_SECONDS = _get_float_setting("page_target_seconds")
+PAGE_MAX_BYTES = int(_get_float_setting("page_max_megabytes") * 1024 * 1024)
+
+MAX_CONCURRENT_MAILBOXES = _get_int_setting("max_concurrent_mailboxes")
+
+SERVICE_REFRESH_MINUTES = _get_float_setting("service_refresh_minutes")
+raw_service_cache_path = (
+    str(CONFIG.get("service_cache_path") or "").strip()
+    or DEFAULT_CONFIG["service_cache_path"]
+)
+SERVICE_CACHE_PATH = (
+    raw_service_cache_path
+    if os.path.isabs(raw_service_cache_path)
+    else os.path.join(SCRIPT_DIR, raw_service_cache_path)
+)
+SERVICE_HOST = str(CONFIG.get("service_host") or "").strip() or DEFAULT_CONFIG["service_host"]
+SERVICE_PORT = _get_int_setting("service_port")
+SERVICE_MODE = False
+# Najkrótszy odstęp między zapisami pamięci statystyk w trakcie odświeżania.
+SERVICE_CACHE_SAVE_INTERVAL_SECONDS = 60
+raw_service_mailboxes = CONFIG.get("service_mailboxes") or []
+if isinstance(raw_service_mailboxes, str):
+    raw_service_mailboxes = raw_service_mailboxes.split(",")
+SERVICE_MAILBOXES = [
+    str(item).strip() for item in raw_service_mailboxes if str(item).strip()
+]
+
 BASE_BACKOFF_SECONDS = max(RETRY_DELAY_SECONDS, THROTTLE_DELAY_SECONDS, 1.0)
 MAX_BACKOFF_SECONDS = max(BASE_BACKOFF_SECONDS * 8, BASE_BACKOFF_SECONDS, 60.0)
 
-logging.info("Używany plik konfiguracyjny: %s", CONFIG_PATH)
+if os.path.exists(CONFIG_PATH):
+    logging.info("Używany plik konfiguracyjny: %s", CONFIG_PATH)
+else:
+    logging.info("Brak pliku konfiguracyjnego %s. Używam wartości domyślnych.", CONFIG_PATH)
 logging.info(
-    "Ustawienia żądań: timeout=%ss, retry_delay=%ss, throttle_delay=%ss, limit=%s, batch_size=%s",
+    "Ustawienia żądań: timeout=%ss, retry_delay=%ss, throttle_delay=%ss, limit=%s, batch_size=%s, dead_letter_retries=%s",
     fetch_timeout_seconds,
     RETRY_DELAY_SECONDS,
     THROTTLE_DELAY_SECONDS,
     SEMAPHORE_LIMIT,
     FOLDER_BATCH_SIZE,
+    DEAD_LETTER_RETRIES,
 )
 
+_CLOCK_RESOLUTION = time.get_clock_info("monotonic").resolution
+
+
 class RequestThrottler:
-    def __init__(self, concurrency_limit, base_interval_seconds):
+    """Ogranicza liczbę równoległych żądań i odstęp między ich startami.
+
+    Oczekujące żądania trzymane są w kopcu terminów wyrażonych w czasie
+    wirtualnym; czas rzeczywisty to termin plus wspólne przesunięcie
+    `_offset`. Cooldown przesuwa wyłącznie to przesunięcie, a jeden timer
+    pętli zdarzeń budzi żądania, których termin minął, więc koszt operacji
+    nie zależy od liczby oczekujących.
+    """
+
+    def __init__(self, concurrency_limit, base_interval_seconds, name="default"):
+        self.name = name
         limit = max(1, int(concurrency_limit))
         self._semaphore = asyncio.Semaphore(limit)
         self._base_interval = max(float(base_interval_seconds), 0.0)
-        self._lock = asyncio.Lock()
+        self._offset = 0.0
         self._next_available_time = 0.0
         self._cooldown_until = 0.0
-        self._waiters = []
-
-    async def _reserve_window(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+
+    def _prune(self):
+        while self._heap and self._heap[0][2].done():
+            heapq.heappop(self._heap)
+
+    def _arm_timer(self, loop):
+        self._prune()
+        if not self._heap:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+                self._timer_deadline = None
+            return
+        deadline = self._heap[0][0] + self._offset
+        if self._timer is not None:
+            if self._timer_deadline == deadline:
+                return
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = loop.call_at(deadline, self._release_due, loop)
+
+    def _release_due(self, loop):
+        self._timer = None
+        self._timer_deadline = None
+        now = loop.time() + _CLOCK_RESOLUTION
+        while self._heap and self._heap[0][0] + self._offset <= now:
+            _, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                future.set_result(None)
+        self._arm_timer(loop)
+
+    def _reserve_window(self):
         loop = asyncio.get_running_loop()
-        waiter = _PendingWaiter(0.0)
-        try:
-            async with self._lock:
-                now = loop.time()
-                scheduled_from = max(
-                    now, self._next_available_time, self._cooldown_until
-                )
-                waiter.deadline = scheduled_from
-                self._next_available_time = scheduled_from + self._base_interval
-                self._waiters.append(waiter)
-
-            while True:
-                now = loop.time()
-                remaining = waiter.deadline - now
-                if remaining <= 0:
-                    break
-                try:
-                    await asyncio.wait_for(waiter.event.wait(), timeout=remaining)
-                except asyncio.TimeoutError:
-                    break
-                else:
-                    waiter.event.clear()
-        finally:
-            async with self._lock:
-                if waiter in self._waiters:
-                    self._waiters.remove(waiter)
+        now = loop.time()
+        scheduled_from = max(
+            now, self._next_available_time + self._offset, self._cooldown_until
+        )
+        self._next_available_time = scheduled_from + self._base_interval - self._offset
+        if scheduled_from <= now:
+            return None
+        future = loop.create_future()
+        heapq.heappush(
+            self._heap, (scheduled_from - self._offset, next(self._sequence), future)
+        )
+        self._arm_timer(loop)
+        return future
 
     @asynccontextmanager
     async def slot(self):
+        profiler = PROFILER
+        wait_started = time.perf_counter() if profiler is not None else 0.0
         await self._semaphore.acquire()
         try:
-            await self._reserve_window()
+            window = self._reserve_window()
+            if window is not None:
+                await window
+            if profiler is not None:
+                profiler.record_throttle_wait(time.perf_counter() - wait_started)
             token = _ThrottleToken(self)
             yield token
         finally:
             self._semaphore.release()
 
+    def cooldown_remaining(self):
+        return max(0.0, self._cooldown_until - asyncio.get_running_loop().time())
+
+    async def wait_for_cooldown(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = self._cooldown_until - loop.time()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
     async def apply_cooldown(self, wait_seconds):
         try:
             wait_value = float(wait_seconds)
@@ -387,38 +869,643 @@ class RequestThrottler:
         if wait_value <= 0:
             return
         loop = asyncio.get_running_loop()
-        async with self._lock:
-            now = loop.time()
-            new_cooldown_until = max(self._cooldown_until, now + wait_value)
-            if new_cooldown_until <= self._cooldown_until:
-                return
+        now = loop.time()
+        new_cooldown_until = max(self._cooldown_until, now + wait_value)
+        if new_cooldown_until <= self._cooldown_until:
+            return
 
-            delta = 0.0
-            if self._waiters:
-                earliest_deadline = min(waiter.deadline for waiter in self._waiters)
-                if earliest_deadline < new_cooldown_until:
-                    delta = new_cooldown_until - earliest_deadline
-                    for waiter in self._waiters:
-                        waiter.deadline += delta
-                    self._next_available_time += delta
-            else:
-                self._next_available_time = max(
-                    self._next_available_time, new_cooldown_until
+        self._prune()
+        if self._heap:
+            earliest_deadline = self._heap[0][0] + self._offset
+            if earliest_deadline < new_cooldown_until:
+                self._offset += new_cooldown_until - earliest_deadline
+                self._arm_timer(loop)
+        else:
+            self._next_available_time = (
+                max(self._next_available_time + self._offset, new_cooldown_until)
+                - self._offset
+            )
+
+        self._cooldown_until = new_cooldown_until
+
+
+class DeadLetterQueue:
+    """Strony wiadomości, których nie udało się pobrać mimo ponowień.
+
+    Każdy wpis zawiera adres strony (pierwszej lub `@odata.nextLink`), od której
+    można wznowić stronicowanie folderu bez pobierania go od początku.
+    """
+
+    def __init__(self):
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, mailbox_email, folder_id, folder_path, url):
+        self._entries.append(
+            {
+                "mailbox": mailbox_email,
+                "folder_id": folder_id,
+                "folder_path": folder_path,
+                "url": url,
+            }
+        )
+        logging.warning(
+            "Strona folderu %s w skrzynce %s trafiła do kolejki ponowień: %s",
+            folder_path or folder_id,
+            mailbox_email,
+            url,
+        )
+
+    def drain(self):
+        entries = self._entries
+        self._entries = []
+        return entries
+
+
+class PipelineStats:
+    """Głębokości kolejek i czasy etapów potoków przetwarzania skrzynek.
+
+    Aktywne potoki rejestrują się tutaj, aby panel postępu mógł odczytać
+    bieżące zapełnienie ich kolejek. Czasy etapów są sumowane dla całego
+    przebiegu, a dla każdej kolejki zapamiętywana jest największa głębokość.
+    """
+
+    STAGES = ("fetch", "normalize", "aggregate", "output")
+    LABELS = {
+        "fetch": "pobieranie",
+        "normalize": "normalizacja",
+        "aggregate": "agregacja",
+        "output": "zapis",
+    }
+
+    def __init__(self):
+        self.stages = {
+            stage: {"items": 0, "seconds": 0.0, "max_seconds": 0.0} for stage in self.STAGES
+        }
+        self.max_depths = dict.fromkeys(self.STAGES[1:], 0)
+        self._pipelines = set()
+
+    def register(self, pipeline):
+        self._pipelines.add(pipeline)
+
+    def unregister(self, pipeline):
+        self._pipelines.discard(pipeline)
+
+    def record_stage(self, stage, seconds):
+        values = self.stages[stage]
+        values["items"] += 1
+        values["seconds"] += seconds
+        if seconds > values["max_seconds"]:
+            values["max_seconds"] = seconds
+
+    def record_depth(self, stage, depth):
+        if depth > self.max_depths[stage]:
+            self.max_depths[stage] = depth
+
+    def queue_depths(self):
+        depths = dict.fromkeys(self.STAGES[1:], 0)
+        for pipeline in self._pipelines:
+            for stage, depth in pipeline.queue_depths().items():
+                depths[stage] += depth
+        return depths
+
+    def summary(self):
+        summary = {}
+        for stage, values in self.stages.items():
+            if not values["items"]:
+                continue
+            summary[stage] = {
+                "items": values["items"],
+                "avg_ms": values["seconds"] * 1000.0 / values["items"],
+                "max_ms": values["max_seconds"] * 1000.0,
+                "max_depth": self.max_depths.get(stage),
+            }
+        return summary
+
+
+class RunStats:
+    """Liczniki przebiegu aktualizowane na gorącej ścieżce.
+
+    Zapis to wyłącznie inkrementacja liczników; tempo i ETA wylicza panel
+    postępu przy każdym odświeżeniu.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_times = deque()
+        self.mailboxes = {}
+        self.credentials = {}
+        self.page_sizes = {}
+        self.pipeline = PipelineStats()
+
+    def record_response(self, status, credential="default"):
+        self.requests += 1
+        counters = self.credentials.get(credential)
+        if counters is None:
+            counters = self.credentials[credential] = {"requests": 0, "throttled": 0}
+        counters["requests"] += 1
+        if status == 429:
+            self.throttled += 1
+            counters["throttled"] += 1
+            self.throttled_times.append(time.monotonic())
+
+    def record_page_sizes(self, mailbox_email, folder_path, page_sizer):
+        self.page_sizes[(mailbox_email, folder_path)] = {
+            "pages": page_sizer.pages,
+            "timeouts": page_sizer.timeouts,
+            "min": page_sizer.min_size,
+            "max": page_sizer.max_size,
+            "final": page_sizer.size,
+        }
+        logging.debug(
+            "Rozmiar strony dla %s / %s: końcowy=%s, min=%s, max=%s, stron=%s, timeoutów=%s",
+            mailbox_email,
+            folder_path,
+            page_sizer.size,
+            page_sizer.min_size,
+            page_sizer.max_size,
+            page_sizer.pages,
+            page_sizer.timeouts,
+        )
+
+    def page_size_summary(self):
+        if not self.page_sizes:
+            return None
+        finals = sorted(values["final"] for values in self.page_sizes.values())
+        return {
+            "folders": len(finals),
+            "min": min(values["min"] for values in self.page_sizes.values()),
+            "max": max(values["max"] for values in self.page_sizes.values()),
+            "median_final": finals[len(finals) // 2],
+            "timeouts": sum(values["timeouts"] for values in self.page_sizes.values()),
+        }
+
+    def credential_summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        summary = {}
+        for name, counters in self.credentials.items():
+            summary[name] = {
+                "mailboxes": 0,
+                "messages": 0,
+                "requests": counters["requests"],
+                "throttled": counters["throttled"],
+            }
+        for entry in self.mailboxes.values():
+            name = entry.get("credential", "default")
+            values = summary.setdefault(
+                name, {"mailboxes": 0, "messages": 0, "requests": 0, "throttled": 0}
+            )
+            values["mailboxes"] += 1
+            values["messages"] += entry["done"]
+        for values in summary.values():
+            values["requests_per_second"] = values["requests"] / elapsed
+            values["messages_per_second"] = values["messages"] / elapsed
+        return summary
+
+    def mailbox(self, mailbox_email):
+        entry = self.mailboxes.get(mailbox_email)
+        if entry is None:
+            entry = {"done": 0, "expected": 0, "finished": False}
+            self.mailboxes[mailbox_email] = entry
+        return entry
+
+
+RUN_STATS = RunStats()
+
+PROFILE_STAGE = contextvars.ContextVar("profile_stage", default="")
+
+
+class _CpuTimedAwaitable:
+    """Sumuje czas CPU kroków jednej korutyny.
+
+    Czas jest mierzony tylko podczas wykonywania kolejnych kroków korutyny,
+    więc praca innych zadań wykonywana w czasie jej oczekiwania nie jest
+    wliczana.
+    """
+
+    def __init__(self, awaitable):
+        self._awaitable = awaitable
+        self.cpu_seconds = 0.0
+
+    def __await__(self):
+        iterator = self._awaitable.__await__()
+        value = None
+        error = None
+        while True:
+            started = time.thread_time()
+            try:
+                if error is None:
+                    yielded = iterator.send(value)
+                else:
+                    yielded = iterator.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.cpu_seconds += time.thread_time() - started
+            try:
+                value = yield yielded
+                error = None
+            except BaseException as raised:
+                value = None
+                error = raised
+
+
+class StageProfiler:
+    """Czasy etapów przebiegu włączane opcją `--profile`.
+
+    Dla każdego etapu sumowany jest czas rzeczywisty, czas CPU oraz czas
+    oczekiwania na sloty ogranicznika żądań. Bieżący etap przechowuje
+    zmienna kontekstowa zadania, więc ogranicznik przypisuje oczekiwanie do
+    właściwego etapu. Opcjonalny wątek próbkujący zapisuje stosy wątku pętli
+    zdarzeń w formacie „folded” dla narzędzi flame graph.
+    """
+
+    STAGES = ("folders", "fetch", "normalize", "aggregate", "export")
+    LABELS = {
+        "folders": "lista folderów",
+        "fetch": "pobieranie stron",
+        "normalize": "przetwarzanie stron",
+        "aggregate": "agregacja",
+        "export": "zapis Excel",
+    }
+
+    def __init__(self, sample_interval_seconds=0.0):
+        self.started = time.perf_counter()
+        self.stages = {
+            stage: {"calls": 0, "wall": 0.0, "cpu": None, "throttle": 0.0, "max_wall": 0.0}
+            for stage in self.STAGES
+        }
+        self.samples = defaultdict(int)
+        self.sample_interval = max(float(sample_interval_seconds), 0.0)
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampler_stop = threading.Event()
+
+    def record(self, stage, wall_seconds, cpu_seconds=None):
+        with self._lock:
+            values = self.stages[stage]
+            values["calls"] += 1
+            values["wall"] += wall_seconds
+            if wall_seconds > values["max_wall"]:
+                values["max_wall"] = wall_seconds
+            if cpu_seconds is not None:
+                values["cpu"] = (values["cpu"] or 0.0) + cpu_seconds
+
+    def record_throttle_wait(self, seconds):
+        stage = PROFILE_STAGE.get()
+        if not stage:
+            return
+        with self._lock:
+            self.stages[stage]["throttle"] += seconds
+
+    @contextmanager
+    def section(self, stage):
+        context_token = PROFILE_STAGE.set(stage)
+        wall_started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(
+                stage,
+                time.perf_counter() - wall_started,
+                time.thread_time() - cpu_started,
+            )
+            PROFILE_STAGE.reset(context_token)
+
+    async def measure(self, stage, awaitable):
+        context_token = PROFILE_STAGE.set(stage)
+        timed = _CpuTimedAwaitable(awaitable)
+        wall_started = time.perf_counter()
+        try:
+            return await timed
+        finally:
+            self.record(stage, time.perf_counter() - wall_started, timed.cpu_seconds)
+            PROFILE_STAGE.reset(context_token)
+
+    def start_sampling(self, thread_id):
+        if self.sample_interval <= 0:
+            return
+        self._sampler = threading.Thread(
+            target=self._sample, args=(thread_id,), name="profile-sampler", daemon=True
+        )
+        self._sampler.start()
+
+    def stop_sampling(self):
+        if self._sampler is None:
+            return
+        self._sampler_stop.set()
+        self._sampler.join()
+        self._sampler = None
+
+    def _sample(self, thread_id):
+        while not self._sampler_stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
                 )
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def folded_lines(self):
+        """Wiersze „stos liczba”: próbki stosów lub, bez próbkowania,
+        czasy etapów w milisekundach rozbite na CPU, ogranicznik i resztę."""
+        if self.samples:
+            return [f"{stack} {count}" for stack, count in sorted(self.samples.items())]
+        lines = []
+        for stage, values in self.stages.items():
+            if not values["calls"]:
+                continue
+            cpu = values["cpu"] or 0.0
+            other = max(values["wall"] - cpu - values["throttle"], 0.0)
+            for part, seconds in (("cpu", cpu), ("throttle", values["throttle"]), ("other", other)):
+                milliseconds = round(seconds * 1000)
+                if milliseconds > 0:
+                    lines.append(f"run;{stage};{part} {milliseconds}")
+        return lines
+
+    def summary_lines(self, top_frames=15):
+        elapsed = time.perf_counter() - self.started
+        lines = [
+            f"Profil przebiegu: czas całkowity {elapsed:.2f} s",
+            f"{'Etap':<22}{'wywołań':>9}{'czas [s]':>11}{'śr. [ms]':>11}"
+            f"{'maks. [ms]':>12}{'CPU [s]':>10}{'limit [s]':>11}",
+        ]
+        for stage, values in self.stages.items():
+            if not values["calls"]:
+                continue
+            cpu = "-" if values["cpu"] is None else f"{values['cpu']:.3f}"
+            lines.append(
+                f"{self.LABELS[stage]:<22}{values['calls']:>9}{values['wall']:>11.3f}"
+                f"{values['wall'] * 1000.0 / values['calls']:>11.1f}"
+                f"{values['max_wall'] * 1000.0:>12.1f}{cpu:>10}{values['throttle']:>11.3f}"
+            )
+        if self.samples:
+            total = sum(self.samples.values())
+            own = defaultdict(int)
+            for stack, count in self.samples.items():
+                own[stack.rsplit(";", 1)[-1]] += count
+            lines.append(
+                f"Próbki wątku pętli zdarzeń: {total} (co {self.sample_interval * 1000:.1f} ms)"
+            )
+            for frame, count in sorted(own.items(), key=lambda item: -item[1])[:top_frames]:
+                lines.append(f"{count * 100.0 / total:6.1f}%  {frame}")
+        return lines
 
-            self._cooldown_until = new_cooldown_until
-            waiters_to_wake = list(self._waiters) if delta > 0 else []
+    def write(self, prefix="profile"):
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        folded_path = f"{prefix}_{timestamp}.folded"
+        summary_path = f"{prefix}_{timestamp}.txt"
+        with open(folded_path, "w", encoding="utf-8") as folded_file:
+            folded_file.writelines(line + "\n" for line in self.folded_lines())
+        summary = self.summary_lines()
+        with open(summary_path, "w", encoding="utf-8") as summary_file:
+            summary_file.writelines(line + "\n" for line in summary)
+        for line in summary:
+            logging.info(line)
+        logging.info("Profil zapisano do plików: %s, %s", folded_path, summary_path)
+        return folded_path, summary_path
+
+
+PROFILER = None
+
+
+def profile_section(stage):
+    if PROFILER is None:
+        return nullcontext()
+    return PROFILER.section(stage)
+
+
+async def profiled(stage, awaitable):
+    if PROFILER is None:
+        return await awaitable
+    return await PROFILER.measure(stage, awaitable)
+
+
+class DashboardProgress:
+    """Zamiennik paska tqdm zasilający panel postępu."""
+
+    def __init__(self, stats, mailbox_email):
+        self._entry = stats.mailbox(mailbox_email)
+        self._entry.update(done=0, expected=0, finished=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._entry["finished"] = True
+        return False
+
+    @property
+    def total(self):
+        return self._entry["expected"]
+
+    @total.setter
+    def total(self, value):
+        self._entry["expected"] = value
+
+    def update(self, count=1):
+        self._entry["done"] += count
+
+    def write(self, message):
+        logging.debug(message)
+
+
+class _MailboxProgressBar(tqdm):
+    """Pasek tqdm, który dodatkowo aktualizuje liczniki przebiegu.
+
+    Komunikaty `write` trafiają do logów zamiast bezpośrednio na konsolę,
+    więc nie blokują pętli zdarzeń. Wiersz konsoli zwolniony przez
+    zakończoną skrzynkę dostaje kolejna skrzynka, więc przy wykrywaniu
+    skrzynek liczba wierszy nie przekracza liczby skrzynek przetwarzanych
+    jednocześnie.
+    """
+
+    _free_positions = []
+    _next_position = 0
+
+    def __init__(self, stats, mailbox_email, **kwargs):
+        self._entry = stats.mailbox(mailbox_email)
+        self._slot = self._acquire_position()
+        super().__init__(position=self._slot, **kwargs)
+
+    @classmethod
+    def _acquire_position(cls):
+        if cls._free_positions:
+            return heapq.heappop(cls._free_positions)
+        position = cls._next_position
+        cls._next_position += 1
+        return position
+
+    def update(self, n=1):
+        self._entry["done"] += n
+        return super().update(n)
+
+    def write(self, message):
+        logging.debug(message)
+
+    def close(self):
+        self._entry["finished"] = True
+        super().close()
+        if self._slot is not None:
+            heapq.heappush(self._free_positions, self._slot)
+            self._slot = None
+
+
+def open_mailbox_progress(mailbox_email):
+    if LIVE_DASHBOARD or SERVICE_MODE:
+        return DashboardProgress(RUN_STATS, mailbox_email)
+    return _MailboxProgressBar(
+        RUN_STATS,
+        mailbox_email,
+        total=1,
+        desc=f"Przetwarzanie {mailbox_email}",
+        unit="msg",
+        leave=True,
+    )
 
-        for waiter in waiters_to_wake:
-            waiter.event.set()
 
+def _format_eta(seconds):
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class LiveDashboard:
+    """Zbiorczy widok postępu wszystkich skrzynek odświeżany co stały czas."""
+
+    MAX_MAILBOX_LINES = 15
+    SMOOTHING = 0.3
+
+    def __init__(self, stats, throttlers, refresh_seconds, stream=None):
+        self._stats = stats
+        self._throttlers = throttlers
+        self._refresh_seconds = refresh_seconds
+        self._stream = stream or sys.stderr
+        self._is_tty = hasattr(self._stream, "isatty") and self._stream.isatty()
+        self._rendered_lines = 0
+        self._last_time = time.monotonic()
+        self._last_requests = 0
+        self._last_done = {}
+        self._rates = {}
+        self._request_rate = 0.0
+
+    def _smooth(self, previous, current):
+        if previous is None:
+            return current
+        return previous + self.SMOOTHING * (current - previous)
+
+    def render(self):
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-6)
+        self._last_time = now
+        stats = self._stats
+
+        while stats.throttled_times and now - stats.throttled_times[0] > 60:
+            stats.throttled_times.popleft()
+
+        request_delta = stats.requests - self._last_requests
+        self._last_requests = stats.requests
+        self._request_rate = self._smooth(self._request_rate, request_delta / elapsed)
+
+        total_done = 0
+        total_expected = 0
+        total_rate = 0.0
+        finished = 0
+        mailbox_lines = []
+        for mailbox_email, entry in stats.mailboxes.items():
+            done = entry["done"]
+            expected = max(entry["expected"], done)
+            delta = done - self._last_done.get(mailbox_email, 0)
+            self._last_done[mailbox_email] = done
+            rate = self._smooth(self._rates.get(mailbox_email), delta / elapsed)
+            self._rates[mailbox_email] = rate
+            total_done += done
+            total_expected += expected
+            if entry["finished"]:
+                finished += 1
+                continue
+            total_rate += rate
+            remaining = expected - done
+            eta = remaining / rate if rate > 0 else None
+            percent = done * 100.0 / expected if expected else 0.0
+            mailbox_lines.append(
+                (
+                    remaining,
+                    f"  {mailbox_email[:40]:<40} {done:>9}/{expected:<9} {percent:5.1f}% "
+                    f"{rate:8.1f} msg/s  ETA {_format_eta(eta)}",
+                )
+            )
 
-class _PendingWaiter:
-    __slots__ = ("deadline", "event")
+        cooldown = max(
+            (throttler.cooldown_remaining() for throttler in self._throttlers),
+            default=0.0,
+        )
+        total_remaining = total_expected - total_done
+        total_eta = total_remaining / total_rate if total_rate > 0 else None
+        if not total_remaining:
+            total_eta = 0
+        lines = [
+            f"Skrzynki: {finished}/{len(stats.mailboxes)} | wiadomości: {total_done}/{total_expected} "
+            f"({total_rate:.1f}/s) | żądania: {self._request_rate:.1f}/s | "
+            f"429/min: {len(stats.throttled_times)} | cooldown: {cooldown:.1f}s | "
+            f"ETA: {_format_eta(total_eta)} | czas: {_format_eta(now - stats.started)}"
+        ]
+        if len(self._throttlers) > 1:
+            for throttler in self._throttlers:
+                counters = stats.credentials.get(throttler.name, {})
+                lines.append(
+                    f"  [{throttler.name}] żądania: {counters.get('requests', 0)} | "
+                    f"429: {counters.get('throttled', 0)} | "
+                    f"cooldown: {throttler.cooldown_remaining():.1f}s"
+                )
+        pipeline_stats = stats.pipeline
+        if pipeline_stats.stages["fetch"]["items"]:
+            depths = pipeline_stats.queue_depths()
+            latencies = ", ".join(
+                f"{pipeline_stats.LABELS[stage]} {values['avg_ms']:.0f}ms"
+                for stage, values in pipeline_stats.summary().items()
+            )
+            lines.append(
+                "  Potok: kolejki normalizacja/agregacja/zapis: "
+                f"{depths['normalize']}/{depths['aggregate']}/{depths['output']} | "
+                f"śr. czas: {latencies}"
+            )
+        mailbox_lines.sort(key=lambda item: item[0], reverse=True)
+        lines.extend(line for _, line in mailbox_lines[: self.MAX_MAILBOX_LINES])
+        hidden = len(mailbox_lines) - self.MAX_MAILBOX_LINES
+        if hidden > 0:
+            lines.append(f"  ... oraz {hidden} innych aktywnych skrzynek")
+        return lines
+
+    def draw(self):
+        lines = self.render()
+        if self._is_tty:
+            if self._rendered_lines:
+                self._stream.write(f"\x1b[{self._rendered_lines}F\x1b[J")
+            self._stream.write("\n".join(lines) + "\n")
+            self._rendered_lines = len(lines)
+        else:
+            self._stream.write(lines[0] + "\n")
+        self._stream.flush()
 
-    def __init__(self, deadline):
-        self.deadline = deadline
-        self.event = asyncio.Event()
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self._refresh_seconds)
+                self.draw()
+        except asyncio.CancelledError:
+            self.draw()
+            raise
 
 
 class _ThrottleToken:
@@ -569,12 +1656,149 @@ def parse_retry_after(header_value):
     return delay
 
 
-def get_access_token():
-    authority = f"https://login.microsoftonline.com/{TENANT_ID}"
+class HttpCassette:
+    """Archiwum odpowiedzi Graph do nagrywania i odtwarzania przebiegów.
+
+    Kluczem jest pełny adres żądania (token nie jest jego częścią), a treść
+    odpowiedzi przechowywana jest w postaci skompresowanej. Kompresja i
+    operacje SQLite wykonywane są w osobnym wątku, aby nie blokować pętli
+    zdarzeń.
+    """
+
+    COMMIT_EVERY = 50
+
+    def __init__(self, path, mode, replay_latency_ms=0):
+        self.path = path
+        self.mode = mode
+        self.replaying = mode == "replay"
+        self._replay_latency = max(replay_latency_ms, 0) / 1000.0
+        self._pending = 0
+        if self.replaying and not os.path.exists(path):
+            raise FileNotFoundError(f"Brak archiwum odpowiedzi: {path}")
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, recorded_at TEXT, body BLOB)"
+        )
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="http-cassette"
+        )
+
+    def _record(self, url, body):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO responses (url, recorded_at, body) VALUES (?, ?, ?)",
+            (url, datetime.datetime.now().isoformat(), zlib.compress(body)),
+        )
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self._connection.commit()
+            self._pending = 0
+
+    def record(self, url, body):
+        future = self._executor.submit(self._record, url, body)
+        future.add_done_callback(self._log_record_error)
+
+    @staticmethod
+    def _log_record_error(future):
+        error = future.exception()
+        if error is not None:
+            logging.warning(
+                "Nie można zapisać odpowiedzi w archiwum: %s", summarize_text(error)
+            )
+
+    def _load(self, url):
+        row = self._connection.execute(
+            "SELECT body FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        return None if row is None else zlib.decompress(row[0])
+
+    async def replay(self, url):
+        if self._replay_latency:
+            await asyncio.sleep(self._replay_latency)
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(self._executor, self._load, url)
+        if body is None:
+            logging.warning("Brak odpowiedzi w archiwum dla %s", url)
+        return body
+
+    def _close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def close(self):
+        self._executor.submit(self._close).result()
+        self._executor.shutdown(wait=True)
+
+
+HTTP_CASSETTE = None
+
+
+class AdaptivePageSizer:
+    """Dobiera rozmiar strony (`$top`) i limit czasu dla jednego folderu.
+
+    Strona jest zmniejszana po przekroczeniu limitu czasu oraz po wolnych lub
+    ciężkich odpowiedziach, a zwiększana po szybkich i lekkich, w granicach
+    dopuszczanych przez Graph. Limit czasu rośnie proporcjonalnie do
+    zmierzonego czasu pobrania jednej wiadomości, nie spadając poniżej
+    `fetch_timeout_seconds`.
+    """
+
+    GROWTH = 1.5
+    SHRINK = 0.7
+    TIMEOUT_FACTOR = 4.0
+    SMOOTHING = 0.3
+
+    def __init__(self, initial_size=None):
+        self.size = initial_size or MESSAGE_PAGE_SIZE
+        self.min_size = self.size
+        self.max_size = self.size
+        self.pages = 0
+        self.timeouts = 0
+        self._seconds_per_item = None
+
+    @property
+    def timeout(self):
+        if self._seconds_per_item is None:
+            return FETCH_TIMEOUT
+        expected = self._seconds_per_item * self.size * self.TIMEOUT_FACTOR
+        total = min(max(expected, fetch_timeout_seconds), fetch_timeout_seconds * 4)
+        return aiohttp.ClientTimeout(total=total)
+
+    def apply(self, url):
+        return re.sub(r"([?&])(\$|%24)top=\d+", rf"\g<1>\g<2>top={self.size}", url, count=1)
+
+    def _resize(self, new_size):
+        self.size = max(MESSAGE_PAGE_SIZE_MINIMUM, min(int(new_size), MESSAGE_PAGE_SIZE_LIMIT))
+        self.min_size = min(self.min_size, self.size)
+        self.max_size = max(self.max_size, self.size)
+
+    def record_success(self, elapsed_seconds, body_bytes):
+        self.pages += 1
+        per_item = elapsed_seconds / max(self.size, 1)
+        if self._seconds_per_item is None:
+            self._seconds_per_item = per_item
+        else:
+            self._seconds_per_item += self.SMOOTHING * (per_item - self._seconds_per_item)
+
+        if elapsed_seconds > PAGE_TARGET_SECONDS or body_bytes > PAGE_MAX_BYTES:
+            self._resize(self.size * self.SHRINK)
+        elif elapsed_seconds < PAGE_TARGET_SECONDS / 4 and body_bytes < PAGE_MAX_BYTES / 4:
+            self._resize(self.size * self.GROWTH)
+
+    def record_timeout(self):
+        self.timeouts += 1
+        self._resize(self.size // 2)
+
+
+def get_access_token(client_id=None, client_secret=None, tenant_id=None):
+    client_id = client_id or CLIENT_ID
+    client_secret = client_secret or CLIENT_SECRET
+    tenant_id = tenant_id or TENANT_ID
+    authority = f"https://login.microsoftonline.com/{tenant_id}"
     app = msal.ConfidentialClientApplication(
-        CLIENT_ID,
+        client_id,
         authority=authority,
-        client_credential=CLIENT_SECRET
+        client_credential=client_secret
     )
     try:
         token_response = app.acquire_token_for_client(scopes=SCOPES)
@@ -589,28 +1813,70 @@ def get_access_token():
         error_details = summarize_text(token_response)
         logging.error(
             "Nie udało się uzyskać tokena dostępu dla tenant_id=%s: %s",
-            TENANT_ID,
+            tenant_id,
             error_details or "brak szczegółów",
         )
         raise Exception(f"Nie udało się uzyskać tokena: {error_details}")
     return token_response["access_token"]
 
-async def fetch(session, url, headers, throttler, retries=3, pbar=None):
+_URL_KINDS = (
+    ("count", "$count=true"),
+    ("delta", "/delta"),
+    ("messages", "/messages"),
+    ("childFolders", "/childFolders"),
+    ("mailFolders", "/mailFolders"),
+    ("groups", "/groups/"),
+    ("users", "/users"),
+)
+
+
+def graph_url_kind(url):
+    for kind, marker in _URL_KINDS:
+        if marker in url:
+            return kind
+    return "other"
+
+
+async def fetch(session, url, headers, throttler, retries=3, pbar=None, raw=False, page_sizer=None):
+    loop = asyncio.get_running_loop()
     attempts_left = retries
     last_error_summary = ""
     backoff_seconds = BASE_BACKOFF_SECONDS
 
+    if HTTP_CASSETTE is not None and HTTP_CASSETTE.replaying:
+        body = await HTTP_CASSETTE.replay(url)
+        RUN_STATS.record_response(200 if body is not None else 404, throttler.name)
+        if body is None:
+            return None
+        return body if raw else json.loads(body)
+
     while attempts_left > 0:
         current_wait = backoff_seconds
         async with throttler.slot() as throttle_slot:
+            request_url = url
+            request_timeout = FETCH_TIMEOUT
+            if page_sizer is not None:
+                request_url = page_sizer.apply(url)
+                request_timeout = page_sizer.timeout
+            request_started = loop.time()
             try:
                 async with session.get(
-                    url,
+                    request_url,
                     headers=headers,
-                    timeout=FETCH_TIMEOUT,
+                    timeout=request_timeout,
                 ) as response:
+                    RUN_STATS.record_response(response.status, throttler.name)
                     if response.status == 200:
-                        return await response.json()
+                        body = await response.read()
+                        if page_sizer is not None:
+                            page_sizer.record_success(
+                                loop.time() - request_started, len(body)
+                            )
+                        if HTTP_CASSETTE is not None:
+                            HTTP_CASSETTE.record(url, body)
+                        if raw:
+                            return body
+                        return json.loads(body)
 
                     error_text = await response.text()
                     error_summary = summarize_text(error_text)
@@ -619,10 +1885,15 @@ async def fetch(session, url, headers, throttler, retries=3, pbar=None):
                         response.status,
                         url,
                         error_summary or "brak treści",
+                        extra={
+                            "url_kind": graph_url_kind(url),
+                            "status": response.status,
+                            "latency_ms": round((loop.time() - request_started) * 1000),
+                        },
                     )
                     if pbar:
                         pbar.write(
-                            f"Błąd pobierania danych: {response.status} {error_text}"
+                            f"Błąd pobierania danych: {response.status} {error_summary}"
                         )
                     last_error_summary = (
                         f"{response.status} {error_summary}".strip()
@@ -646,11 +1917,19 @@ async def fetch(session, url, headers, throttler, retries=3, pbar=None):
                     else:
                         await throttle_slot.extend_cooldown(THROTTLE_DELAY_SECONDS)
             except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                RUN_STATS.record_response(None, throttler.name)
+                if page_sizer is not None and isinstance(error, asyncio.TimeoutError):
+                    page_sizer.record_timeout()
                 error_summary = summarize_text(error)
                 logging.warning(
                     "Wyjątek podczas pobierania %s: %s",
                     url,
                     error_summary or f"{error.__class__.__name__}: {error}",
+                    extra={
+                        "url_kind": graph_url_kind(url),
+                        "status": error.__class__.__name__,
+                        "latency_ms": round((loop.time() - request_started) * 1000),
+                    },
                 )
                 if pbar:
                     pbar.write(
@@ -685,6 +1964,7 @@ async def fetch(session, url, headers, throttler, retries=3, pbar=None):
         url,
         retries,
         last_error_summary or "brak szczegółów",
+        extra={"url_kind": graph_url_kind(url)},
     )
     return None
 
@@ -752,29 +2032,409 @@ async def get_all_folders(session, token, mailbox_email, throttler, pbar=None):
 
     return all_folders
 
-async def get_messages_from_folder(session, token, mailbox_email, folder_id, pbar, throttler, retries=3):
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Prefer": 'outlook.body-content-type="html"',
-    }
-    base_url = (
-        "https://graph.microsoft.com/v1.0/users/"
-        f"{mailbox_email}/mailFolders/{folder_id}/messages"
-    )
-    attachments_expand = "attachments($select=size,isInline)"
-    extended_filter = quote("id eq 'Integer 0x0E08' or id eq 'Long 0x0E08'", safe="")
+def process_message_page(page_messages):
+    for msg in page_messages:
+        attachments = msg.get("attachments", []) or []
+        regular_attachment_size = 0
+        inline_attachment_size = 0
 
-    select_parts = [
-        "subject",
-        "receivedDateTime",
-        "hasAttachments",
-        "id",
-        "from",
-        "body",
-        "bodyPreview",
-        "internetMessageHeaders",
-        "singleValueExtendedProperties",
-        "toRecipients",
+        for att in attachments:
+            att_size = safe_int(att.get("size"))
+            if not att_size:
+                continue
+            if att.get("isInline"):
+                inline_attachment_size += att_size
+            else:
+                regular_attachment_size += att_size
+
+        msg["attachment_size"] = regular_attachment_size
+
+        estimated_body = estimate_message_body_bytes(msg)
+        extended_total = extract_extended_message_size(msg)
+        baseline_body = estimated_body + inline_attachment_size
+        baseline_total = regular_attachment_size + baseline_body
+
+        if extended_total > 0:
+            total_size = max(extended_total, baseline_total)
+            body_size = max(total_size - regular_attachment_size, baseline_body)
+        else:
+            body_size = baseline_body
+            total_size = baseline_total
+
+        msg["body_size"] = body_size
+        msg["total_size"] = total_size
+
+        msg.pop("attachments", None)
+        msg.pop("singleValueExtendedProperties", None)
+        msg.pop("internetMessageHeaders", None)
+        msg.pop("body", None)
+        msg.pop("bodyPreview", None)
+        msg.pop("toRecipients", None)
+        msg.pop("ccRecipients", None)
+        msg.pop("bccRecipients", None)
+    return page_messages
+
+
+def process_message_page_bytes(raw_page):
+    return process_message_page(json.loads(raw_page).get("value", []))
+
+
+_NEXT_LINK_KEY = b'"@odata.nextLink"'
+_NEXT_LINK_VALUE = re.compile(rb'\s*:\s*("(?:[^"\\]|\\.)*")')
+
+
+def extract_next_link(raw_page):
+    """Odczytuje `@odata.nextLink` z surowej strony bez dekodowania całości.
+
+    Klucz najwyższego poziomu nie jest poprzedzony ukośnikiem, w odróżnieniu
+    od tego samego tekstu wewnątrz treści wiadomości, gdzie cudzysłowy są
+    zawsze poprzedzone znakiem ucieczki.
+    """
+    end = len(raw_page)
+    while True:
+        index = raw_page.rfind(_NEXT_LINK_KEY, 0, end)
+        if index < 0:
+            return None
+        backslashes = 0
+        while index - backslashes > 0 and raw_page[index - backslashes - 1] == 0x5C:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            match = _NEXT_LINK_VALUE.match(raw_page, index + len(_NEXT_LINK_KEY))
+            if match:
+                return json.loads(match.group(1))
+        end = index
+
+
+def _init_page_worker(log_queue, log_level):
+    """Kieruje logi procesu roboczego do kolejki czytanej przez proces główny.
+
+    Proces utworzony przez fork dziedziczy procedurę obsługi kolejki, której
+    w nim nikt nie odczytuje, a proces utworzony przez spawn nie ma żadnej.
+    """
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(LogQueueHandler(log_queue))
+    root_logger.setLevel(log_level)
+
+
+class PageProcessor:
+    """Normalizuje surowe strony wiadomości w puli procesów.
+
+    Pętla zdarzeń obsługuje wtedy wyłącznie I/O, a semafor ogranicza łączną
+    liczbę stron przetwarzanych jednocześnie przez potoki wszystkich skrzynek.
+    Logi procesów roboczych wracają przez kolejkę międzyprocesową do
+    `log_queue_handler`, więc przechodzą przez te same filtry co pozostałe.
+    """
+
+    def __init__(self, workers, max_in_flight):
+        context = multiprocessing.get_context()
+        self._log_queue = context.Queue()
+        self._log_listener = logging.handlers.QueueListener(
+            self._log_queue, log_queue_handler
+        )
+        self._log_listener.start()
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_page_worker,
+            initargs=(self._log_queue, LOG_LEVEL),
+        )
+        self._in_flight = asyncio.Semaphore(max(1, int(max_in_flight)))
+
+    async def submit(self, raw_page):
+        await self._in_flight.acquire()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, process_message_page_bytes, raw_page)
+        future.add_done_callback(lambda _: self._in_flight.release())
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        self._log_listener.stop()
+        self._log_queue.close()
+
+
+class FolderCache:
+    """Pamięć podręczna drzewa folderów i rozmiarów wiadomości jednej skrzynki.
+
+    Plik `.json` przechowuje foldery, token `mailFolders/delta` oraz listę
+    folderów pobranych w całości; wiadomości tych folderów są zapisywane
+    wiersz po wierszu w pliku `.messages.jsonl.gz`.
+    """
+
+    def __init__(self, directory, mailbox_email):
+        safe_mailbox = mailbox_email.replace("@", "_at_").replace(".", "_")
+        self.meta_path = os.path.join(directory, f"{safe_mailbox}.json")
+        self.messages_path = os.path.join(directory, f"{safe_mailbox}.messages.jsonl.gz")
+        self._temp_messages_path = f"{self.messages_path}.tmp"
+        self._messages_file = None
+
+    def load(self):
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as meta_file:
+                state = json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as error:
+            logging.warning(
+                "Nie można odczytać pamięci podręcznej folderów %s: %s",
+                self.meta_path,
+                summarize_text(error),
+            )
+            return None
+        if not isinstance(state, dict) or not isinstance(state.get("folders"), dict):
+            return None
+        return state
+
+    def iter_messages(self, folder_ids, chunk_size=500):
+        """Zwraca wiadomości wskazanych folderów paczkami `(folder_id, lista)`."""
+        folder_ids = set(folder_ids)
+        if not folder_ids:
+            return
+        current_folder = None
+        chunk = []
+        with gzip.open(self.messages_path, "rt", encoding="utf-8") as messages_file:
+            for line in messages_file:
+                record = json.loads(line)
+                folder_id = record.get("folder_id")
+                if folder_id not in folder_ids:
+                    continue
+                if chunk and (folder_id != current_folder or len(chunk) >= chunk_size):
+                    yield current_folder, chunk
+                    chunk = []
+                current_folder = folder_id
+                chunk.append(record["message"])
+        if chunk:
+            yield current_folder, chunk
+
+    def begin_save(self):
+        os.makedirs(os.path.dirname(self.meta_path), exist_ok=True)
+        self._messages_file = gzip.open(self._temp_messages_path, "wt", encoding="utf-8")
+
+    def append_messages(self, folder_id, messages):
+        for message in messages:
+            self._messages_file.write(
+                json.dumps({"folder_id": folder_id, "message": message}, ensure_ascii=False)
+            )
+            self._messages_file.write("\n")
+
+    def commit(self, delta_link, folders_state, cached_folder_ids):
+        self._messages_file.close()
+        self._messages_file = None
+        os.replace(self._temp_messages_path, self.messages_path)
+
+        state = {
+            "delta_link": delta_link,
+            "folders": folders_state,
+            "cached_folders": list(cached_folder_ids),
+        }
+        temp_meta_path = f"{self.meta_path}.tmp"
+        with open(temp_meta_path, "w", encoding="utf-8") as meta_file:
+            json.dump(state, meta_file, ensure_ascii=False)
+        os.replace(temp_meta_path, self.meta_path)
+
+    def abort(self):
+        if self._messages_file is None:
+            return
+        self._messages_file.close()
+        self._messages_file = None
+        try:
+            os.remove(self._temp_messages_path)
+        except OSError:
+            pass
+
+
+def build_folder_list(folders_state):
+    children = defaultdict(list)
+    roots = []
+    for folder_id, folder in folders_state.items():
+        parent_id = folder.get("parentFolderId")
+        if parent_id in folders_state:
+            children[parent_id].append(folder_id)
+        else:
+            roots.append(folder_id)
+
+    result = []
+    stack = [(folder_id, "") for folder_id in reversed(roots)]
+    while stack:
+        folder_id, parent_path = stack.pop()
+        folder = folders_state[folder_id]
+        folder_name = folder.get("displayName", "")
+        current_path = f"{parent_path}/{folder_name}" if parent_path else folder_name
+        result.append(
+            {
+                "id": folder_id,
+                "path": current_path,
+                "displayName": folder_name,
+                "totalItemCount": folder.get("totalItemCount", 0),
+            }
+        )
+        stack.extend((child_id, current_path) for child_id in reversed(children[folder_id]))
+    return result
+
+
+def build_folder_messages_delta_url(mailbox_email, folder_id):
+    return (
+        f"https://graph.microsoft.com/v1.0/users/{mailbox_email}/mailFolders/"
+        f"{folder_id}/messages/delta?$select=id"
+    )
+
+
+async def sync_folder_messages_delta(session, headers, url, throttler, pbar=None):
+    """Przechodzi zapytanie `messages/delta` folderu aż do `deltaLink`.
+
+    Zwraca nowy `deltaLink` i liczbę wiadomości dodanych, zmienionych lub
+    usuniętych od poprzedniego tokenu albo `None`, jeśli zapytanie się nie
+    powiodło (np. token wygasł).
+    """
+    changes = 0
+    while url:
+        data = await fetch(session, url, headers, throttler, pbar=pbar)
+        if not data:
+            return None
+        changes += len(data.get("value", []))
+        delta_link = data.get("@odata.deltaLink")
+        if delta_link:
+            return delta_link, changes
+        url = data.get("@odata.nextLink")
+    return None
+
+
+async def sync_folder_tree(session, token, mailbox_email, throttler, folder_cache, pbar=None):
+    """Aktualizuje drzewo folderów z pamięci podręcznej zapytaniem delta.
+
+    Zwraca listę folderów, nowy `deltaLink`, stan folderów do zapisania i
+    zbiór identyfikatorów folderów, których wiadomości można wziąć z pamięci
+    podręcznej. Zwraca `None`, jeśli nie udało się pobrać zmian.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    initial_url = (
+        f"https://graph.microsoft.com/v1.0/users/{mailbox_email}/mailFolders/delta"
+        "?$select=displayName,parentFolderId,totalItemCount"
+    )
+    loop = asyncio.get_running_loop()
+    state = await loop.run_in_executor(None, folder_cache.load)
+
+    while True:
+        folders_state = dict(state["folders"]) if state else {}
+        url = (state or {}).get("delta_link") or initial_url
+        changed = set()
+        delta_link = None
+
+        while url:
+            data = await fetch(session, url, headers, throttler, pbar=pbar)
+            if not data:
+                break
+            for item in data.get("value", []):
+                folder_id = item.get("id")
+                if not folder_id:
+                    continue
+                changed.add(folder_id)
+                if "@removed" in item:
+                    folders_state.pop(folder_id, None)
+                    continue
+                folder = folders_state.setdefault(folder_id, {})
+                for key in ("displayName", "parentFolderId", "totalItemCount"):
+                    if key in item:
+                        folder[key] = item[key]
+            delta_link = data.get("@odata.deltaLink")
+            url = data.get("@odata.nextLink")
+
+        if delta_link:
+            break
+        if state is None:
+            logging.warning(
+                "Nie udało się pobrać zmian folderów dla %s. Używam pełnej listy folderów.",
+                mailbox_email,
+            )
+            return None
+        logging.warning(
+            "Token delta folderów dla %s jest nieaktualny. Pobieram drzewo od nowa.",
+            mailbox_email,
+        )
+        state = None
+
+    # Delta folderów zgłasza tylko zmianę `totalItemCount`, więc folder, do
+    # którego przybyło i z którego ubyło tyle samo wiadomości, wyglądałby na
+    # niezmieniony. O użyciu pamięci podręcznej decyduje dlatego zapytanie
+    # `messages/delta` od tokenu zapisanego w poprzednim przebiegu. Folder bez
+    # tokenu jest pobierany w całości, a pełne wyliczenie `messages/delta`
+    # (jedno żądanie na 1000 wiadomości) wykonywane jest tylko dla folderów,
+    # które mogą zostać użyte z pamięci podręcznej w następnym przebiegu:
+    # zapisanych w niej i bez zmiany w drzewie folderów.
+    cached_folders = set((state or {}).get("cached_folders") or [])
+    message_headers = {
+        "Authorization": f"Bearer {token}",
+        "Prefer": f"odata.maxpagesize={MESSAGE_PAGE_SIZE_LIMIT}",
+    }
+    unchanged = set()
+
+    async def sync_messages(folder_id):
+        folder = folders_state[folder_id]
+        stored_link = folder.pop("messagesDeltaLink", None)
+        if stored_link:
+            result = await sync_folder_messages_delta(
+                session, message_headers, stored_link, throttler, pbar
+            )
+            if result is not None:
+                folder["messagesDeltaLink"], message_changes = result
+                if not message_changes and folder_id in cached_folders:
+                    unchanged.add(folder_id)
+                return
+        if folder_id not in cached_folders or folder_id in changed:
+            return
+        result = await sync_folder_messages_delta(
+            session,
+            message_headers,
+            build_folder_messages_delta_url(mailbox_email, folder_id),
+            throttler,
+            pbar,
+        )
+        if result is not None:
+            folder["messagesDeltaLink"] = result[0]
+
+    folder_ids = list(folders_state)
+    for index in range(0, len(folder_ids), FOLDER_BATCH_SIZE):
+        await asyncio.gather(
+            *(sync_messages(folder_id) for folder_id in folder_ids[index : index + FOLDER_BATCH_SIZE])
+        )
+
+    folders = build_folder_list(folders_state)
+    logging.info(
+        "Drzewo folderów %s: %s folderów, %s zmienionych, %s bez zmian w pamięci podręcznej.",
+        mailbox_email,
+        len(folders),
+        len(changed),
+        len(unchanged),
+    )
+    return folders, delta_link, folders_state, unchanged
+
+
+def build_folder_messages_request(token, mailbox_email, folder_id):
+    """Zwraca adres pierwszej strony wiadomości folderu i nagłówki żądania."""
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Prefer": 'outlook.body-content-type="html"',
+    }
+    base_url = (
+        "https://graph.microsoft.com/v1.0/users/"
+        f"{mailbox_email}/mailFolders/{folder_id}/messages"
+    )
+    attachments_expand = "attachments($select=size,isInline)"
+    extended_filter = quote("id eq 'Integer 0x0E08' or id eq 'Long 0x0E08'", safe="")
+
+    select_parts = [
+        "subject",
+        "receivedDateTime",
+        "hasAttachments",
+        "id",
+        "from",
+        "body",
+        "bodyPreview",
+        "internetMessageHeaders",
+        "singleValueExtendedProperties",
+        "toRecipients",
         "ccRecipients",
         "bccRecipients",
     ]
@@ -786,72 +2446,452 @@ async def get_messages_from_folder(session, token, mailbox_email, folder_id, pba
         ]
     )
 
-    url = f"{base_url}?$select={select_clause}&$expand={expand_clause}&$top=100"
-    messages = []
+    url = (
+        f"{base_url}?$select={select_clause}&$expand={expand_clause}"
+        f"&$top={MESSAGE_PAGE_SIZE}"
+    )
+    return url, headers
+
+
+async def stream_folder_pages(
+    session,
+    token,
+    mailbox_email,
+    folder_meta,
+    pipeline,
+    pbar,
+    throttler,
+    retries=3,
+    dead_letters=None,
+    start_url=None,
+):
+    """Pobiera kolejne strony folderu i przekazuje je do potoku skrzynki.
+
+    Gdy potok jest zapełniony, `put_page` czeka, więc pobieranie zwalnia
+    razem z najwolniejszym etapem. Strona, której nie udało się pobrać,
+    trafia do kolejki ponowień razem z adresem, od którego należy wznowić.
+    """
+    folder_id = folder_meta["id"]
+    folder_path = folder_meta["path"]
+    context_token = LOG_FOLDER.set(folder_path)
+    try:
+        await _stream_folder_pages(
+            session,
+            token,
+            mailbox_email,
+            folder_meta,
+            pipeline,
+            pbar,
+            throttler,
+            retries,
+            dead_letters,
+            start_url,
+        )
+    finally:
+        LOG_FOLDER.reset(context_token)
+
+
+async def _stream_folder_pages(
+    session,
+    token,
+    mailbox_email,
+    folder_meta,
+    pipeline,
+    pbar,
+    throttler,
+    retries,
+    dead_letters,
+    start_url,
+):
+    folder_id = folder_meta["id"]
+    folder_path = folder_meta["path"]
+    url, headers = build_folder_messages_request(token, mailbox_email, folder_id)
+    url = start_url or url
+    page_sizer = AdaptivePageSizer() if ADAPTIVE_PAGE_SIZE else None
+    loop = asyncio.get_running_loop()
 
     while url:
-        data = await fetch(session, url, headers, throttler, retries, pbar)
-        if not data:
+        started = loop.time()
+        try:
+            page = await profiled(
+                "fetch",
+                fetch(
+                    session,
+                    url,
+                    headers,
+                    throttler,
+                    retries,
+                    pbar,
+                    raw=pipeline.raw_pages,
+                    page_sizer=page_sizer,
+                ),
+            )
+        except Exception as error:
+            logging.warning(
+                "Błąd pobierania folderu %s (%s): %s",
+                folder_path,
+                folder_id,
+                summarize_text(error) or error.__class__.__name__,
+            )
+            page = None
+        if not page:
             logging.error(
                 "Brak danych wiadomości dla folderu %s w skrzynce %s.",
                 folder_id,
                 mailbox_email,
             )
+            if dead_letters is not None:
+                dead_letters.add(mailbox_email, folder_id, folder_path, url)
             break
+        RUN_STATS.pipeline.record_stage("fetch", loop.time() - started)
 
-        page_messages = data.get("value", [])
-        for msg in page_messages:
-            attachments = msg.get("attachments", []) or []
-            regular_attachment_size = 0
-            inline_attachment_size = 0
+        page_url = url
+        if pipeline.raw_pages:
+            url = extract_next_link(page)
+        else:
+            url = page.get("@odata.nextLink")
+        await pipeline.put_page(folder_meta, page, page_url)
 
-            for att in attachments:
-                att_size = safe_int(att.get("size"))
-                if not att_size:
-                    continue
-                if att.get("isInline"):
-                    inline_attachment_size += att_size
-                else:
-                    regular_attachment_size += att_size
+    if page_sizer is not None and page_sizer.pages:
+        RUN_STATS.record_page_sizes(mailbox_email, folder_path, page_sizer)
 
-            msg["attachment_size"] = regular_attachment_size
 
-            estimated_body = estimate_message_body_bytes(msg)
-            extended_total = extract_extended_message_size(msg)
-            baseline_body = estimated_body + inline_attachment_size
-            baseline_total = regular_attachment_size + baseline_body
+async def stream_cached_folders(folder_cache, folders, folder_ids, pipeline):
+    """Przekazuje do potoku wiadomości folderów zapisane w pamięci podręcznej.
 
-            if extended_total > 0:
-                total_size = max(extended_total, baseline_total)
-                body_size = max(total_size - regular_attachment_size, baseline_body)
-            else:
-                body_size = baseline_body
-                total_size = baseline_total
-
-            msg["body_size"] = body_size
-            msg["total_size"] = total_size
-
-            msg.pop("attachments", None)
-            msg.pop("singleValueExtendedProperties", None)
-            msg.pop("internetMessageHeaders", None)
-            msg.pop("body", None)
-            msg.pop("bodyPreview", None)
-            msg.pop("toRecipients", None)
-            msg.pop("ccRecipients", None)
-            msg.pop("bccRecipients", None)
-
-        messages.extend(page_messages)
-        pbar.update(len(page_messages))
-        url = data.get("@odata.nextLink")
+    Zwraca foldery, których nie udało się odczytać i które trzeba pobrać z
+    Graph. Folder, z którego część wiadomości trafiła już do potoku, jest
+    zgłaszany jako niekompletny.
+    """
+    loop = asyncio.get_running_loop()
+    folders_by_id = {folder_meta["id"]: folder_meta for folder_meta in folders}
+    streamed = set()
+    chunks = folder_cache.iter_messages(folder_ids)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            folder_id, messages = chunk
+            streamed.add(folder_id)
+            await pipeline.put_records(folders_by_id[folder_id], messages)
+    except (OSError, EOFError, json.JSONDecodeError, KeyError) as error:
+        logging.warning(
+            "Nie można odczytać wiadomości z pamięci podręcznej %s: %s",
+            folder_cache.messages_path,
+            summarize_text(error),
+        )
+        for folder_id in streamed:
+            pipeline.mark_incomplete(
+                folders_by_id[folder_id], f"pamięć podręczna: {folder_cache.messages_path}"
+            )
+        return [
+            folders_by_id[folder_id]
+            for folder_id in folder_ids
+            if folder_id not in streamed and folder_id in folders_by_id
+        ]
+    return []
+
+
+async def retry_dead_letters(
+    session,
+    token,
+    mailbox_email,
+    dead_letters,
+    pipeline,
+    pbar,
+    throttler,
+):
+    entries = dead_letters.drain()
+    if not entries:
+        return []
+
+    await throttler.wait_for_cooldown()
+    logging.info(
+        "Ponawianie %s nieudanych stron dla skrzynki %s (limit prób: %s).",
+        len(entries),
+        mailbox_email,
+        DEAD_LETTER_RETRIES,
+    )
+
+    still_failed = DeadLetterQueue()
+    for entry in entries:
+        await stream_folder_pages(
+            session,
+            token,
+            mailbox_email,
+            {"id": entry["folder_id"], "path": entry["folder_path"]},
+            pipeline,
+            pbar,
+            throttler,
+            retries=DEAD_LETTER_RETRIES,
+            dead_letters=still_failed,
+            start_url=entry["url"],
+        )
+
+    incomplete = still_failed.drain()
+    for entry in incomplete:
+        logging.error(
+            "Folder %s w skrzynce %s jest niekompletny. Nie pobrano strony: %s",
+            entry["folder_path"],
+            mailbox_email,
+            entry["url"],
+        )
+    return incomplete
+
+def _shift_month(month_start, months):
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return month_start.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
+async def count_folder_messages_by_month(session, token, mailbox_email, folder_meta, throttler, pbar=None):
+    """Zlicza wiadomości folderu w kolejnych miesiącach zapytaniami `$count`.
+
+    Miesiące sprawdzane są od bieżącego wstecz, aż suma zliczeń osiągnie
+    `totalItemCount` folderu, więc liczba żądań nie zależy od jego rozmiaru.
+    Zwraca słownik miesiąc -> liczba oraz listę adresów, których nie pobrano.
+    """
+    total = safe_int(folder_meta.get("totalItemCount", 0))
+    counts = {}
+    failed_urls = []
+    if total <= 0:
+        return counts, failed_urls
+
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "ConsistencyLevel": "eventual",
+    }
+    base_url = (
+        "https://graph.microsoft.com/v1.0/users/"
+        f"{mailbox_email}/mailFolders/{folder_meta['id']}/messages"
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    next_month_start = _shift_month(
+        datetime.datetime(now.year, now.month, 1, tzinfo=datetime.timezone.utc), 1
+    )
+
+    counted = 0
+    months_checked = 0
+    batch_size = max(SEMAPHORE_LIMIT, 1)
+    while counted < total and months_checked < COUNT_MAX_MONTHS:
+        batch = []
+        for _ in range(min(batch_size, COUNT_MAX_MONTHS - months_checked)):
+            month_end = _shift_month(next_month_start, -months_checked)
+            month_start = _shift_month(month_end, -1)
+            months_checked += 1
+            month_filter = quote(
+                f"receivedDateTime ge {month_start:%Y-%m-%dT%H:%M:%SZ} "
+                f"and receivedDateTime lt {month_end:%Y-%m-%dT%H:%M:%SZ}",
+                safe="",
+            )
+            url = f"{base_url}?$filter={month_filter}&$count=true&$top=1&$select=id"
+            batch.append((month_start.strftime("%Y-%m"), url))
+
+        results = await asyncio.gather(
+            *(fetch(session, url, headers, throttler, pbar=pbar) for _, url in batch)
+        )
+        for (month_key, url), data in zip(batch, results):
+            if not data or "@odata.count" not in data:
+                failed_urls.append(url)
+                continue
+            month_count = safe_int(data["@odata.count"])
+            if month_count:
+                counts[month_key] = month_count
+                counted += month_count
+
+    if counted < total and not failed_urls:
+        counts["Nieznany"] = total - counted
+    return counts, failed_urls
+
+
+def export_counts_to_excel(summary, mailbox_email, incomplete_folders=None):
+    wb = openpyxl.Workbook()
+    summary_sheet = wb.active
+    summary_sheet.title = "Podsumowanie"
+    summary_sheet.append(["Mailbox", "Folder", "Month", "Message Count"])
+    for (folder_path, month_key), values in sorted(summary.items()):
+        summary_sheet.append(
+            [mailbox_email, folder_path, month_key, values["message_count"]]
+        )
+
+    if incomplete_folders:
+        incomplete_sheet = wb.create_sheet(title="Niekompletne")
+        incomplete_sheet.append(["Mailbox", "Folder", "Folder ID", "Missing Page URL"])
+        for entry in incomplete_folders:
+            incomplete_sheet.append([
+                mailbox_email,
+                entry["folder_path"],
+                entry["folder_id"],
+                entry["url"],
+            ])
+
+    safe_mailbox = mailbox_email.replace("@", "_at_").replace(".", "_")
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"{safe_mailbox}_counts_{timestamp}.xlsx"
+    wb.save(filename)
+    logging.info(f"Dane zapisano do pliku: {filename}")
+
+
+async def process_mailbox_counts(session, mailbox, token, throttler):
+    incomplete = []
+    try:
+        logging.info(f"Zliczanie wiadomości w skrzynce: {mailbox}")
+        with open_mailbox_progress(mailbox) as pbar:
+            folders = await profiled(
+                "folders", get_all_folders(session, token, mailbox, throttler, pbar)
+            )
+            pbar.total = sum(f.get("totalItemCount", 0) for f in folders)
+
+            summary = defaultdict(
+                lambda: {
+                    "message_count": 0,
+                    "body_size": 0,
+                    "attachment_size": 0,
+                    "total_size": 0,
+                }
+            )
+            for index in range(0, len(folders), FOLDER_BATCH_SIZE):
+                current_batch = folders[index : index + FOLDER_BATCH_SIZE]
+                results = await asyncio.gather(
+                    *(
+                        count_folder_messages_by_month(
+                            session, token, mailbox, folder_meta, throttler, pbar
+                        )
+                        for folder_meta in current_batch
+                    )
+                )
+                for folder_meta, (counts, failed_urls) in zip(current_batch, results):
+                    for month_key, month_count in counts.items():
+                        summary[(folder_meta["path"], month_key)]["message_count"] += month_count
+                    for url in failed_urls:
+                        incomplete.append(
+                            {
+                                "mailbox": mailbox,
+                                "folder_id": folder_meta["id"],
+                                "folder_path": folder_meta["path"],
+                                "url": url,
+                            }
+                        )
+                    pbar.update(safe_int(folder_meta.get("totalItemCount", 0)))
+
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                None, export_counts_to_excel, summary, mailbox, incomplete
+            )
+    except Exception:
+        logging.exception("Błąd zliczania wiadomości w skrzynce %s", mailbox)
+    return incomplete
 
-    return messages
 
 def sanitize_sheet_name(name: str) -> str:
     cleaned = re.sub(r'[\\/:\?\*\[\]]+', '_', name)
     return cleaned[:31] or "Folder"
 
-def build_monthly_summary(mailbox_data):
-    summary = defaultdict(
+def message_month_key(received_dt):
+    if not received_dt:
+        return "Nieznany"
+    try:
+        dt_obj = datetime.datetime.fromisoformat(received_dt.replace("Z", ""))
+    except ValueError:
+        return received_dt[:7]
+    return dt_obj.strftime("%Y-%m")
+
+
+class MessageStore:
+    """Indeksowana baza SQLite z rozmiarami pobranych wiadomości.
+
+    Zapisy wykonywane są w jednym wątku roboczym, aby nie blokować pętli
+    zdarzeń. Pierwsza paczka folderu w przebiegu zastępuje jego wcześniejsze
+    wiersze, kolejne są dopisywane.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="message-store"
+        )
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                mailbox TEXT NOT NULL,
+                folder_path TEXT NOT NULL,
+                message_id TEXT,
+                received TEXT,
+                month TEXT NOT NULL,
+                sender TEXT,
+                subject TEXT,
+                body_size INTEGER NOT NULL,
+                attachment_size INTEGER NOT NULL,
+                total_size INTEGER NOT NULL,
+                fetched_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_folder
+                ON messages (mailbox, folder_path, month);
+            CREATE INDEX IF NOT EXISTS idx_messages_month ON messages (mailbox, month);
+            CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender);
+            """
+        )
+
+    def _write_messages(self, mailbox_email, folder_path, messages, replace):
+        fetched_at = datetime.datetime.now().isoformat(timespec="seconds")
+        rows = []
+        for msg in messages:
+            body_bytes = safe_int(msg.get("body_size", 0))
+            attachment_bytes = safe_int(msg.get("attachment_size", 0))
+            received_dt = msg.get("receivedDateTime")
+            rows.append(
+                (
+                    mailbox_email,
+                    folder_path,
+                    msg.get("id"),
+                    received_dt,
+                    message_month_key(received_dt),
+                    (msg.get("from") or {}).get("emailAddress", {}).get("address", ""),
+                    msg.get("subject"),
+                    body_bytes,
+                    attachment_bytes,
+                    safe_int(msg.get("total_size", body_bytes + attachment_bytes)),
+                    fetched_at,
+                )
+            )
+        with self._connection:
+            if replace:
+                self._connection.execute(
+                    "DELETE FROM messages WHERE mailbox = ? AND folder_path = ?",
+                    (mailbox_email, folder_path),
+                )
+            self._connection.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    async def write_messages(self, mailbox_email, folder_path, messages, replace=False):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self._executor,
+                self._write_messages,
+                mailbox_email,
+                folder_path,
+                messages,
+                replace,
+            )
+        except sqlite3.Error as error:
+            logging.warning(
+                "Nie można zapisać folderu %s skrzynki %s w bazie %s: %s",
+                folder_path,
+                mailbox_email,
+                self.path,
+                summarize_text(error),
+            )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._connection.close()
+
+
+def new_monthly_summary():
+    return defaultdict(
         lambda: {
             "message_count": 0,
             "body_size": 0,
@@ -859,41 +2899,317 @@ def build_monthly_summary(mailbox_data):
             "total_size": 0,
         }
     )
-    for folder_path, messages in mailbox_data.items():
+
+
+def add_message_to_summary(summary, folder_path, msg):
+    body_bytes = safe_int(msg.get("body_size", 0))
+    attachment_bytes = safe_int(msg.get("attachment_size", 0))
+    total_bytes = safe_int(msg.get("total_size", body_bytes + attachment_bytes))
+    values = summary[(folder_path, message_month_key(msg.get("receivedDateTime")))]
+    values["message_count"] += 1
+    values["body_size"] += body_bytes
+    values["attachment_size"] += attachment_bytes
+    values["total_size"] += total_bytes
+
+
+MESSAGE_SHEET_HEADER = [
+    "Subject",
+    "Sender",
+    "Message Size (bytes)",
+    "Message Size (KB)",
+    "Message Size (MB)",
+    "Attachment Size (bytes)",
+    "Attachment Size (KB)",
+    "Attachment Size (MB)",
+    "Total Size (bytes)",
+    "Total Size (KB)",
+    "Total Size (MB)",
+    "Has Attachments",
+    "Received Date",
+    "Received Time",
+    "Month"
+]
+
+SUMMARY_SHEET_HEADER = [
+    "Mailbox",
+    "Folder",
+    "Month",
+    "Message Count",
+    "Total Size (KB)",
+    "Message Size (KB)",
+    "Attachment Size (KB)",
+    "Total Size (MB)",
+    "Message Size (MB)",
+    "Attachment Size (MB)"
+]
+
+
+def build_message_row(msg):
+    subject = msg.get("subject")
+    sender = msg.get("from", {}).get("emailAddress", {}).get("address", "")
+
+    body_bytes = safe_int(msg.get("body_size", 0))
+    body_kb = round(body_bytes / 1024, 2)
+    body_mb = round(body_bytes / (1024 * 1024), 2)
+
+    attach_bytes = safe_int(msg.get("attachment_size", 0))
+    attach_kb = round(attach_bytes / 1024, 2)
+    attach_mb = round(attach_bytes / (1024 * 1024), 2)
+
+    total_bytes = safe_int(msg.get("total_size", body_bytes + attach_bytes))
+    total_kb = round(total_bytes / 1024, 2)
+    total_mb = round(total_bytes / (1024 * 1024), 2)
+
+    has_attachments = "Yes" if attach_bytes > 0 else "No"
+
+    received_dt = msg.get("receivedDateTime")
+    month_label = ""
+    if received_dt:
+        try:
+            dt_str = received_dt.replace("Z", "")
+            dt_obj = datetime.datetime.fromisoformat(dt_str)
+            received_date = dt_obj.date().strftime("%Y-%m-%d")
+            received_time = dt_obj.time().strftime("%H:%M:%S")
+            month_label = dt_obj.strftime("%Y-%m")
+        except ValueError:
+            received_date = received_dt
+            received_time = ""
+            month_label = received_dt[:7]
+    else:
+        received_date = ""
+        received_time = ""
+        month_label = "Nieznany"
+
+    return [
+        subject,
+        sender,
+        body_bytes,
+        body_kb,
+        body_mb,
+        attach_bytes,
+        attach_kb,
+        attach_mb,
+        total_bytes,
+        total_kb,
+        total_mb,
+        has_attachments,
+        received_date,
+        received_time,
+        month_label
+    ]
+
+
+SIZE_BUCKET_EDGES = (
+    10 * 1024,
+    50 * 1024,
+    100 * 1024,
+    500 * 1024,
+    1024 * 1024,
+    5 * 1024 * 1024,
+    10 * 1024 * 1024,
+    25 * 1024 * 1024,
+)
+SIZE_BUCKET_LABELS = (
+    "< 10 KB",
+    "10-50 KB",
+    "50-100 KB",
+    "100-500 KB",
+    "500 KB-1 MB",
+    "1-5 MB",
+    "5-10 MB",
+    "10-25 MB",
+    ">= 25 MB",
+)
+SIZE_PERCENTILES = (50, 90, 95, 99)
+ALL_MONTHS_LABEL = "Wszystkie"
+
+SIZE_HISTOGRAM_SHEET_HEADER = [
+    "Mailbox",
+    "Month",
+    "Size Bucket",
+    "Message Count",
+    "Total Size (MB)",
+    "Share of Messages (%)",
+]
+
+SIZE_PERCENTILE_SHEET_HEADER = (
+    ["Mailbox", "Month", "Message Count"]
+    + [f"P{percentile} (KB)" for percentile in SIZE_PERCENTILES]
+    + ["Max (KB)"]
+)
+
+TOP_SENDERS_SHEET_HEADER = [
+    "Mailbox",
+    "Rank",
+    "Sender",
+    "Message Count",
+    "Total Size (MB)",
+    "Share of Size (%)",
+]
+
+
+class MailboxAnalytics:
+    """Kolumnowe dane wiadomości skrzynki do analiz rozkładu rozmiarów.
+
+    Dla każdej wiadomości zapisywany jest tylko rozmiar oraz numery miesiąca
+    i nadawcy w zwartych tablicach `array`, więc nawet miliony wiadomości
+    zajmują kilkanaście bajtów każda. Histogramy, percentyle i ranking
+    nadawców są liczone raz, przy zapisie skoroszytu, grupowanymi
+    operacjami NumPy.
+    """
+
+    def __init__(self):
+        self.sizes = array("q")
+        self.months = array("i")
+        self.senders = array("i")
+        self._month_ids = {}
+        self._sender_ids = {}
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add_messages(self, messages):
+        month_ids = self._month_ids
+        sender_ids = self._sender_ids
+        append_size = self.sizes.append
+        append_month = self.months.append
+        append_sender = self.senders.append
         for msg in messages:
             body_bytes = safe_int(msg.get("body_size", 0))
             attachment_bytes = safe_int(msg.get("attachment_size", 0))
-            total_bytes = safe_int(
-                msg.get("total_size", body_bytes + attachment_bytes)
+            append_size(safe_int(msg.get("total_size", body_bytes + attachment_bytes)))
+
+            month_key = message_month_key(msg.get("receivedDateTime"))
+            month_id = month_ids.get(month_key)
+            if month_id is None:
+                month_id = month_ids[month_key] = len(month_ids)
+            append_month(month_id)
+
+            sender = (msg.get("from") or {}).get("emailAddress", {}).get("address") or ""
+            sender = sender.lower()
+            sender_id = sender_ids.get(sender)
+            if sender_id is None:
+                sender_id = sender_ids[sender] = len(sender_ids)
+            append_sender(sender_id)
+
+    def _columns(self):
+        sizes = np.frombuffer(self.sizes, dtype=np.int64)
+        months = np.frombuffer(self.months, dtype=np.intc)
+        senders = np.frombuffer(self.senders, dtype=np.intc)
+        return sizes, months, senders
+
+    def _month_order(self, months):
+        """Zwraca etykiety miesięcy w kolejności rosnącej i numer pozycji
+        każdej wiadomości w tej kolejności."""
+        labels = list(self._month_ids)
+        order = sorted(range(len(labels)), key=labels.__getitem__)
+        ranks = np.empty(len(labels), dtype=np.intp)
+        ranks[order] = np.arange(len(labels))
+        return [labels[index] for index in order], ranks[months]
+
+    def size_histogram(self):
+        """Liczba i suma rozmiarów wiadomości w przedziałach `SIZE_BUCKET_EDGES`
+        dla każdego miesiąca oraz dla całej skrzynki."""
+        sizes, months, _ = self._columns()
+        month_labels, month_ranks = self._month_order(months)
+        bucket_count = len(SIZE_BUCKET_LABELS)
+        buckets = np.searchsorted(np.asarray(SIZE_BUCKET_EDGES), sizes, side="right")
+        keys = month_ranks * bucket_count + buckets
+        length = len(month_labels) * bucket_count
+        counts = np.bincount(keys, minlength=length).reshape(-1, bucket_count)
+        totals = np.bincount(keys, weights=sizes, minlength=length).reshape(-1, bucket_count)
+        rows = []
+        labelled = list(zip(month_labels, counts, totals))
+        labelled.append((ALL_MONTHS_LABEL, counts.sum(axis=0), totals.sum(axis=0)))
+        for month_label, month_counts, month_totals in labelled:
+            month_total = int(month_counts.sum())
+            for bucket in np.flatnonzero(month_counts):
+                rows.append(
+                    (
+                        month_label,
+                        SIZE_BUCKET_LABELS[bucket],
+                        int(month_counts[bucket]),
+                        int(month_totals[bucket]),
+                        int(month_counts[bucket]) / month_total,
+                    )
+                )
+        return rows
+
+    def size_percentiles(self):
+        """Percentyle `SIZE_PERCENTILES` i maksimum rozmiaru w każdym miesiącu
+        oraz dla całej skrzynki (interpolacja liniowa, jak `numpy.percentile`)."""
+        sizes, months, _ = self._columns()
+        if not len(sizes):
+            return []
+        month_labels, month_ranks = self._month_order(months)
+        order = np.lexsort((sizes, month_ranks))
+        sorted_sizes = sizes[order].astype(np.float64)
+        counts = np.bincount(month_ranks, minlength=len(month_labels))
+        present = np.flatnonzero(counts)
+        counts = counts[present]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        quantiles = np.asarray(SIZE_PERCENTILES + (100,), dtype=np.float64) / 100.0
+        positions = starts[:, None] + quantiles[None, :] * (counts[:, None] - 1)
+        lower = np.floor(positions).astype(np.intp)
+        upper = np.ceil(positions).astype(np.intp)
+        values = sorted_sizes[lower] + (sorted_sizes[upper] - sorted_sizes[lower]) * (
+            positions - lower
+        )
+        rows = [
+            (month_labels[rank], int(count), values[index].tolist())
+            for index, (rank, count) in enumerate(zip(present, counts))
+        ]
+        overall = np.percentile(sizes, quantiles * 100.0)
+        rows.append((ALL_MONTHS_LABEL, len(sizes), overall.tolist()))
+        return rows
+
+    def top_senders(self, limit):
+        """Nadawcy o największej łącznej objętości wiadomości."""
+        sizes, _, senders = self._columns()
+        if not len(sizes):
+            return []
+        sender_labels = list(self._sender_ids)
+        totals = np.bincount(senders, weights=sizes, minlength=len(sender_labels))
+        counts = np.bincount(senders, minlength=len(sender_labels))
+        top = np.argsort(-totals, kind="stable")[:limit]
+        grand_total = float(totals.sum()) or 1.0
+        return [
+            (
+                sender_labels[sender_id] or "(brak nadawcy)",
+                int(counts[sender_id]),
+                int(totals[sender_id]),
+                float(totals[sender_id]) / grand_total,
             )
-            received_dt = msg.get("receivedDateTime")
-            month_key = "Nieznany"
-            if received_dt:
-                try:
-                    dt_str = received_dt.replace("Z", "")
-                    dt_obj = datetime.datetime.fromisoformat(dt_str)
-                    month_key = dt_obj.strftime("%Y-%m")
-                except ValueError:
-                    month_key = received_dt[:7]
-
-            summary[(folder_path, month_key)]["message_count"] += 1
-            summary[(folder_path, month_key)]["body_size"] += body_bytes
-            summary[(folder_path, month_key)]["attachment_size"] += attachment_bytes
-            summary[(folder_path, month_key)]["total_size"] += total_bytes
-
-    return summary
-
-def export_to_excel(data, mailbox_email):
-    wb = openpyxl.Workbook()
-    if "Sheet" in wb.sheetnames:
-        default_sheet = wb["Sheet"]
-        wb.remove(default_sheet)
+            for sender_id in top
+        ]
 
-    used_sheet_names = set(wb.sheetnames)
-    sheet_name_counters = {}
 
-    def get_unique_sheet_name(base_name: str) -> str:
-        index = sheet_name_counters.get(base_name, 1)
+class MailboxWorkbook:
+    """Skoroszyt jednej skrzynki zapisywany strumieniowo (tryb write-only).
+
+    Każdy otwarty arkusz write-only trzyma własny plik tymczasowy, więc
+    wiersze folderów nie trafiają od razu do arkuszy. Są dopisywane paczkami
+    do jednego pliku pośredniego skrzynki, a przy zapisie arkusze folderów
+    powstają po kolei i każdy jest zamykany przed utworzeniem następnego.
+    Skoroszyt zajmuje więc stałą liczbę deskryptorów plików niezależnie od
+    liczby folderów, a w pamięci nie są trzymane całe foldery.
+    """
+
+    SPOOL_CHUNK_ROWS = 500
+
+    def __init__(self, mailbox_email, folder_paths=()):
+        self.mailbox_email = mailbox_email
+        self._workbook = openpyxl.Workbook(write_only=True)
+        self._used_sheet_names = set()
+        self._sheet_name_counters = {}
+        self._spool = tempfile.TemporaryFile(prefix="email_trend_")
+        self._spool_size = 0
+        self._folder_chunks = {folder_path: [] for folder_path in folder_paths}
+        self._pending_folder = None
+        self._pending_rows = []
+
+    def _unique_sheet_name(self, base_name: str) -> str:
+        index = self._sheet_name_counters.get(base_name, 1)
         while True:
             if index == 1:
                 candidate = base_name
@@ -902,209 +3218,2114 @@ def export_to_excel(data, mailbox_email):
                 allowed_length = max(31 - len(suffix), 0)
                 candidate = f"{base_name[:allowed_length]}{suffix}"
             candidate = candidate[:31] or "Folder"
-            if candidate not in used_sheet_names:
-                used_sheet_names.add(candidate)
-                sheet_name_counters[base_name] = index + 1
+            if candidate not in self._used_sheet_names:
+                self._used_sheet_names.add(candidate)
+                self._sheet_name_counters[base_name] = index + 1
                 return candidate
             index += 1
 
-    for folder_path, messages in data.items():
-        base_name = sanitize_sheet_name(folder_path)
-        sheet_name = get_unique_sheet_name(base_name)
+    def _flush_pending(self):
+        if not self._pending_rows:
+            return
+        data = marshal.dumps(self._pending_rows)
+        self._spool.write(data)
+        self._folder_chunks.setdefault(self._pending_folder, []).append(
+            (self._spool_size, len(data))
+        )
+        self._spool_size += len(data)
+        self._pending_rows = []
+
+    def append_messages(self, folder_path, messages):
+        if folder_path != self._pending_folder:
+            self._flush_pending()
+            self._pending_folder = folder_path
+            self._folder_chunks.setdefault(folder_path, [])
+        self._pending_rows.extend(build_message_row(msg) for msg in messages)
+        if len(self._pending_rows) >= self.SPOOL_CHUNK_ROWS:
+            self._flush_pending()
+
+    def _write_folder_sheets(self):
+        self._flush_pending()
+        for folder_path, chunks in self._folder_chunks.items():
+            sheet = self._workbook.create_sheet(
+                title=self._unique_sheet_name(sanitize_sheet_name(folder_path))
+            )
+            sheet.append(MESSAGE_SHEET_HEADER)
+            for offset, length in chunks:
+                self._spool.seek(offset)
+                for row in marshal.loads(self._spool.read(length)):
+                    sheet.append(row)
+            sheet.close()
 
-        ws = wb.create_sheet(title=sheet_name)
-        ws.append([
-            "Subject",
-            "Sender",
-            "Message Size (bytes)",
-            "Message Size (KB)",
-            "Message Size (MB)",
-            "Attachment Size (bytes)",
-            "Attachment Size (KB)",
-            "Attachment Size (MB)",
-            "Total Size (bytes)",
-            "Total Size (KB)",
-            "Total Size (MB)",
-            "Has Attachments",
-            "Received Date",
-            "Received Time",
-            "Month"
-        ])
+    def close(self):
+        self._spool.close()
 
-        for msg in messages:
-            subject = msg.get("subject")
-            sender = msg.get("from", {}).get("emailAddress", {}).get("address", "")
+    def save(self, summary_data, incomplete_folders=None, analytics=None):
+        try:
+            return self._save(summary_data, incomplete_folders, analytics)
+        finally:
+            self.close()
 
-            body_bytes = safe_int(msg.get("body_size", 0))
-            body_kb = round(body_bytes / 1024, 2)
-            body_mb = round(body_bytes / (1024 * 1024), 2)
+    def _save(self, summary_data, incomplete_folders, analytics):
+        self._write_folder_sheets()
+        summary_sheet = self._workbook.create_sheet(
+            title=self._unique_sheet_name("Podsumowanie")
+        )
+        summary_sheet.append(SUMMARY_SHEET_HEADER)
+        for (folder_path, month_key), values in sorted(summary_data.items(), key=lambda x: (x[0][0], x[0][1])):
+            total_size_bytes = safe_int(values.get("total_size", 0))
+            body_size_bytes = safe_int(values.get("body_size", 0))
+            attachment_size_bytes = safe_int(values.get("attachment_size", 0))
+            summary_sheet.append([
+                self.mailbox_email,
+                folder_path,
+                month_key,
+                values["message_count"],
+                round(total_size_bytes / 1024, 2),
+                round(body_size_bytes / 1024, 2),
+                round(attachment_size_bytes / 1024, 2),
+                round(total_size_bytes / (1024 * 1024), 2),
+                round(body_size_bytes / (1024 * 1024), 2),
+                round(attachment_size_bytes / (1024 * 1024), 2)
+            ])
+        summary_sheet.close()
 
-            attach_bytes = safe_int(msg.get("attachment_size", 0))
-            attach_kb = round(attach_bytes / 1024, 2)
-            attach_mb = round(attach_bytes / (1024 * 1024), 2)
+        if incomplete_folders:
+            incomplete_sheet = self._workbook.create_sheet(
+                title=self._unique_sheet_name("Niekompletne")
+            )
+            incomplete_sheet.append(["Mailbox", "Folder", "Folder ID", "Missing Page URL"])
+            for entry in incomplete_folders:
+                incomplete_sheet.append([
+                    self.mailbox_email,
+                    entry["folder_path"],
+                    entry["folder_id"],
+                    entry["url"],
+                ])
+            incomplete_sheet.close()
+
+        if analytics is not None and len(analytics):
+            self._append_analytics(analytics)
+
+        safe_mailbox = self.mailbox_email.replace("@", "_at_").replace(".", "_")
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"{safe_mailbox}_{timestamp}.xlsx"
+        self._workbook.save(filename)
+        logging.info(f"Dane zapisano do pliku: {filename}")
+        return filename
+
+    def _append_analytics(self, analytics):
+        histogram_sheet = self._workbook.create_sheet(
+            title=self._unique_sheet_name("Rozkład rozmiarów")
+        )
+        histogram_sheet.append(SIZE_HISTOGRAM_SHEET_HEADER)
+        for month_label, bucket_label, count, total_bytes, share in analytics.size_histogram():
+            histogram_sheet.append([
+                self.mailbox_email,
+                month_label,
+                bucket_label,
+                count,
+                round(total_bytes / (1024 * 1024), 2),
+                round(share * 100, 2),
+            ])
+        histogram_sheet.close()
 
-            total_bytes = safe_int(msg.get("total_size", body_bytes + attach_bytes))
-            total_kb = round(total_bytes / 1024, 2)
-            total_mb = round(total_bytes / (1024 * 1024), 2)
+        percentile_sheet = self._workbook.create_sheet(
+            title=self._unique_sheet_name("Percentyle rozmiaru")
+        )
+        percentile_sheet.append(SIZE_PERCENTILE_SHEET_HEADER)
+        for month_label, count, values in analytics.size_percentiles():
+            percentile_sheet.append(
+                [self.mailbox_email, month_label, count]
+                + [round(value / 1024, 2) for value in values]
+            )
+        percentile_sheet.close()
 
-            has_attachments = "Yes" if attach_bytes > 0 else "No"
+        senders_sheet = self._workbook.create_sheet(
+            title=self._unique_sheet_name("Najwięksi nadawcy")
+        )
+        senders_sheet.append(TOP_SENDERS_SHEET_HEADER)
+        top_senders = analytics.top_senders(TOP_SENDERS_LIMIT)
+        for rank, (sender, count, total_bytes, share) in enumerate(top_senders, start=1):
+            senders_sheet.append([
+                self.mailbox_email,
+                rank,
+                sender,
+                count,
+                round(total_bytes / (1024 * 1024), 2),
+                round(share * 100, 2),
+            ])
+        senders_sheet.close()
 
-            received_dt = msg.get("receivedDateTime")
-            month_label = ""
-            if received_dt:
-                try:
-                    dt_str = received_dt.replace("Z", "")
-                    dt_obj = datetime.datetime.fromisoformat(dt_str)
-                    received_date = dt_obj.date().strftime("%Y-%m-%d")
-                    received_time = dt_obj.time().strftime("%H:%M:%S")
-                    month_label = dt_obj.strftime("%Y-%m")
-                except ValueError:
-                    received_date = received_dt
-                    received_time = ""
-                    month_label = received_dt[:7]
-            else:
-                received_date = ""
-                received_time = ""
-                month_label = "Nieznany"
 
-            ws.append([
-                subject,
-                sender,
-                body_bytes,
-                body_kb,
-                body_mb,
-                attach_bytes,
-                attach_kb,
-                attach_mb,
-                total_bytes,
-                total_kb,
-                total_mb,
-                has_attachments,
-                received_date,
-                received_time,
-                month_label
-            ])
+class ExcelExportWriter:
+    """Zapisuje skoroszyty w osobnym wątku, aby nie blokować pętli zdarzeń.
 
-    summary_base_name = "Podsumowanie"
-    summary_sheet_name = get_unique_sheet_name(summary_base_name)
-    summary_sheet = wb.create_sheet(title=summary_sheet_name)
-    summary_sheet.append([
-        "Mailbox",
-        "Folder",
-        "Month",
-        "Message Count",
-        "Total Size (KB)",
-        "Message Size (KB)",
-        "Attachment Size (KB)",
-        "Total Size (MB)",
-        "Message Size (MB)",
-        "Attachment Size (MB)"
-    ])
-
-    summary_data = build_monthly_summary(data)
-    for (folder_path, month_key), values in sorted(summary_data.items(), key=lambda x: (x[0][0], x[0][1])):
-        total_size_bytes = safe_int(values.get("total_size", 0))
-        body_size_bytes = safe_int(values.get("body_size", 0))
-        attachment_size_bytes = safe_int(values.get("attachment_size", 0))
-        summary_sheet.append([
-            mailbox_email,
-            folder_path,
-            month_key,
-            values["message_count"],
-            round(total_size_bytes / 1024, 2),
-            round(body_size_bytes / 1024, 2),
-            round(attachment_size_bytes / 1024, 2),
-            round(total_size_bytes / (1024 * 1024), 2),
-            round(body_size_bytes / (1024 * 1024), 2),
-            round(attachment_size_bytes / (1024 * 1024), 2)
-        ])
+    Polecenia `open`, `rows` i `close` trafiają do ograniczonej kolejki; gdy
+    zapis nie nadąża, `submit` czeka na wolne miejsce i w ten sposób
+    spowalnia potoki skrzynek zamiast gromadzić wiersze w pamięci.
+    """
 
-    safe_mailbox = mailbox_email.replace("@", "_at_").replace(".", "_")
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{safe_mailbox}_{timestamp}.xlsx"
-    wb.save(filename)
-    logging.info(f"Dane zapisano do pliku: {filename}")
+    _STOP = object()
+
+    def __init__(self, queue_size):
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._thread = threading.Thread(
+            target=self._run, name="excel-export-writer", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        workbooks = {}
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            action, mailbox_email, payload = item
+            try:
+                if action == "open":
+                    with profile_section("export"):
+                        workbooks[mailbox_email] = MailboxWorkbook(mailbox_email, payload)
+                elif action == "rows":
+                    workbook = workbooks.get(mailbox_email)
+                    if workbook is not None:
+                        with profile_section("export"):
+                            workbook.append_messages(*payload)
+                elif action == "close":
+                    workbook = workbooks.pop(mailbox_email, None)
+                    if workbook is not None:
+                        with profile_section("export"):
+                            workbook.save(*payload)
+                else:
+                    workbook = workbooks.pop(mailbox_email, None)
+                    if workbook is not None:
+                        workbook.close()
+            except Exception:
+                workbook = workbooks.pop(mailbox_email, None)
+                if workbook is not None:
+                    workbook.close()
+                logging.exception(
+                    "Błąd zapisu pliku Excel dla skrzynki %s", mailbox_email
+                )
+
+    async def submit(self, action, mailbox_email, payload=None):
+        if self._queue.full():
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                None, self._queue.put, (action, mailbox_email, payload)
+            )
+        else:
+            self._queue.put_nowait((action, mailbox_email, payload))
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._queue.put, self._STOP)
+        await loop.run_in_executor(None, self._thread.join)
+
+
+class ExcelSink:
+    """Etap zapisu potoku: wiersze skrzynki do skoroszytu Excel."""
+
+    def __init__(self, export_writer, mailbox_email):
+        self._export_writer = export_writer
+        self._mailbox_email = mailbox_email
+
+    async def begin(self, folders):
+        folder_paths = list(dict.fromkeys(folder_meta["path"] for folder_meta in folders))
+        await self._export_writer.submit("open", self._mailbox_email, folder_paths)
+
+    async def write(self, folder_meta, messages):
+        await self._export_writer.submit(
+            "rows", self._mailbox_email, (folder_meta["path"], messages)
+        )
+
+    async def finish(self, summary, incomplete, failed_folders, analytics=None):
+        await self._export_writer.submit(
+            "close", self._mailbox_email, (summary, incomplete, analytics)
+        )
+
+    async def abort(self):
+        await self._export_writer.submit("discard", self._mailbox_email)
+
+
+class MessageStoreSink:
+    """Etap zapisu potoku: wiersze skrzynki do lokalnej bazy wiadomości."""
+
+    def __init__(self, message_store, mailbox_email):
+        self._message_store = message_store
+        self._mailbox_email = mailbox_email
+        self._folders = []
+        self._written = set()
+
+    async def begin(self, folders):
+        self._folders = list(folders)
+
+    async def write(self, folder_meta, messages):
+        folder_path = folder_meta["path"]
+        replace = folder_path not in self._written
+        self._written.add(folder_path)
+        await self._message_store.write_messages(
+            self._mailbox_email, folder_path, messages, replace=replace
+        )
+
+    async def finish(self, summary, incomplete, failed_folders, analytics=None):
+        for folder_meta in self._folders:
+            folder_path = folder_meta["path"]
+            if folder_path in self._written or folder_meta["id"] in failed_folders:
+                continue
+            self._written.add(folder_path)
+            await self._message_store.write_messages(
+                self._mailbox_email, folder_path, [], replace=True
+            )
+
+    async def abort(self):
+        pass
+
+
+class FolderCacheSink:
+    """Etap zapisu potoku: rozmiary wiadomości do pamięci podręcznej folderów.
+
+    Plik tymczasowy jest podmieniany dopiero po zakończeniu skrzynki, więc
+    przerwany przebieg nie uszkadza poprzedniej pamięci podręcznej.
+    """
+
+    def __init__(self, folder_cache, mailbox_email, delta_link, folders_state):
+        self._folder_cache = folder_cache
+        self._mailbox_email = mailbox_email
+        self._delta_link = delta_link
+        self._folders_state = folders_state
+        self._folder_ids = []
+        self._failed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="folder-cache"
+        )
+
+    async def _run(self, function, *args):
+        if self._failed:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, function, *args)
+        except OSError as error:
+            self._failed = True
+            logging.warning(
+                "Nie można zapisać pamięci podręcznej folderów dla %s: %s",
+                self._mailbox_email,
+                summarize_text(error),
+            )
+            await loop.run_in_executor(self._executor, self._folder_cache.abort)
+
+    async def begin(self, folders):
+        self._folder_ids = [folder_meta["id"] for folder_meta in folders]
+        await self._run(self._folder_cache.begin_save)
+
+    async def write(self, folder_meta, messages):
+        await self._run(self._folder_cache.append_messages, folder_meta["id"], messages)
+
+    async def finish(self, summary, incomplete, failed_folders, analytics=None):
+        cached_folder_ids = [
+            folder_id for folder_id in self._folder_ids if folder_id not in failed_folders
+        ]
+        await self._run(
+            self._folder_cache.commit,
+            self._delta_link,
+            self._folders_state,
+            cached_folder_ids,
+        )
+        self._executor.shutdown(wait=False)
+
+    async def abort(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._folder_cache.abort)
+        self._executor.shutdown(wait=False)
+
+
+class MailboxPipeline:
+    """Potok skrzynki: pobieranie → normalizacja → agregacja → zapis.
+
+    Etapy łączą kolejki o stałej pojemności. Gdy któryś etap nie nadąża,
+    `put` w poprzednim etapie czeka, więc spowolnienie dociera aż do
+    pobierania stron, a w pamięci pozostaje co najwyżej kilka stron na
+    kolejkę oraz zagregowane podsumowanie miesięczne.
+    """
+
+    def __init__(
+        self,
+        mailbox_email,
+        sinks,
+        pbar,
+        page_processor=None,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        analytics=False,
+    ):
+        self.mailbox_email = mailbox_email
+        self.summary = new_monthly_summary()
+        self.analytics = MailboxAnalytics() if analytics else None
+        self.failed_folders = set()
+        self.incomplete = []
+        self._sinks = list(sinks)
+        self._pbar = pbar
+        self._page_processor = page_processor
+        self._stats = RUN_STATS.pipeline
+        queue_size = max(1, int(queue_size))
+        self._queues = {
+            stage: asyncio.Queue(maxsize=queue_size) for stage in ("normalize", "aggregate", "output")
+        }
+
+    @property
+    def raw_pages(self):
+        return self._page_processor is not None
+
+    def queue_depths(self):
+        return {stage: stage_queue.qsize() for stage, stage_queue in self._queues.items()}
+
+    async def _put(self, stage, item):
+        stage_queue = self._queues[stage]
+        await stage_queue.put(item)
+        self._stats.record_depth(stage, stage_queue.qsize())
+
+    async def put_page(self, folder_meta, page, page_url=None):
+        await self._put(
+            "normalize", ("raw" if self.raw_pages else "page", folder_meta, page, page_url)
+        )
+
+    async def put_records(self, folder_meta, messages):
+        await self._put("normalize", ("records", folder_meta, messages, None))
+
+    def mark_incomplete(self, folder_meta, url):
+        """Zgłasza brak części wiadomości folderu na karcie `Niekompletne`."""
+        self.failed_folders.add(folder_meta["id"])
+        self.incomplete.append(
+            {
+                "mailbox": self.mailbox_email,
+                "folder_id": folder_meta["id"],
+                "folder_path": folder_meta["path"],
+                "url": url,
+            }
+        )
+
+    def _record_pool_normalize(self, seconds):
+        self._stats.record_stage("normalize", seconds)
+        if PROFILER is not None:
+            PROFILER.record("normalize", seconds)
+
+    async def _normalize(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queues["normalize"].get()
+            if item is None:
+                await self._put("aggregate", None)
+                return
+            kind, folder_meta, payload, page_url = item
+            started = loop.time()
+            if kind == "raw":
+                pending = await self._page_processor.submit(payload)
+                pending.add_done_callback(
+                    lambda _, started=started: self._record_pool_normalize(
+                        loop.time() - started
+                    )
+                )
+            else:
+                pending = loop.create_future()
+                try:
+                    if kind == "page":
+                        with profile_section("normalize"):
+                            payload = process_message_page(payload.get("value", []))
+                        self._stats.record_stage("normalize", loop.time() - started)
+                    pending.set_result(payload)
+                except Exception as error:
+                    pending.set_exception(error)
+            await self._put("aggregate", (folder_meta, pending, page_url))
+
+    async def _aggregate(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queues["aggregate"].get()
+            if item is None:
+                await self._put("output", None)
+                return
+            folder_meta, pending, page_url = item
+            try:
+                messages = await pending
+            except Exception as error:
+                logging.error(
+                    "Nie udało się przetworzyć strony folderu %s w skrzynce %s (%s): %s",
+                    folder_meta["path"],
+                    self.mailbox_email,
+                    page_url,
+                    summarize_text(error) or error.__class__.__name__,
+                )
+                self.mark_incomplete(folder_meta, page_url)
+                continue
+            started = loop.time()
+            folder_path = folder_meta["path"]
+            with profile_section("aggregate"):
+                for msg in messages:
+                    add_message_to_summary(self.summary, folder_path, msg)
+                if self.analytics is not None:
+                    self.analytics.add_messages(messages)
+            self._pbar.update(len(messages))
+            self._stats.record_stage("aggregate", loop.time() - started)
+            await self._put("output", (folder_meta, messages))
+
+    async def _output(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queues["output"].get()
+            if item is None:
+                return
+            folder_meta, messages = item
+            started = loop.time()
+            for sink in list(self._sinks):
+                try:
+                    await sink.write(folder_meta, messages)
+                except Exception:
+                    logging.exception(
+                        "Błąd zapisu danych skrzynki %s. Pomijam dalszy zapis do %s.",
+                        self.mailbox_email,
+                        sink.__class__.__name__,
+                    )
+                    self._sinks.remove(sink)
+            self._stats.record_stage("output", loop.time() - started)
+
+    async def run(self, folders, produce):
+        """Uruchamia etapy potoku i czeka, aż `produce` i wszystkie etapy
+        zakończą pracę."""
+        self._stats.register(self)
+        for sink in self._sinks:
+            await sink.begin(folders)
 
-async def process_mailbox(session, mailbox, token, throttler):
+        async def feed():
+            await produce()
+            await self._put("normalize", None)
+
+        tasks = [
+            asyncio.create_task(feed()),
+            asyncio.create_task(self._normalize()),
+            asyncio.create_task(self._aggregate()),
+            asyncio.create_task(self._output()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for sink in self._sinks:
+                await sink.abort()
+            raise
+        finally:
+            self._stats.unregister(self)
+
+    async def finish(self, incomplete):
+        failed_folders = self.failed_folders | {entry["folder_id"] for entry in incomplete}
+        for sink in self._sinks:
+            await sink.finish(self.summary, incomplete, failed_folders, self.analytics)
+
+
+async def process_mailbox(
+    session,
+    mailbox,
+    token,
+    throttler,
+    page_processor=None,
+    export_writer=None,
+    message_store=None,
+    export=True,
+    on_summary=None,
+):
+    incomplete = []
+    own_export_writer = None
     try:
         logging.info(f"Przetwarzanie skrzynki: {mailbox}")
-        with tqdm(total=1, desc=f"Przetwarzanie {mailbox}", unit="msg", position=0, leave=True) as pbar:
-            folders = await get_all_folders(session, token, mailbox, throttler, pbar)
+        with open_mailbox_progress(mailbox) as pbar:
+            folder_cache = FolderCache(FOLDER_CACHE_DIR, mailbox) if FOLDER_CACHE_DIR else None
+            synced_tree = None
+            if folder_cache is not None:
+                synced_tree = await profiled(
+                    "folders",
+                    sync_folder_tree(session, token, mailbox, throttler, folder_cache, pbar),
+                )
+
+            unchanged = set()
+            if synced_tree is not None:
+                folders, delta_link, folders_state, unchanged = synced_tree
+            else:
+                folders = await profiled(
+                    "folders", get_all_folders(session, token, mailbox, throttler, pbar)
+                )
+                delta_link = None
+                folders_state = {
+                    folder_meta["id"]: {
+                        "displayName": folder_meta["displayName"],
+                        "totalItemCount": folder_meta["totalItemCount"],
+                    }
+                    for folder_meta in folders
+                }
             total_msgs = sum(f.get("totalItemCount", 0) for f in folders)
             pbar.total = total_msgs
 
-            mailbox_data = {}
+            sinks = []
+            if export:
+                if export_writer is None:
+                    export_writer = own_export_writer = ExcelExportWriter(EXPORT_QUEUE_SIZE)
+                sinks.append(ExcelSink(export_writer, mailbox))
+            if message_store is not None:
+                sinks.append(MessageStoreSink(message_store, mailbox))
+            if folder_cache is not None:
+                sinks.append(FolderCacheSink(folder_cache, mailbox, delta_link, folders_state))
+            pipeline = MailboxPipeline(
+                mailbox, sinks, pbar, page_processor, analytics=export and SIZE_ANALYTICS
+            )
+            dead_letters = DeadLetterQueue()
 
-            for index in range(0, len(folders), FOLDER_BATCH_SIZE):
-                current_batch = folders[index : index + FOLDER_BATCH_SIZE]
-                tasks = [
-                    get_messages_from_folder(
-                        session,
-                        token,
-                        mailbox,
-                        folder_meta["id"],
-                        pbar,
-                        throttler,
-                    )
-                    for folder_meta in current_batch
+            async def produce():
+                nonlocal incomplete
+                folders_to_fetch = [
+                    folder_meta for folder_meta in folders if folder_meta["id"] not in unchanged
                 ]
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                for folder_meta, result in zip(current_batch, results):
-                    folder_path = folder_meta["path"]
-                    if isinstance(result, Exception):
-                        error_summary = summarize_text(result)
-                        logging.warning(
-                            "Błąd pobierania folderu %s (%s): %s. Ponawiam próbę...",
-                            folder_path,
-                            folder_meta.get("id"),
-                            error_summary or result.__class__.__name__,
-                        )
-                        try:
-                            retry_messages = await get_messages_from_folder(
+                if unchanged:
+                    folders_to_fetch.extend(
+                        await stream_cached_folders(folder_cache, folders, unchanged, pipeline)
+                    )
+
+                for index in range(0, len(folders_to_fetch), FOLDER_BATCH_SIZE):
+                    current_batch = folders_to_fetch[index : index + FOLDER_BATCH_SIZE]
+                    await asyncio.gather(
+                        *(
+                            stream_folder_pages(
                                 session,
                                 token,
                                 mailbox,
-                                folder_meta["id"],
+                                folder_meta,
+                                pipeline,
                                 pbar,
                                 throttler,
+                                dead_letters=dead_letters,
                             )
-                        except Exception as retry_error:
-                            retry_summary = summarize_text(retry_error)
-                            logging.error(
-                                "Nie udało się pobrać folderu %s po ponownej próbie: %s",
-                                folder_path,
-                                retry_summary or retry_error.__class__.__name__,
-                            )
-                            mailbox_data[folder_path] = []
-                        else:
-                            mailbox_data[folder_path] = retry_messages or []
-                        continue
+                            for folder_meta in current_batch
+                        )
+                    )
 
-                    mailbox_data[folder_path] = result or []
+                incomplete = await retry_dead_letters(
+                    session, token, mailbox, dead_letters, pipeline, pbar, throttler
+                )
 
-            export_to_excel(mailbox_data, mailbox)
+            await pipeline.run(folders, produce)
+            incomplete = incomplete + pipeline.incomplete
+            await pipeline.finish(incomplete)
+            if on_summary is not None:
+                on_summary(mailbox, pipeline.summary, incomplete)
     except Exception:
         logging.exception("Błąd przetwarzania skrzynki %s", mailbox)
+    finally:
+        if own_export_writer is not None:
+            await own_export_writer.close()
+    return incomplete
+
+async def discover_mailboxes(session, token, throttler, department=None, domain=None, group_id=None):
+    """Zwraca adresy skrzynek dzierżawy strona po stronie z `/users`.
+
+    Adresy są przekazywane dalej zaraz po pobraniu każdej strony, więc
+    przetwarzanie pierwszych skrzynek zaczyna się przed końcem listy.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    if group_id:
+        url = (
+            f"https://graph.microsoft.com/v1.0/groups/{quote(group_id, safe='')}"
+            "/transitiveMembers/microsoft.graph.user"
+        )
+    else:
+        url = "https://graph.microsoft.com/v1.0/users"
+    url += "?$select=mail&$top=999"
+
+    filters = []
+    if department:
+        escaped_department = department.replace("'", "''")
+        filters.append(f"department eq '{escaped_department}'")
+    if domain:
+        escaped_domain = domain.lstrip("@").replace("'", "''")
+        filters.append(f"endswith(mail,'@{escaped_domain}')")
+    if filters:
+        url += "&$filter=" + quote(" and ".join(filters), safe="") + "&$count=true"
+        headers["ConsistencyLevel"] = "eventual"
+
+    seen = set()
+    discovered = 0
+    while url:
+        data = await fetch(session, url, headers, throttler)
+        if not data:
+            logging.error("Nie udało się pobrać listy użytkowników (adres: %s).", url)
+            return
+        for user in data.get("value", []):
+            mailbox_email = str(user.get("mail") or "").strip()
+            if not mailbox_email or mailbox_email.lower() in seen:
+                continue
+            seen.add(mailbox_email.lower())
+            discovered += 1
+            yield mailbox_email
+        url = data.get("@odata.nextLink")
+        logging.info("Wykryto dotąd %s skrzynek.", discovered)
+
+
+async def iterate_mailboxes(mailbox_list):
+    for mailbox in mailbox_list:
+        yield mailbox
+
+
+async def process_mailbox_queue(mailbox_source, run_mailbox, concurrency):
+    work_queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def mailbox_worker():
+        worker_results = []
+        while True:
+            mailbox = await work_queue.get()
+            if mailbox is None:
+                return worker_results
+            context_token = LOG_MAILBOX.set(mailbox)
+            try:
+                worker_results.append(await run_mailbox(mailbox))
+            finally:
+                LOG_MAILBOX.reset(context_token)
+
+    workers = [asyncio.create_task(mailbox_worker()) for _ in range(concurrency)]
+    try:
+        async for mailbox in mailbox_source:
+            await work_queue.put(mailbox)
+    finally:
+        for _ in workers:
+            await work_queue.put(None)
+    return [
+        result
+        for worker_results in await asyncio.gather(*workers)
+        for result in worker_results
+    ]
+
+
+class Credential:
+    def __init__(self, name, client_id, client_secret, tenant_id):
+        self.name = name
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.tenant_id = tenant_id
+        self.token = None
+        self.active_mailboxes = 0
+        self.throttler = RequestThrottler(
+            SEMAPHORE_LIMIT, THROTTLE_DELAY_SECONDS, name=name
+        )
+
+
+class CredentialPool:
+    """Rozdziela skrzynki pomiędzy rejestracje aplikacji.
+
+    Skrzynka pozostaje przypisana do jednej aplikacji (limity Graph liczone są
+    per aplikacja i skrzynka). Nowe skrzynki trafiają do aplikacji bez
+    aktywnego cooldownu, a spośród nich do najmniej obciążonej.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = [
+            Credential(
+                item["name"],
+                item["client_id"],
+                item["client_secret"],
+                item["tenant_id"],
+            )
+            for item in credentials
+        ]
+        self._assignments = {}
+
+    @property
+    def throttlers(self):
+        return [credential.throttler for credential in self.credentials]
+
+    def acquire_tokens(self):
+        for credential in self.credentials:
+            if HTTP_CASSETTE is not None and HTTP_CASSETTE.replaying:
+                credential.token = "replay"
+                continue
+            credential.token = get_access_token(
+                credential.client_id, credential.client_secret, credential.tenant_id
+            )
+            logging.info("Token dostępu uzyskany dla aplikacji %s.", credential.name)
+
+    def assign(self, mailbox_email):
+        credential = self._assignments.get(mailbox_email)
+        if credential is None:
+            credential = min(
+                self.credentials,
+                key=lambda item: (
+                    item.throttler.cooldown_remaining(),
+                    item.active_mailboxes,
+                ),
+            )
+            self._assignments[mailbox_email] = credential
+            RUN_STATS.mailbox(mailbox_email)["credential"] = credential.name
+        credential.active_mailboxes += 1
+        return credential
+
+    def release(self, mailbox_email):
+        credential = self._assignments.get(mailbox_email)
+        if credential is not None:
+            credential.active_mailboxes -= 1
+
+
+def log_credential_summary():
+    summary = RUN_STATS.credential_summary()
+    if len(summary) <= 1:
+        return
+    for name, values in sorted(summary.items()):
+        logging.info(
+            "Aplikacja %s: skrzynki=%s, wiadomości=%s (%.1f/s), żądania=%s (%.1f/s), 429=%s",
+            name,
+            values["mailboxes"],
+            values["messages"],
+            values["messages_per_second"],
+            values["requests"],
+            values["requests_per_second"],
+            values["throttled"],
+        )
+
+
+def log_pipeline_summary():
+    for stage, values in RUN_STATS.pipeline.summary().items():
+        logging.info(
+            "Potok [%s]: stron=%s, śr. czas=%.1f ms, maks. czas=%.1f ms, maks. kolejka=%s",
+            PipelineStats.LABELS[stage],
+            values["items"],
+            values["avg_ms"],
+            values["max_ms"],
+            "-" if values["max_depth"] is None else values["max_depth"],
+        )
+
+
+async def main(count_only=False, discovery=None, profile=False, profile_sample_ms=0.0):
+    global HTTP_CASSETTE, PROFILER
 
-async def main():
     logging.info("Rozpoczynam pobieranie danych (app-only)...")
-    token = get_access_token()
+    if profile:
+        PROFILER = StageProfiler(profile_sample_ms / 1000.0)
+        PROFILER.start_sampling(threading.get_ident())
+        logging.info(
+            "Profilowanie etapów włączone (próbkowanie: %s).",
+            f"co {profile_sample_ms:g} ms" if PROFILER.sample_interval else "wyłączone",
+        )
+    if HTTP_CASSETTE_MODE:
+        HTTP_CASSETTE = HttpCassette(
+            HTTP_CASSETTE_PATH, HTTP_CASSETTE_MODE, HTTP_CASSETTE_REPLAY_LATENCY_MS
+        )
+        logging.info(
+            "Archiwum odpowiedzi HTTP (%s): %s", HTTP_CASSETTE_MODE, HTTP_CASSETTE_PATH
+        )
+    credential_pool = CredentialPool(CREDENTIALS)
+    credential_pool.acquire_tokens()
     logging.info("Token dostępu uzyskany pomyślnie.")
 
-    mailboxes_input = input("Podaj adresy skrzynek oddzielone przecinkiem: ").strip()
-    mailbox_list = [m.strip() for m in mailboxes_input.split(",") if m.strip()]
+    mailbox_list = []
+    if discovery is None:
+        mailboxes_input = input("Podaj adresy skrzynek oddzielone przecinkiem: ").strip()
+        mailbox_list = [m.strip() for m in mailboxes_input.split(",") if m.strip()]
+
+    page_processor = None
+    if PAGE_PROCESSING_WORKERS > 0:
+        page_processor = PageProcessor(
+            PAGE_PROCESSING_WORKERS, PAGE_PROCESSING_MAX_IN_FLIGHT
+        )
+        logging.info(
+            "Przetwarzanie stron w puli procesów: workers=%s, max_in_flight=%s",
+            PAGE_PROCESSING_WORKERS,
+            PAGE_PROCESSING_MAX_IN_FLIGHT,
+        )
+
+    export_writer = ExcelExportWriter(EXPORT_QUEUE_SIZE)
+    message_store = MessageStore(MESSAGE_STORE_PATH) if MESSAGE_STORE_PATH else None
+    dashboard_task = None
+    if LIVE_DASHBOARD:
+        for handler in LOG_HANDLERS:
+            if isinstance(handler, logging.StreamHandler) and not isinstance(
+                handler, logging.FileHandler
+            ):
+                handler.setLevel(logging.ERROR)
+        dashboard = LiveDashboard(
+            RUN_STATS, credential_pool.throttlers, DASHBOARD_REFRESH_SECONDS
+        )
+        dashboard_task = asyncio.create_task(dashboard.run())
+    try:
+        async with aiohttp.ClientSession() as session:
+
+            async def run_mailbox(mailbox):
+                credential = credential_pool.assign(mailbox)
+                try:
+                    if count_only:
+                        return await process_mailbox_counts(
+                            session, mailbox, credential.token, credential.throttler
+                        )
+                    return await process_mailbox(
+                        session,
+                        mailbox,
+                        credential.token,
+                        credential.throttler,
+                        page_processor,
+                        export_writer,
+                        message_store,
+                    )
+                finally:
+                    credential_pool.release(mailbox)
+
+            if discovery is not None:
+                discovery_credential = credential_pool.credentials[0]
+                mailbox_source = discover_mailboxes(
+                    session,
+                    discovery_credential.token,
+                    discovery_credential.throttler,
+                    **discovery,
+                )
+            else:
+                mailbox_source = iterate_mailboxes(mailbox_list)
+            results = await process_mailbox_queue(
+                mailbox_source, run_mailbox, MAX_CONCURRENT_MAILBOXES
+            )
+    finally:
+        await export_writer.close()
+        if dashboard_task is not None:
+            dashboard_task.cancel()
+            await asyncio.gather(dashboard_task, return_exceptions=True)
+        if page_processor is not None:
+            page_processor.shutdown()
+        if HTTP_CASSETTE is not None:
+            HTTP_CASSETTE.close()
+        if message_store is not None:
+            message_store.close()
+        if PROFILER is not None:
+            PROFILER.stop_sampling()
+            PROFILER.write()
+
+    log_credential_summary()
+    log_pipeline_summary()
+    page_size_summary = RUN_STATS.page_size_summary()
+    if page_size_summary:
+        logging.info(
+            "Rozmiary stron wiadomości: folderów=%s, min=%s, max=%s, mediana końcowa=%s, timeouty=%s",
+            page_size_summary["folders"],
+            page_size_summary["min"],
+            page_size_summary["max"],
+            page_size_summary["median_final"],
+            page_size_summary["timeouts"],
+        )
+
+    incomplete = [entry for result in results for entry in result]
+    if incomplete:
+        logging.warning(
+            "Przetwarzanie zakończone z %s niekompletnymi stronami folderów:",
+            len(incomplete),
+        )
+        for entry in incomplete:
+            logging.warning(
+                "  %s / %s: %s", entry["mailbox"], entry["folder_path"], entry["url"]
+            )
+        return
+
+    logging.info("Przetwarzanie zakończone.")
+
+class AggregateCache:
+    """Zagregowane statystyki (skrzynka, folder, miesiąc) trzymane w pamięci.
+
+    Stan jest zapisywany do pliku JSON w trakcie odświeżania (nie częściej
+    niż co `SERVICE_CACHE_SAVE_INTERVAL_SECONDS`) i po jego zakończeniu oraz
+    wczytywany przy starcie, więc API odpowiada od razu po restarcie usługi.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mailboxes = {}
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as cache_file:
+                data = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, json.JSONDecodeError) as error:
+            logging.warning(
+                "Nie można odczytać pamięci statystyk %s: %s",
+                self.path,
+                summarize_text(error),
+            )
+            return
+        if isinstance(data, dict):
+            self.mailboxes = data.get("mailboxes", {})
+
+    def snapshot(self):
+        """Serializuje stan; wywoływane w pętli zdarzeń, która go zmienia."""
+        return json.dumps({"mailboxes": self.mailboxes}, ensure_ascii=False)
+
+    def write(self, snapshot):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            cache_file.write(snapshot)
+        os.replace(temp_path, self.path)
+
+    async def save(self):
+        loop = asyncio.get_running_loop()
+        try:
+            snapshot = self.snapshot()
+            await loop.run_in_executor(None, self.write, snapshot)
+        except (OSError, TypeError, ValueError) as error:
+            logging.warning(
+                "Nie można zapisać pamięci statystyk %s: %s",
+                self.path,
+                summarize_text(error),
+            )
+
+    def update(self, mailbox_email, summary, incomplete_folders):
+        folders = defaultdict(dict)
+        for (folder_path, month_key), values in summary.items():
+            folders[folder_path][month_key] = dict(values)
+        self.mailboxes[mailbox_email] = {
+            "refreshed_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "incomplete_pages": len(incomplete_folders),
+            "folders": dict(folders),
+        }
+
+    @staticmethod
+    def _is_month(month_key):
+        return bool(re.match(r"^\d{4}-\d{2}$", month_key))
+
+    def mailbox_overview(self):
+        overview = []
+        for mailbox_email, entry in sorted(self.mailboxes.items()):
+            message_count = 0
+            total_size = 0
+            for months in entry["folders"].values():
+                for values in months.values():
+                    message_count += values["message_count"]
+                    total_size += values["total_size"]
+            overview.append(
+                {
+                    "mailbox": mailbox_email,
+                    "refreshed_at": entry["refreshed_at"],
+                    "incomplete_pages": entry.get("incomplete_pages", 0),
+                    "folders": len(entry["folders"]),
+                    "message_count": message_count,
+                    "total_size": total_size,
+                }
+            )
+        return overview
+
+    def trend(self, mailbox_email, folder_path=None):
+        entry = self.mailboxes.get(mailbox_email)
+        if entry is None:
+            return None
+        monthly = defaultdict(
+            lambda: {"message_count": 0, "body_size": 0, "attachment_size": 0, "total_size": 0}
+        )
+        for current_folder, months in entry["folders"].items():
+            if folder_path is not None and current_folder != folder_path:
+                continue
+            for month_key, values in months.items():
+                for key, value in values.items():
+                    monthly[month_key][key] += value
+        return [
+            {"month": month_key, **values} for month_key, values in sorted(monthly.items())
+        ]
+
+    def top_growing_folders(self, months, limit, mailbox_email=None):
+        all_months = sorted(
+            {
+                month_key
+                for mailbox, entry in self.mailboxes.items()
+                if mailbox_email is None or mailbox == mailbox_email
+                for folder_months in entry["folders"].values()
+                for month_key in folder_months
+                if self._is_month(month_key)
+            }
+        )
+        recent = set(all_months[-months:])
+        previous = set(all_months[-2 * months : -months])
+        ranking = []
+        for mailbox, entry in self.mailboxes.items():
+            if mailbox_email is not None and mailbox != mailbox_email:
+                continue
+            for folder_path, folder_months in entry["folders"].items():
+                recent_size = sum(
+                    values["total_size"]
+                    for month_key, values in folder_months.items()
+                    if month_key in recent
+                )
+                previous_size = sum(
+                    values["total_size"]
+                    for month_key, values in folder_months.items()
+                    if month_key in previous
+                )
+                ranking.append(
+                    {
+                        "mailbox": mailbox,
+                        "folder": folder_path,
+                        "recent_total_size": recent_size,
+                        "previous_total_size": previous_size,
+                        "growth": recent_size - previous_size,
+                    }
+                )
+        ranking.sort(key=lambda item: item["growth"], reverse=True)
+        return {
+            "recent_months": sorted(recent),
+            "previous_months": sorted(previous),
+            "folders": ranking[:limit],
+        }
+
+
+def create_service_app(cache):
+    from aiohttp import web
+
+    def _int_query(request, key, default):
+        try:
+            return max(1, int(request.query.get(key, default)))
+        except ValueError:
+            raise web.HTTPBadRequest(text=f"Nieprawidłowa wartość parametru {key}.")
+
+    async def health(request):
+        return web.json_response({"status": "ok", "mailboxes": len(cache.mailboxes)})
+
+    async def mailboxes(request):
+        return web.json_response(cache.mailbox_overview())
+
+    async def trend(request):
+        mailbox_email = request.query.get("mailbox")
+        if not mailbox_email:
+            raise web.HTTPBadRequest(text="Wymagany parametr mailbox.")
+        series = cache.trend(mailbox_email, request.query.get("folder"))
+        if series is None:
+            raise web.HTTPNotFound(text=f"Brak danych dla skrzynki {mailbox_email}.")
+        return web.json_response({"mailbox": mailbox_email, "trend": series})
+
+    async def top_growing_folders(request):
+        return web.json_response(
+            cache.top_growing_folders(
+                _int_query(request, "months", 3),
+                _int_query(request, "limit", 10),
+                request.query.get("mailbox"),
+            )
+        )
+
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_get("/mailboxes", mailboxes)
+    app.router.add_get("/trend", trend)
+    app.router.add_get("/top-growing-folders", top_growing_folders)
+    return app
+
+
+async def refresh_service_cache(session, credential_pool, cache, discovery, message_store=None):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, credential_pool.acquire_tokens)
+
+    save_lock = asyncio.Lock()
+    last_saved = loop.time()
+
+    def store_summary(mailbox, summary, incomplete_folders):
+        cache.update(mailbox, summary, incomplete_folders)
+
+    async def save_cache(force=False):
+        nonlocal last_saved
+        async with save_lock:
+            if not force and loop.time() - last_saved < SERVICE_CACHE_SAVE_INTERVAL_SECONDS:
+                return
+            await cache.save()
+            last_saved = loop.time()
+
+    async def run_mailbox(mailbox):
+        credential = credential_pool.assign(mailbox)
+        try:
+            result = await process_mailbox(
+                session,
+                mailbox,
+                credential.token,
+                credential.throttler,
+                message_store=message_store,
+                export=False,
+                on_summary=store_summary,
+            )
+        finally:
+            credential_pool.release(mailbox)
+        await save_cache()
+        return result
+
+    if SERVICE_MAILBOXES:
+        mailbox_source = iterate_mailboxes(SERVICE_MAILBOXES)
+    else:
+        discovery_credential = credential_pool.credentials[0]
+        mailbox_source = discover_mailboxes(
+            session,
+            discovery_credential.token,
+            discovery_credential.throttler,
+            **(discovery or {}),
+        )
+    try:
+        return await process_mailbox_queue(
+            mailbox_source, run_mailbox, MAX_CONCURRENT_MAILBOXES
+        )
+    finally:
+        await save_cache(force=True)
+
+
+async def run_service(discovery=None):
+    global SERVICE_MODE
+    from aiohttp import web
+
+    SERVICE_MODE = True
+    cache = AggregateCache(SERVICE_CACHE_PATH)
+    cache.load()
+    logging.info(
+        "Usługa statystyk: %s skrzynek w pamięci (%s).", len(cache.mailboxes), cache.path
+    )
+
+    runner = web.AppRunner(create_service_app(cache))
+    await runner.setup()
+    site = web.TCPSite(runner, SERVICE_HOST, SERVICE_PORT)
+    await site.start()
+    logging.info("API usługi dostępne pod adresem http://%s:%s", SERVICE_HOST, SERVICE_PORT)
+
+    credential_pool = CredentialPool(CREDENTIALS)
+    message_store = MessageStore(MESSAGE_STORE_PATH) if MESSAGE_STORE_PATH else None
+    try:
+        async with aiohttp.ClientSession() as session:
+            while True:
+                started = time.monotonic()
+                logging.info("Rozpoczynam odświeżanie statystyk skrzynek.")
+                try:
+                    results = await refresh_service_cache(
+                        session, credential_pool, cache, discovery, message_store
+                    )
+                except Exception:
+                    logging.exception("Błąd odświeżania statystyk skrzynek.")
+                else:
+                    incomplete = sum(len(result) for result in results)
+                    logging.info(
+                        "Odświeżono %s skrzynek w %.0fs (niekompletne strony: %s).",
+                        len(results),
+                        time.monotonic() - started,
+                        incomplete,
+                    )
+                await asyncio.sleep(SERVICE_REFRESH_MINUTES * 60)
+    finally:
+        await runner.cleanup()
+        if message_store is not None:
+            message_store.close()
+
+
+GRAPH_MAILBOX_CONCURRENT_REQUESTS = 4
+GRAPH_MAILBOX_REQUESTS_PER_SECOND = 10000 / 600
+
+
+class _PageSample:
+    """Zapamiętuje czas i rozmiar strony pobranej przez `fetch`.
+
+    Przekazywany jako `page_sizer`, więc mierzy samo żądanie, bez czasu
+    oczekiwania na miejsce w throttlerze.
+    """
+
+    timeout = FETCH_TIMEOUT
+
+    def __init__(self):
+        self.seconds = None
+        self.bytes = 0
+
+    def apply(self, url):
+        return url
+
+    def record_success(self, elapsed_seconds, body_bytes):
+        self.seconds = elapsed_seconds
+        self.bytes = body_bytes
+
+    def record_timeout(self):
+        pass
+
+
+async def estimate_mailbox(session, mailbox_email, token, throttler, sample=True):
+    """Pobiera drzewo folderów skrzynki i opcjonalnie jedną stronę próbną.
+
+    Strona próbna pochodzi z największego folderu i służy do zmierzenia
+    czasu odpowiedzi oraz średniej liczby bajtów na wiadomość.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    folders = await get_all_folders(session, token, mailbox_email, throttler)
+    estimate = {
+        "mailbox": mailbox_email,
+        "folder_counts": [safe_int(folder.get("totalItemCount")) for folder in folders],
+        "folder_requests": len(folders) + 1,
+        "folder_seconds": loop.time() - started,
+        "sample": None,
+    }
+    if not sample or not any(estimate["folder_counts"]):
+        return estimate
+
+    largest = max(folders, key=lambda folder: safe_int(folder.get("totalItemCount")))
+    url, headers = build_folder_messages_request(token, mailbox_email, largest["id"])
+    page_sample = _PageSample()
+    raw_page = await fetch(session, url, headers, throttler, raw=True, page_sizer=page_sample)
+    if raw_page and page_sample.seconds is not None:
+        estimate["sample"] = {
+            "seconds": page_sample.seconds,
+            "bytes": len(raw_page),
+            "messages": len(json.loads(raw_page).get("value", [])),
+        }
+    return estimate
+
+
+def build_latency_model(estimates):
+    """Wyznacza stały narzut żądania, czas na wiadomość i bajty na wiadomość."""
+    samples = [
+        estimate["sample"]
+        for estimate in estimates
+        if estimate["sample"] and estimate["sample"]["messages"]
+    ]
+    if not samples:
+        return None
+    page_seconds = statistics.median(sample["seconds"] for sample in samples)
+    page_messages = statistics.median(sample["messages"] for sample in samples)
+    overhead = min(
+        statistics.median(
+            estimate["folder_seconds"] / estimate["folder_requests"] for estimate in estimates
+        ),
+        page_seconds,
+    )
+    return {
+        "overhead": overhead,
+        "per_message": (page_seconds - overhead) / page_messages,
+        "bytes_per_message": sum(sample["bytes"] for sample in samples)
+        / sum(sample["messages"] for sample in samples),
+        "samples": len(samples),
+    }
+
+
+def estimate_run(estimates, model, settings, credential_count):
+    """Szacuje liczbę żądań, transfer i czas przebiegu dla podanych ustawień.
+
+    Czas skrzynki to najdłuższy z trzech limitów: stronicowanie folderów
+    (partia czeka na swój najdłuższy folder), liczba równoległych żądań na
+    skrzynkę i limit żądań Graph na skrzynkę. Czas całości ograniczają
+    dodatkowo `semaphore_limit` i `throttle_delay_seconds` każdej aplikacji.
+    """
+    page_size = settings["message_page_size"]
+    batch_size = settings["max_folder_batch_size"]
+    page_latency = model["overhead"] + model["per_message"] * page_size
+    total_requests = 0
+    total_messages = 0
+    mailbox_seconds = []
+    for estimate in estimates:
+        counts = estimate["folder_counts"]
+        pages = [max(1, math.ceil(count / page_size)) for count in counts]
+        total_requests += estimate["folder_requests"] + sum(pages)
+        total_messages += sum(counts)
+        chain_seconds = page_latency * sum(
+            max(pages[index : index + batch_size]) for index in range(0, len(pages), batch_size)
+        )
+        parallel = min(batch_size, GRAPH_MAILBOX_CONCURRENT_REQUESTS)
+        mailbox_seconds.append(
+            estimate["folder_seconds"]
+            + max(
+                chain_seconds,
+                sum(pages) * page_latency / parallel,
+                sum(pages) / GRAPH_MAILBOX_REQUESTS_PER_SECOND,
+            )
+        )
+
+    request_rate = settings["semaphore_limit"] / page_latency
+    if settings["throttle_delay_seconds"] > 0:
+        request_rate = min(request_rate, 1 / settings["throttle_delay_seconds"])
+    request_rate *= max(credential_count, 1)
+    concurrency = max(min(settings["max_concurrent_mailboxes"], len(estimates)), 1)
+    wall_seconds = max(
+        total_requests / request_rate,
+        sum(mailbox_seconds) / concurrency,
+        max(mailbox_seconds, default=0.0),
+    )
+    return {
+        "requests": total_requests,
+        "transfer_bytes": total_messages * model["bytes_per_message"],
+        "page_latency": page_latency,
+        "request_rate": request_rate,
+        "wall_seconds": wall_seconds,
+    }
+
+
+def recommend_settings(estimates, model):
+    page_size = MESSAGE_PAGE_SIZE_LIMIT
+    if model["bytes_per_message"] > 0:
+        page_size = min(page_size, int(PAGE_MAX_BYTES / model["bytes_per_message"]))
+    if model["per_message"] > 0 and PAGE_TARGET_SECONDS > model["overhead"]:
+        page_size = min(
+            page_size, int((PAGE_TARGET_SECONDS - model["overhead"]) / model["per_message"])
+        )
+    page_size = max(MESSAGE_PAGE_SIZE_MINIMUM, min(page_size, MESSAGE_PAGE_SIZE_LIMIT))
+    page_latency = model["overhead"] + model["per_message"] * page_size
+
+    batch_size = GRAPH_MAILBOX_CONCURRENT_REQUESTS
+    useful_parallel = batch_size * max(len(estimates), 1)
+    if THROTTLE_DELAY_SECONDS > 0:
+        semaphore_limit = math.ceil(page_latency / THROTTLE_DELAY_SECONDS)
+    else:
+        semaphore_limit = useful_parallel
+    semaphore_limit = max(batch_size, min(semaphore_limit, useful_parallel))
+    return {
+        "message_page_size": page_size,
+        "max_folder_batch_size": batch_size,
+        "semaphore_limit": semaphore_limit,
+        "throttle_delay_seconds": THROTTLE_DELAY_SECONDS,
+        "max_concurrent_mailboxes": max(
+            1, min(len(estimates), math.ceil(semaphore_limit / batch_size))
+        ),
+    }
+
+
+def _format_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TB"
+
+
+def print_run_estimate(estimates, credential_count):
+    folders = sum(len(estimate["folder_counts"]) for estimate in estimates)
+    messages = sum(sum(estimate["folder_counts"]) for estimate in estimates)
+    print(f"Szacunek przebiegu: skrzynek {len(estimates)}, folderów {folders}, wiadomości {messages}")
+    model = build_latency_model(estimates)
+    if model is None:
+        print("Brak strony próbnej (puste skrzynki lub błąd pobierania) – nie można oszacować czasu.")
+        return
+    print(
+        f"  Próbki stron: {model['samples']}, narzut żądania {model['overhead']:.2f}s, "
+        f"{model['per_message'] * 1000:.1f} ms i {_format_bytes(model['bytes_per_message'])} "
+        "na wiadomość"
+    )
+
+    current = {
+        "message_page_size": MESSAGE_PAGE_SIZE,
+        "max_folder_batch_size": FOLDER_BATCH_SIZE,
+        "semaphore_limit": SEMAPHORE_LIMIT,
+        "throttle_delay_seconds": THROTTLE_DELAY_SECONDS,
+        "max_concurrent_mailboxes": MAX_CONCURRENT_MAILBOXES,
+    }
+    recommended = recommend_settings(estimates, model)
+    for label, settings in (("obecne", current), ("zalecane", recommended)):
+        result = estimate_run(estimates, model, settings, credential_count)
+        print(f"  Ustawienia {label}: " + ", ".join(f"{key}={value}" for key, value in settings.items()))
+        print(
+            f"    żądania: {result['requests']}, transfer: {_format_bytes(result['transfer_bytes'])}, "
+            f"strona: {result['page_latency']:.2f}s, limit tempa: {result['request_rate']:.1f} żądań/s, "
+            f"czas: {_format_eta(result['wall_seconds'])}"
+        )
+    if FOLDER_BATCH_SIZE > GRAPH_MAILBOX_CONCURRENT_REQUESTS:
+        print(
+            f"  Uwaga: max_folder_batch_size={FOLDER_BATCH_SIZE} przekracza "
+            f"{GRAPH_MAILBOX_CONCURRENT_REQUESTS} równoczesne żądania na skrzynkę dopuszczane "
+            "przez Graph – spodziewaj się odpowiedzi 429."
+        )
+    print("  Szacunek zakłada pobieranie bez pamięci podręcznej folderów i stały rozmiar strony.")
+    print("Zalecany fragment email_trend_config.json:")
+    print(json.dumps(recommended, indent=2))
+
+
+async def run_estimate(discovery=None, sample_mailboxes=5):
+    logging.info("Szacowanie kosztu przebiegu (bez pobierania wiadomości)...")
+    credential_pool = CredentialPool(CREDENTIALS)
+    credential_pool.acquire_tokens()
 
-    throttler = RequestThrottler(SEMAPHORE_LIMIT, THROTTLE_DELAY_SECONDS)
+    mailbox_list = []
+    if discovery is None:
+        mailboxes_input = input("Podaj adresy skrzynek oddzielone przecinkiem: ").strip()
+        mailbox_list = [m.strip() for m in mailboxes_input.split(",") if m.strip()]
 
+    sampled = 0
     async with aiohttp.ClientSession() as session:
-        tasks = [
-            process_mailbox(session, mailbox, token, throttler)
-            for mailbox in mailbox_list
+
+        async def run_mailbox(mailbox):
+            nonlocal sampled
+            sample = sampled < sample_mailboxes
+            sampled += 1
+            credential = credential_pool.assign(mailbox)
+            try:
+                return await estimate_mailbox(
+                    session, mailbox, credential.token, credential.throttler, sample
+                )
+            except Exception:
+                logging.exception("Błąd szacowania skrzynki %s", mailbox)
+                return None
+            finally:
+                credential_pool.release(mailbox)
+
+        if discovery is not None:
+            discovery_credential = credential_pool.credentials[0]
+            mailbox_source = discover_mailboxes(
+                session,
+                discovery_credential.token,
+                discovery_credential.throttler,
+                **discovery,
+            )
+        else:
+            mailbox_source = iterate_mailboxes(mailbox_list)
+        results = await process_mailbox_queue(
+            mailbox_source, run_mailbox, MAX_CONCURRENT_MAILBOXES
+        )
+
+    print_run_estimate(
+        [estimate for estimate in results if estimate is not None],
+        len(credential_pool.credentials),
+    )
+    return 0
+
+
+BENCHMARK_BODY_SAMPLES = (
+    "Hello team, please find the quarterly report attached for review. ",
+    "Zażółć gęślą jaźń – spotkanie przeniesione na piątek, sala 204. ",
+    "会议纪要已附上，请在周五之前确认预算。 ",
+    "Привет! Документы по проекту во вложении, жду комментариев. ",
+    "Grüße aus München — die Überweisung erfolgt morgen früh. ",
+    "✅ Zadanie zakończone 🚀 dziękuję wszystkim za pomoc 🙏 ",
+)
+BENCHMARK_HEADER_NAMES = (
+    "Received",
+    "DKIM-Signature",
+    "ARC-Seal",
+    "ARC-Message-Signature",
+    "Authentication-Results",
+    "X-MS-Exchange-Organization-SCL",
+    "X-Forefront-Antispam-Report",
+    "Content-Type",
+)
+BENCHMARK_ALLOCATION_SLACK_BYTES = 16
+BENCHMARK_MIN_RUN_SECONDS = 0.05
+BENCHMARK_CALIBRATION_ITEMS = 100_000
+BENCHMARK_BASELINE_PATH = os.path.join(SCRIPT_DIR, "benchmark_baseline.json")
+
+
+def build_benchmark_messages(count, seed=0):
+    """Buduje syntetyczne wiadomości w kształcie odpowiedzi Graph.
+
+    Mieszanka obejmuje treści ASCII i wielojęzyczne, duże zestawy nagłówków
+    oraz wiadomości z wieloma załącznikami. Ziarno `seed` zapewnia te same
+    dane w kolejnych przebiegach, więc wyniki można porównywać z bazowymi.
+    """
+    rng = random.Random(seed)
+    messages = []
+    for index in range(count):
+        sample = rng.choice(BENCHMARK_BODY_SAMPLES)
+        body = "<html><body><p>" + sample * rng.randint(2, 60) + "</p></body></html>"
+        headers = [
+            {
+                "name": BENCHMARK_HEADER_NAMES[header_index % len(BENCHMARK_HEADER_NAMES)],
+                "value": (
+                    f"from mx{rng.randint(1, 99)}.example.com ([10.0.{header_index}.1]) "
+                    f"by relay.example.com with ESMTPS id {rng.getrandbits(64):x}"
+                ),
+            }
+            for header_index in range(rng.choice((6, 24, 60)))
         ]
-        await asyncio.gather(*tasks)
+        attachments = []
+        for _ in range(rng.choice((0, 0, 0, 1, 2, 5, 30))):
+            size = rng.randint(1_000, 5_000_000)
+            raw_size = rng.choice((size, size, float(size), f"{size:,}".replace(",", " ")))
+            attachments.append({"size": raw_size, "isInline": rng.random() < 0.3})
+        extended = []
+        if rng.random() < 0.7:
+            extended.append({"id": "Long 0x0E08", "value": str(rng.randint(5_000, 9_000_000))})
+        received = datetime.datetime(2020, 1, 1) + datetime.timedelta(
+            minutes=rng.randint(0, 5 * 365 * 24 * 60)
+        )
+        messages.append(
+            {
+                "id": f"AAMkAGI2{index:012d}",
+                "subject": sample[: rng.randint(10, 60)].strip(),
+                "receivedDateTime": received.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "hasAttachments": bool(attachments),
+                "from": {"emailAddress": {"address": f"user{rng.randint(0, 499)}@example.com"}},
+                "body": {"contentType": "html", "content": body},
+                "bodyPreview": sample[:255],
+                "internetMessageHeaders": headers,
+                "singleValueExtendedProperties": extended,
+                "attachments": attachments,
+                "toRecipients": [
+                    {"emailAddress": {"address": f"user{rng.randint(0, 499)}@example.com"}}
+                    for _ in range(rng.randint(1, 8))
+                ],
+                "ccRecipients": [],
+                "bccRecipients": [],
+            }
+        )
+    return messages
+
+
+def _summarize_benchmark_messages(messages):
+    summary = new_monthly_summary()
+    for msg in messages:
+        add_message_to_summary(summary, "Inbox", msg)
+    return summary
+
+
+def _message_benchmark_cases(messages):
+    processed = process_message_page([dict(msg) for msg in messages])
+    size_values = [att["size"] for msg in messages for att in msg["attachments"]]
+    size_values.extend(
+        prop["value"] for msg in messages for prop in msg["singleValueExtendedProperties"]
+    )
+    bodies = [msg["body"]["content"] for msg in messages]
+    return [
+        ("safe_int", lambda: size_values, lambda items: [safe_int(item) for item in items]),
+        ("encoded_length", lambda: bodies, lambda items: [encoded_length(item) for item in items]),
+        (
+            "estimate_message_body_bytes",
+            lambda: messages,
+            lambda items: [estimate_message_body_bytes(item) for item in items],
+        ),
+        (
+            "extract_extended_message_size",
+            lambda: messages,
+            lambda items: [extract_extended_message_size(item) for item in items],
+        ),
+        ("process_message_page", lambda: [dict(msg) for msg in messages], process_message_page),
+        ("add_message_to_summary", lambda: processed, _summarize_benchmark_messages),
+        ("build_message_row", lambda: processed, lambda items: [build_message_row(item) for item in items]),
+    ]
+
+
+def _benchmark_statistics(samples):
+    """Zwraca medianę próbek i ich względny rozrzut.
+
+    Rozrzut to rozstęp międzykwartylowy podzielony przez medianę. Porównanie
+    z wynikami bazowymi dolicza go do progu, więc szum pomiaru nie jest
+    zgłaszany jako regresja.
+    """
+    median = statistics.median(samples)
+    if len(samples) < 2 or median <= 0:
+        return median, 0.0
+    first_quartile, _, third_quartile = statistics.quantiles(samples, n=4)
+    return median, (third_quartile - first_quartile) / median
+
+
+def _time_calibration():
+    """Mierzy czas stałej pętli w czystym Pythonie (ns na iterację).
+
+    Wyniki przypadków dzielone są przez ten czas zmierzony tuż po nich, więc
+    porównanie z wynikami bazowymi nie zależy od chwilowej szybkości maszyny
+    (obciążenie przez inne procesy, zmiana taktowania procesora).
+    """
+    best = None
+    for _ in range(3):
+        total = 0
+        started = time.perf_counter_ns()
+        for value in range(BENCHMARK_CALIBRATION_ITEMS):
+            total += value * value % 7
+        elapsed = time.perf_counter_ns() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / BENCHMARK_CALIBRATION_ITEMS
+
+
+def _time_benchmark_case(prepare, run, repeat):
+    samples = []
+    relative_samples = []
+    for _ in range(repeat):
+        elapsed = 0
+        processed = 0
+        while elapsed < BENCHMARK_MIN_RUN_SECONDS * 1e9:
+            items = prepare()
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                started = time.perf_counter_ns()
+                run(items)
+                elapsed += time.perf_counter_ns() - started
+            finally:
+                if gc_enabled:
+                    gc.enable()
+            processed += max(len(items), 1)
+        samples.append(elapsed / processed)
+        relative_samples.append(samples[-1] / _time_calibration())
+    return _benchmark_statistics(samples), _benchmark_statistics(relative_samples), len(items)
+
+
+def _trace_benchmark_case(prepare, run):
+    items = prepare()
+    tracemalloc.start()
+    try:
+        result = run(items)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak / max(len(items), 1)
+
+
+def benchmark_message_hot_path(count, repeat, seed=0):
+    messages = build_benchmark_messages(count, seed)
+    results = {}
+    for name, prepare, run in _message_benchmark_cases(messages):
+        (ns_per_item, ns_noise), (relative_cost, relative_noise), items = (
+            _time_benchmark_case(prepare, run, repeat)
+        )
+        results[name] = {
+            "items": items,
+            "ns_per_item": ns_per_item,
+            "ns_noise": ns_noise,
+            "relative_cost": relative_cost,
+            "relative_noise": relative_noise,
+            "bytes_per_item": _trace_benchmark_case(prepare, run),
+        }
+    return results
+
+
+def _benchmark_time_change(values, reference):
+    """Zwraca względną zmianę czasu i rozrzut, który należy doliczyć do progu.
+
+    Czas porównywany jest po kalibracji, jeśli mają ją oba pomiary (starsze
+    pliki wyników bazowych jej nie zawierają).
+    """
+    change_key, noise_key = "ns_per_item", "ns_noise"
+    if reference.get("relative_cost") and values.get("relative_cost"):
+        change_key, noise_key = "relative_cost", "relative_noise"
+    noise = max(reference.get(noise_key) or 0.0, values.get(noise_key) or 0.0)
+    return values[change_key] / reference[change_key] - 1, noise
+
+
+def compare_benchmark_results(results, baseline_results, threshold):
+    regressions = []
+    for name, values in results.items():
+        reference = baseline_results.get(name)
+        if not reference:
+            continue
+        limits = {
+            "ns_per_item": reference.get("ns_per_item"),
+            "bytes_per_item": reference.get("bytes_per_item"),
+        }
+        for metric, reference_value in limits.items():
+            current = values.get(metric)
+            if reference_value is None or current is None:
+                continue
+            if metric == "bytes_per_item":
+                if current > reference_value * (1 + threshold) + BENCHMARK_ALLOCATION_SLACK_BYTES:
+                    regressions.append((name, metric, reference_value, current))
+                continue
+            change, noise = _benchmark_time_change(values, reference)
+            if change > threshold + noise:
+                regressions.append((name, metric, reference_value, current))
+    return regressions
+
+
+async def benchmark_throttler(waiters, cooldowns, interval_seconds):
+    throttler = RequestThrottler(waiters, interval_seconds, name="benchmark")
+    cooldown_every = max(waiters // max(cooldowns, 1), 1)
+
+    async def worker(index):
+        async with throttler.slot() as throttle_slot:
+            if index % cooldown_every == 0:
+                await throttle_slot.extend_cooldown(interval_seconds * 20)
+
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    await asyncio.gather(*(worker(index) for index in range(waiters)))
+    return time.perf_counter() - wall_started, time.process_time() - cpu_started
+
+
+def run_benchmark(args):
+    baseline = None
+    baseline_path = args.baseline
+    if baseline_path is None and (args.check or os.path.exists(BENCHMARK_BASELINE_PATH)):
+        baseline_path = BENCHMARK_BASELINE_PATH
+    if args.check and not (baseline_path and os.path.exists(baseline_path)):
+        print(
+            f"Brak pliku wyników bazowych {baseline_path}. Zapisz je poleceniem "
+            "`benchmark --save-baseline` na maszynie, na której wykonywana jest kontrola."
+        )
+        return 2
+    if baseline_path:
+        try:
+            with open(baseline_path, "r", encoding="utf-8") as baseline_file:
+                baseline = json.load(baseline_file)
+        except (OSError, json.JSONDecodeError) as error:
+            print(f"Nie można odczytać wyników bazowych {baseline_path}: {summarize_text(error)}")
+            return 1
+        print(f"Wyniki bazowe: {baseline_path}")
+        if (baseline.get("messages"), baseline.get("seed")) != (args.messages, args.seed):
+            print(
+                "Uwaga: wyniki bazowe zmierzono dla innych parametrów "
+                f"(wiadomości={baseline.get('messages')}, seed={baseline.get('seed')})."
+            )
+    baseline_results = (baseline or {}).get("results", {})
+
+    results = {}
+    if args.suite in ("all", "messages"):
+        print(
+            f"Ścieżka wiadomości: {args.messages} syntetycznych wiadomości "
+            f"(seed={args.seed}), mediana z {args.repeat} przebiegów"
+        )
+        message_results = benchmark_message_hot_path(args.messages, args.repeat, args.seed)
+        for name, values in message_results.items():
+            line = (
+                f"  {name:<30} {values['ns_per_item']:>10.1f} ns/elem "
+                f"(±{values['ns_noise']:.0%}) "
+                f"{values['bytes_per_item']:>10.1f} B/elem (szczyt)  elementów: {values['items']}"
+            )
+            reference = baseline_results.get(name)
+            if reference and reference.get("ns_per_item"):
+                change, _ = _benchmark_time_change(values, reference)
+                line += f"  [{change:+.1%} względem bazowych]"
+            print(line)
+        results.update(message_results)
+
+    if args.suite in ("all", "throttler"):
+        throttler_runs = []
+        relative_samples = []
+        for _ in range(max(args.throttler_repeat, 1)):
+            throttler_runs.append(
+                asyncio.run(
+                    benchmark_throttler(
+                        args.throttler_waiters, args.throttler_cooldowns, args.throttler_interval
+                    )
+                )
+            )
+            relative_samples.append(
+                throttler_runs[-1][1] / args.throttler_waiters * 1e9 / _time_calibration()
+            )
+        wall_seconds = statistics.median(run[0] for run in throttler_runs)
+        cpu_per_request, cpu_noise = _benchmark_statistics(
+            [run[1] / args.throttler_waiters for run in throttler_runs]
+        )
+        relative_cost, relative_noise = _benchmark_statistics(relative_samples)
+        cpu_seconds = cpu_per_request * args.throttler_waiters
+        scheduled_seconds = args.throttler_waiters * args.throttler_interval
+        print(
+            f"RequestThrottler: {args.throttler_waiters} oczekujących, "
+            f"{args.throttler_cooldowns} cooldownów, odstęp {args.throttler_interval}s, "
+            f"mediana z {len(throttler_runs)} przebiegów"
+        )
+        throttler_result = {
+            "items": args.throttler_waiters,
+            "ns_per_item": cpu_per_request * 1e9,
+            "ns_noise": cpu_noise,
+            "relative_cost": relative_cost,
+            "relative_noise": relative_noise,
+            "bytes_per_item": None,
+        }
+        line = (
+            f"  czas: {wall_seconds:.3f}s (harmonogram: {scheduled_seconds:.3f}s), "
+            f"CPU: {cpu_seconds:.3f}s, "
+            f"CPU na żądanie: {cpu_per_request * 1e6:.1f}µs (±{cpu_noise:.0%})"
+        )
+        reference = baseline_results.get("RequestThrottler")
+        if reference and reference.get("ns_per_item"):
+            change, _ = _benchmark_time_change(throttler_result, reference)
+            line += f"  [{change:+.1%} względem bazowych]"
+        print(line)
+        results["RequestThrottler"] = throttler_result
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(
+                {
+                    "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "python": sys.version.split()[0],
+                    "messages": args.messages,
+                    "seed": args.seed,
+                    "results": results,
+                },
+                baseline_file,
+                ensure_ascii=False,
+                indent=2,
+            )
+        print(f"Wyniki bazowe zapisano do pliku: {args.save_baseline}")
+
+    regressions = compare_benchmark_results(results, baseline_results, args.threshold)
+    if regressions:
+        print(f"Regresje powyżej progu {args.threshold:.0%}:")
+        for name, metric, reference_value, current in regressions:
+            unit = "ns/elem" if metric == "ns_per_item" else "B/elem"
+            print(f"  {name}: {reference_value:.1f} → {current:.1f} {unit}")
+        return 1
+    return 0
+
+
+REPORT_PERIOD_EXPRESSIONS = {
+    "month": "month",
+    "quarter": (
+        "CASE WHEN month GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]' "
+        "THEN substr(month, 1, 4) || '-Q' || ((CAST(substr(month, 6, 2) AS INTEGER) + 2) / 3) "
+        "ELSE month END"
+    ),
+    "year": (
+        "CASE WHEN month GLOB '[0-9][0-9][0-9][0-9]-*' THEN substr(month, 1, 4) ELSE month END"
+    ),
+}
+
+
+def _report_filters(args):
+    clauses = []
+    params = []
+    if args.mailbox:
+        clauses.append(f"mailbox IN ({', '.join('?' for _ in args.mailbox)})")
+        params.extend(args.mailbox)
+    if args.since:
+        clauses.append("received >= ?")
+        params.append(args.since)
+    if args.until:
+        clauses.append("received < ?")
+        params.append(args.until)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+
+def run_report(args):
+    store_path = args.store or MESSAGE_STORE_PATH
+    if not store_path or not os.path.exists(store_path):
+        print("Brak bazy wiadomości. Ustaw message_store_path lub podaj --store.")
+        return 1
+
+    folder_pattern = re.compile(args.folder) if args.folder else None
+    connection = sqlite3.connect(store_path)
+    where, params = _report_filters(args)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    if args.full:
+        mailboxes = [
+            row[0]
+            for row in connection.execute(
+                f"SELECT DISTINCT mailbox FROM messages {where} ORDER BY mailbox", params
+            )
+        ]
+        for mailbox_email in mailboxes:
+            mailbox_where = f"{where} AND mailbox = ?" if where else "WHERE mailbox = ?"
+            workbook = MailboxWorkbook(mailbox_email)
+            summary = new_monthly_summary()
+            analytics = MailboxAnalytics() if SIZE_ANALYTICS else None
+            rows = connection.execute(
+                "SELECT folder_path, message_id, received, sender, subject, body_size, "
+                f"attachment_size, total_size FROM messages {mailbox_where} "
+                "ORDER BY folder_path, rowid",
+                params + [mailbox_email],
+            )
+            for folder_path, message_id, received, sender, subject, body, attachment, total in rows:
+                if folder_pattern and not folder_pattern.search(folder_path):
+                    continue
+                msg = {
+                    "id": message_id,
+                    "subject": subject,
+                    "receivedDateTime": received,
+                    "from": {"emailAddress": {"address": sender}},
+                    "body_size": body,
+                    "attachment_size": attachment,
+                    "total_size": total,
+                }
+                workbook.append_messages(folder_path, (msg,))
+                add_message_to_summary(summary, folder_path, msg)
+                if analytics is not None:
+                    analytics.add_messages((msg,))
+            workbook.save(summary, analytics=analytics)
+        connection.close()
+        return 0
+
+    period_expression = REPORT_PERIOD_EXPRESSIONS[args.period]
+    group_columns = {
+        "folder": ["mailbox", "folder_path"],
+        "mailbox": ["mailbox"],
+        "tenant": [],
+    }[args.group_by]
+    select_columns = ", ".join(group_columns + [f"{period_expression} AS period"])
+    rows = connection.execute(
+        f"SELECT {select_columns}, folder_path AS filter_folder, COUNT(*), SUM(total_size), "
+        f"SUM(body_size), SUM(attachment_size) FROM messages {where} "
+        f"GROUP BY {', '.join(group_columns + ['period', 'filter_folder'])}",
+        params,
+    ).fetchall()
+    connection.close()
+
+    summary = defaultdict(lambda: [0, 0, 0, 0])
+    for row in rows:
+        key = row[: len(group_columns) + 1]
+        folder_path = row[len(group_columns) + 1]
+        if folder_pattern and not folder_pattern.search(folder_path):
+            continue
+        values = summary[key]
+        for index, value in enumerate(row[len(group_columns) + 2 :]):
+            values[index] += value or 0
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Podsumowanie"
+    header_labels = {"mailbox": "Mailbox", "folder_path": "Folder"}
+    ws.append(
+        [header_labels[column] for column in group_columns]
+        + [
+            args.period.capitalize(),
+            "Message Count",
+            "Total Size (KB)",
+            "Message Size (KB)",
+            "Attachment Size (KB)",
+            "Total Size (MB)",
+            "Message Size (MB)",
+            "Attachment Size (MB)",
+        ]
+    )
+    for key, (count, total_bytes, body_bytes, attachment_bytes) in sorted(summary.items()):
+        ws.append(
+            list(key)
+            + [
+                count,
+                round(total_bytes / 1024, 2),
+                round(body_bytes / 1024, 2),
+                round(attachment_bytes / 1024, 2),
+                round(total_bytes / (1024 * 1024), 2),
+                round(body_bytes / (1024 * 1024), 2),
+                round(attachment_bytes / (1024 * 1024), 2),
+            ]
+        )
+    filename = args.output or f"raport_{args.group_by}_{args.period}_{timestamp}.xlsx"
+    wb.save(filename)
+    logging.info("Raport zapisano do pliku: %s (%s wierszy)", filename, len(summary))
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Statystyki rozmiaru wiadomości w skrzynkach Microsoft 365."
+    )
+    parser.add_argument(
+        "--count-only",
+        action="store_true",
+        help="Tylko miesięczna liczba wiadomości w folderach (zapytania $count).",
+    )
+    parser.add_argument(
+        "--discover",
+        action="store_true",
+        help="Pobiera listę skrzynek z katalogu dzierżawy zamiast pytać o adresy.",
+    )
+    parser.add_argument("--department", help="Filtr działu przy --discover.")
+    parser.add_argument("--domain", help="Filtr domeny adresu przy --discover.")
+    parser.add_argument("--group", help="Identyfikator grupy przy --discover.")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Pobiera tylko foldery i stronę próbną, szacuje koszt i czas przebiegu.",
+    )
+    parser.add_argument(
+        "--sample-mailboxes",
+        type=int,
+        default=5,
+        help="Liczba skrzynek, z których --dry-run pobiera stronę próbną.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Mierzy czas rzeczywisty, CPU i oczekiwanie na limit dla etapów przebiegu.",
+    )
+    parser.add_argument(
+        "--profile-sample-ms",
+        type=float,
+        default=0.0,
+        help="Okres próbkowania stosu pętli zdarzeń przy --profile (0 = bez próbkowania).",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    report_parser = subparsers.add_parser(
+        "report", help="Odtwarza raporty z lokalnej bazy wiadomości bez pobierania."
+    )
+    report_parser.add_argument("--store", help="Plik bazy (domyślnie message_store_path).")
+    report_parser.add_argument(
+        "--mailbox", action="append", help="Skrzynka do raportu (można powtarzać)."
+    )
+    report_parser.add_argument("--folder", help="Wyrażenie regularne dla ścieżki folderu.")
+    report_parser.add_argument("--since", help="Data początkowa (np. 2024-01-01).")
+    report_parser.add_argument("--until", help="Data końcowa, wyłącznie (np. 2025-01-01).")
+    report_parser.add_argument(
+        "--period", choices=sorted(REPORT_PERIOD_EXPRESSIONS), default="month"
+    )
+    report_parser.add_argument(
+        "--group-by", choices=["folder", "mailbox", "tenant"], default="folder"
+    )
+    report_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Odtwarza pełne skoroszyty skrzynek (karty folderów i podsumowanie).",
+    )
+    report_parser.add_argument("--output", help="Nazwa pliku raportu zbiorczego.")
+
+    subparsers.add_parser(
+        "serve",
+        help="Usługa odświeżająca statystyki w tle z lokalnym API HTTP.",
+    )
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Mikrobenchmarki elementów krytycznych dla wydajności."
+    )
+    benchmark_parser.add_argument("--throttler-waiters", type=int, default=10000)
+    benchmark_parser.add_argument("--throttler-cooldowns", type=int, default=100)
+    benchmark_parser.add_argument("--throttler-interval", type=float, default=0.0001)
+    benchmark_parser.add_argument(
+        "--throttler-repeat", type=int, default=3, help="Liczba przebiegów testu RequestThrottler."
+    )
+    benchmark_parser.add_argument(
+        "--suite", choices=["all", "messages", "throttler"], default="all"
+    )
+    benchmark_parser.add_argument(
+        "--messages", type=int, default=5000, help="Liczba syntetycznych wiadomości."
+    )
+    benchmark_parser.add_argument(
+        "--repeat", type=int, default=9, help="Liczba przebiegów; liczy się mediana."
+    )
+    benchmark_parser.add_argument("--seed", type=int, default=0)
+    benchmark_parser.add_argument(
+        "--baseline",
+        help="Plik JSON z wynikami bazowymi (domyślnie benchmark_baseline.json obok skryptu, jeśli istnieje).",
+    )
+    benchmark_parser.add_argument(
+        "--save-baseline",
+        nargs="?",
+        const=BENCHMARK_BASELINE_PATH,
+        help="Zapisuje bieżące wyniki jako bazowe do pliku JSON (domyślnie benchmark_baseline.json).",
+    )
+    benchmark_parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Kontrola regresji: brak pliku wyników bazowych kończy polecenie błędem.",
+    )
+    benchmark_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.3,
+        help=(
+            "Dopuszczalny wzrost względem wyników bazowych (0.3 = 30%%); "
+            "do progu doliczany jest rozrzut pomiarów."
+        ),
+    )
+    return parser.parse_args(argv)
 
-    logging.info("Przetwarzanie zakończone.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    cli_args = parse_args()
+    if cli_args.command == "benchmark":
+        sys.exit(run_benchmark(cli_args))
+    if cli_args.command == "report":
+        sys.exit(run_report(cli_args))
+    prepare_config()
+    discovery_options = None
+    if cli_args.discover or cli_args.command == "serve":
+        discovery_options = {
+            "department": cli_args.department,
+            "domain": cli_args.domain,
+            "group_id": cli_args.group,
+        }
+    if cli_args.command == "serve":
+        asyncio.run(run_service(discovery_options))
+    elif cli_args.dry_run:
+        sys.exit(asyncio.run(run_estimate(discovery_options, cli_args.sample_mailboxes)))
+    else:
+        asyncio.run(
+            main(
+                count_only=cli_args.count_only,
+                discovery=discovery_options,
+                profile=cli_args.profile,
+                profile_sample_ms=cli_args.profile_sample_ms,
+            )
+        )
@@ -0,0 +1,61 @@
+import asyncio
+import importlib.util
+import pathlib
+import sys
+
+import pytest
+
+SCRIPT_PATH = pathlib.Path(__file__).resolve().parents[1] / "E-mail trend.py"
+
+
+def load_script():
+    module = sys.modules.get("email_trend")
+    if module is None:
+        spec = importlib.util.spec_from_file_location("email_trend", SCRIPT_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def et():
+    return load_script()
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Pętla zdarzeń z czasem wirtualnym.
+
+    Oczekiwanie na najbliższy timer przesuwa zegar zamiast usypiać wątek,
+    więc harmonogram żądań można porównywać dokładnie i bez opóźnień.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.clock = 0.0
+        select = self._selector.select
+
+        def virtual_select(timeout=None):
+            events = select(0)
+            if not events and timeout:
+                self.clock += timeout
+            return events
+
+        self._selector.select = virtual_select
+
+    def time(self):
+        return self.clock
+
+
+@pytest.fixture
+def run_virtual():
+    loops = []
+
+    def run(coroutine):
+        loop = VirtualClockLoop()
+        loops.append(loop)
+        return loop.run_until_complete(coroutine)
+
+    yield run
+    for loop in loops:
+        loop.close()
@@ -0,0 +1,44 @@
+import asyncio
+import json
+
+
+def test_save_round_trips_through_load(et, tmp_path):
+    path = tmp_path / "service_cache.json"
+    cache = et.AggregateCache(str(path))
+    summary = et.new_monthly_summary()
+    summary[("Inbox", "2024-01")]["message_count"] += 2
+    summary[("Inbox", "2024-01")]["total_size"] += 300
+    cache.update("a@x.com", summary, [])
+
+    asyncio.run(cache.save())
+
+    restored = et.AggregateCache(str(path))
+    restored.load()
+    assert restored.mailboxes == json.loads(json.dumps(cache.mailboxes))
+    assert not (tmp_path / "service_cache.json.tmp").exists()
+
+
+def test_snapshot_is_taken_before_the_write_runs(et, tmp_path):
+    path = tmp_path / "service_cache.json"
+    cache = et.AggregateCache(str(path))
+    cache.mailboxes["a@x.com"] = {"refreshed_at": "t", "folders": {}}
+    written = []
+
+    def write(snapshot):
+        cache.mailboxes["b@x.com"] = {"refreshed_at": "t", "folders": {}}
+        written.append(json.loads(snapshot))
+
+    cache.write = write
+    asyncio.run(cache.save())
+    assert list(written[0]["mailboxes"]) == ["a@x.com"]
+
+
+def test_failed_save_keeps_the_previous_file(et, tmp_path):
+    path = tmp_path / "service_cache.json"
+    path.write_text('{"mailboxes": {"old@x.com": {}}}', encoding="utf-8")
+    cache = et.AggregateCache(str(path))
+    cache.mailboxes["a@x.com"] = {"refreshed_at": object()}
+
+    asyncio.run(cache.save())
+
+    assert json.loads(path.read_text(encoding="utf-8")) == {"mailboxes": {"old@x.com": {}}}
@@ -0,0 +1,107 @@
+import random
+
+import numpy as np
+import pytest
+
+
+def message(received, total_size, sender="a@x.com"):
+    return {
+        "receivedDateTime": received,
+        "total_size": total_size,
+        "from": {"emailAddress": {"address": sender}},
+    }
+
+
+def build_analytics(et, messages):
+    analytics = et.MailboxAnalytics()
+    analytics.add_messages(messages)
+    return analytics
+
+
+def test_percentiles_match_numpy_per_month(et):
+    rng = random.Random(7)
+    messages = []
+    for month in range(1, 7):
+        for _ in range(rng.randint(1, 300)):
+            messages.append(
+                message(f"2024-{month:02d}-15T10:00:00Z", rng.randint(100, 40_000_000))
+            )
+    rng.shuffle(messages)
+    rows = build_analytics(et, messages).size_percentiles()
+
+    quantiles = list(et.SIZE_PERCENTILES) + [100]
+    by_month = {}
+    for msg in messages:
+        by_month.setdefault(msg["receivedDateTime"][:7], []).append(msg["total_size"])
+    expected = sorted(by_month.items()) + [
+        (et.ALL_MONTHS_LABEL, [msg["total_size"] for msg in messages])
+    ]
+    assert [row[0] for row in rows] == [label for label, _ in expected]
+    for (label, count, values), (_, sizes) in zip(rows, expected):
+        assert count == len(sizes), label
+        assert values == pytest.approx(np.percentile(sizes, quantiles).tolist()), label
+
+
+def test_single_message_month_uses_its_size_for_every_percentile(et):
+    rows = build_analytics(et, [message("2024-05-01T00:00:00Z", 1234)]).size_percentiles()
+    assert rows[0] == ("2024-05", 1, [1234.0] * (len(et.SIZE_PERCENTILES) + 1))
+
+
+def test_empty_mailbox_has_no_percentiles_or_senders(et):
+    analytics = et.MailboxAnalytics()
+    assert analytics.size_percentiles() == []
+    assert analytics.top_senders(5) == []
+
+
+def test_months_match_the_monthly_summary_for_unusual_dates(et):
+    dates = [
+        "2024-03-05T10:00:00Z",
+        "2024-03-31T23:30:00-02:00",
+        "2024-12-31T23:59:59.1234567Z",
+        "20240305T100000Z",
+        "nie-data",
+        "",
+        None,
+    ]
+    messages = [message(received, 1000 + index) for index, received in enumerate(dates)]
+    summary = et.new_monthly_summary()
+    for msg in messages:
+        et.add_message_to_summary(summary, "Inbox", msg)
+    summary_counts = {month: values["message_count"] for (_, month), values in summary.items()}
+
+    rows = build_analytics(et, messages).size_percentiles()
+    analytics_counts = {label: count for label, count, _ in rows if label != et.ALL_MONTHS_LABEL}
+    assert analytics_counts == summary_counts
+
+
+def test_histogram_buckets_use_upper_edges_exclusively(et):
+    edges = et.SIZE_BUCKET_EDGES
+    sizes = [0, edges[0] - 1, edges[0], edges[-1], edges[-1] + 1]
+    rows = build_analytics(
+        et, [message("2024-01-01T00:00:00Z", size) for size in sizes]
+    ).size_histogram()
+    month_rows = {bucket: (count, total) for month, bucket, count, total, _ in rows if month == "2024-01"}
+    labels = et.SIZE_BUCKET_LABELS
+    assert month_rows == {
+        labels[0]: (2, edges[0] - 1),
+        labels[1]: (1, edges[0]),
+        labels[-1]: (2, 2 * edges[-1] + 1),
+    }
+    overall = [row for row in rows if row[0] == et.ALL_MONTHS_LABEL]
+    assert sum(row[2] for row in overall) == len(sizes)
+    assert sum(row[4] for row in overall) == pytest.approx(1.0)
+
+
+def test_top_senders_are_ranked_by_volume_case_insensitively(et):
+    messages = [
+        message("2024-01-01T00:00:00Z", 500, "Big@X.com"),
+        message("2024-02-01T00:00:00Z", 700, "big@x.com"),
+        message("2024-01-01T00:00:00Z", 900, "small@x.com"),
+        message("2024-01-01T00:00:00Z", 10, None),
+    ]
+    senders = build_analytics(et, messages).top_senders(2)
+    assert [(sender, count, total) for sender, count, total, _ in senders] == [
+        ("big@x.com", 2, 1200),
+        ("small@x.com", 1, 900),
+    ]
+    assert senders[0][3] == pytest.approx(1200 / 2110)
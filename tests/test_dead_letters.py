@@ -0,0 +1,100 @@
+import json
+from urllib.parse import parse_qs, urlparse
+
+MAILBOX = "a@x.com"
+FOLDER = {"id": "inbox", "path": "Inbox"}
+
+
+class FakeResponse:
+    def __init__(self, status, payload):
+        self.status = status
+        self.headers = {}
+        self._body = json.dumps(payload).encode()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self._body
+
+    async def text(self):
+        return self._body.decode()
+
+
+class PagedFolder:
+    """Folder stronicowany przez `$skip`; wybrane strony zwracają 503."""
+
+    def __init__(self, pages, failures):
+        self.pages = pages
+        self.failures = dict(failures)
+        self.calls = []
+
+    def get(self, url, headers=None, timeout=None):
+        skip = int(parse_qs(urlparse(url).query).get("$skip", ["0"])[0])
+        self.calls.append(skip)
+        if self.failures.get(skip, 0) > 0:
+            self.failures[skip] -= 1
+            return FakeResponse(503, {"error": "busy"})
+        payload = {"value": [{"id": f"m{skip}"}]}
+        if skip + 1 < self.pages:
+            payload["@odata.nextLink"] = f"https://graph.microsoft.com/next?$skip={skip + 1}"
+        return FakeResponse(200, payload)
+
+
+class CollectingPipeline:
+    raw_pages = False
+
+    def __init__(self):
+        self.messages = []
+
+    async def put_page(self, folder_meta, page, page_url=None):
+        self.messages.extend(message["id"] for message in page["value"])
+
+
+def first_pass(et, run_virtual, graph, pipeline, dead_letters, throttler):
+    run_virtual(
+        et.stream_folder_pages(
+            graph, "tok", MAILBOX, FOLDER, pipeline, None, throttler,
+            retries=1, dead_letters=dead_letters,
+        )
+    )
+
+
+def test_failed_page_is_retried_from_its_own_url(et, run_virtual):
+    graph = PagedFolder(pages=4, failures={2: 2})
+    pipeline = CollectingPipeline()
+    dead_letters = et.DeadLetterQueue()
+    throttler = et.RequestThrottler(4, 0.0)
+
+    first_pass(et, run_virtual, graph, pipeline, dead_letters, throttler)
+    assert pipeline.messages == ["m0", "m1"]
+    assert len(dead_letters) == 1
+
+    incomplete = run_virtual(
+        et.retry_dead_letters(graph, "tok", MAILBOX, dead_letters, pipeline, None, throttler)
+    )
+
+    assert incomplete == []
+    assert pipeline.messages == ["m0", "m1", "m2", "m3"]
+    assert graph.calls.count(0) == 1 and graph.calls.count(1) == 1
+
+
+def test_page_failing_every_retry_is_reported_incomplete(et, run_virtual):
+    graph = PagedFolder(pages=3, failures={1: 1 + et.DEAD_LETTER_RETRIES})
+    pipeline = CollectingPipeline()
+    dead_letters = et.DeadLetterQueue()
+    throttler = et.RequestThrottler(4, 0.0)
+
+    first_pass(et, run_virtual, graph, pipeline, dead_letters, throttler)
+    incomplete = run_virtual(
+        et.retry_dead_letters(graph, "tok", MAILBOX, dead_letters, pipeline, None, throttler)
+    )
+
+    assert pipeline.messages == ["m0"]
+    assert [(entry["folder_path"], entry["url"]) for entry in incomplete] == [
+        ("Inbox", "https://graph.microsoft.com/next?$skip=1")
+    ]
+    assert len(dead_letters) == 0
@@ -0,0 +1,166 @@
+import json
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+MAILBOX = "a@x.com"
+
+
+class FakeResponse:
+    def __init__(self, status, payload):
+        self.status = status
+        self.headers = {}
+        self._body = json.dumps(payload).encode()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self._body
+
+    async def text(self):
+        return self._body.decode()
+
+
+class FakeGraph:
+    """Odpowiada na zapytania delta folderów i wiadomości jednej skrzynki."""
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.changed_folders = set(folders)
+        self.message_changes = {}
+        self.expired_tokens = set()
+        self.calls = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.calls.append(url)
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        token = query.get("token", [None])[0]
+        if token in self.expired_tokens:
+            return FakeResponse(410, {"error": {"code": "SyncStateNotFound"}})
+        if parsed.path.endswith("/mailFolders/delta"):
+            items = [
+                {"id": folder_id, "displayName": name, "totalItemCount": count}
+                for folder_id, (name, count) in self.folders.items()
+                if token is None or folder_id in self.changed_folders
+            ]
+            return FakeResponse(200, {"value": items, "@odata.deltaLink": f"{url.split('?')[0]}?token=f"})
+        folder_id = parsed.path.split("/mailFolders/")[1].split("/")[0]
+        if token is None:
+            items = [{"id": f"{folder_id}-{index}"} for index in range(self.folders[folder_id][1])]
+        else:
+            items = [{"id": message_id} for message_id in self.message_changes.get(folder_id, [])]
+        link = f"{url.split('?')[0]}?token={folder_id}-{len(self.calls)}"
+        return FakeResponse(200, {"value": items, "@odata.deltaLink": link})
+
+    def message_delta_calls(self, folder_id=None):
+        return [
+            url
+            for url in self.calls
+            if "/messages/delta" in url and (folder_id is None or f"/{folder_id}/" in url)
+        ]
+
+
+@pytest.fixture
+def graph():
+    return FakeGraph({"inbox": ("Inbox", 250), "sent": ("Sent", 30), "archive": ("Archive", 5)})
+
+
+@pytest.fixture
+def sync(et, run_virtual, tmp_path):
+    folder_cache = et.FolderCache(str(tmp_path), MAILBOX)
+
+    def run(graph, reused_folders=None):
+        """Synchronizuje drzewo i zapisuje pamięć podręczną jak po przebiegu.
+
+        `reused_folders` to foldery, które przebieg zapisał w pamięci
+        podręcznej (domyślnie wszystkie).
+        """
+        graph.calls.clear()
+        result = run_virtual(
+            et.sync_folder_tree(
+                graph, "tok", MAILBOX, et.RequestThrottler(4, 0.0), folder_cache
+            )
+        )
+        folders, delta_link, folders_state, unchanged = result
+        folder_cache.begin_save()
+        folder_cache.commit(
+            delta_link,
+            folders_state,
+            reused_folders if reused_folders is not None else folders_state,
+        )
+        graph.changed_folders = set()
+        return unchanged, folders_state
+
+    return run
+
+
+def test_first_run_does_not_enumerate_message_delta(graph, sync):
+    unchanged, folders_state = sync(graph)
+    assert unchanged == set()
+    assert graph.message_delta_calls() == []
+    assert not any("messagesDeltaLink" in folder for folder in folders_state.values())
+
+
+def test_token_is_primed_only_for_cached_folders_unchanged_in_the_tree(graph, sync):
+    sync(graph, reused_folders={"inbox", "sent"})
+    graph.changed_folders = {"sent"}
+
+    unchanged, folders_state = sync(graph)
+
+    assert unchanged == set()
+    assert len(graph.message_delta_calls("inbox")) == 1
+    assert graph.message_delta_calls("sent") == []
+    assert graph.message_delta_calls("archive") == []
+    assert "messagesDeltaLink" in folders_state["inbox"]
+
+
+def test_folder_without_message_changes_is_reused(graph, sync):
+    sync(graph)
+    sync(graph)
+
+    unchanged, _ = sync(graph)
+
+    assert unchanged == {"inbox", "sent", "archive"}
+    assert all("token=" in url for url in graph.message_delta_calls())
+
+
+def test_same_item_count_with_changed_messages_is_not_reused(graph, sync):
+    sync(graph)
+    sync(graph)
+    graph.message_changes = {"inbox": ["inbox-3", "inbox-new"]}
+
+    unchanged, folders_state = sync(graph)
+
+    assert unchanged == {"sent", "archive"}
+    previous_link = folders_state["inbox"]["messagesDeltaLink"]
+    graph.message_changes = {}
+    unchanged, folders_state = sync(graph)
+    assert "inbox" in unchanged
+    assert graph.message_delta_calls("inbox") == [previous_link]
+
+
+def test_folder_missing_from_cache_is_not_reused_despite_valid_token(graph, sync):
+    sync(graph)
+    sync(graph, reused_folders={"sent", "archive"})
+
+    unchanged, _ = sync(graph)
+
+    assert unchanged == {"sent", "archive"}
+
+
+def test_expired_token_falls_back_to_a_full_fetch_and_reprimes(graph, sync):
+    sync(graph)
+    _, folders_state = sync(graph)
+    expired_link = folders_state["inbox"]["messagesDeltaLink"]
+    graph.expired_tokens = {parse_qs(urlparse(expired_link).query)["token"][0]}
+
+    unchanged, folders_state = sync(graph)
+
+    assert "inbox" not in unchanged
+    assert folders_state["inbox"]["messagesDeltaLink"] != expired_link
+    assert any("token=" not in url for url in graph.message_delta_calls("inbox"))
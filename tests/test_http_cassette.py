@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+import pytest
+
+
+def test_recorded_responses_replay_by_url(et, tmp_path):
+    path = str(tmp_path / "cassette.sqlite")
+    recorder = et.HttpCassette(path, "record")
+    for index in range(recorder.COMMIT_EVERY + 5):
+        recorder.record(f"https://graph.microsoft.com/v1.0/page/{index}", b'{"n": %d}' % index)
+    recorder.close()
+
+    player = et.HttpCassette(path, "replay")
+    try:
+        assert asyncio.run(player.replay("https://graph.microsoft.com/v1.0/page/3")) == b'{"n": 3}'
+        assert asyncio.run(player.replay("https://graph.microsoft.com/v1.0/missing")) is None
+    finally:
+        player.close()
+
+
+def test_replay_requires_an_existing_cassette(et, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        et.HttpCassette(str(tmp_path / "missing.sqlite"), "replay")
+
+
+class UnusedThrottler:
+    name = "replay"
+
+    def slot(self):
+        raise AssertionError("odtwarzanie nie powinno czekać na limit żądań")
+
+
+def test_fetch_replays_without_throttling_or_network(et, tmp_path, monkeypatch):
+    path = str(tmp_path / "cassette.sqlite")
+    url = "https://graph.microsoft.com/v1.0/users/a/mailFolders"
+    recorder = et.HttpCassette(path, "record")
+    recorder.record(url, json.dumps({"value": [1, 2]}).encode())
+    recorder.close()
+
+    player = et.HttpCassette(path, "replay")
+    monkeypatch.setattr(et, "HTTP_CASSETTE", player)
+    try:
+        data = asyncio.run(et.fetch(None, url, {}, UnusedThrottler()))
+        raw = asyncio.run(et.fetch(None, url, {}, UnusedThrottler(), raw=True))
+    finally:
+        player.close()
+    assert data == {"value": [1, 2]}
+    assert json.loads(raw) == data
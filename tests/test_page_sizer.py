@@ -0,0 +1,44 @@
+def test_apply_rewrites_only_the_top_parameter(et):
+    sizer = et.AdaptivePageSizer(initial_size=250)
+    url = "https://graph.microsoft.com/v1.0/users/a/messages?$select=id&%24top=100&$skiptoken=top=5"
+    assert sizer.apply(url) == (
+        "https://graph.microsoft.com/v1.0/users/a/messages?$select=id&%24top=250&$skiptoken=top=5"
+    )
+
+
+def test_fast_light_pages_grow_up_to_the_graph_limit(et):
+    sizer = et.AdaptivePageSizer(initial_size=100)
+    for _ in range(20):
+        sizer.record_success(et.PAGE_TARGET_SECONDS / 10, 1000)
+    assert sizer.size == et.MESSAGE_PAGE_SIZE_LIMIT
+    assert (sizer.min_size, sizer.max_size) == (100, et.MESSAGE_PAGE_SIZE_LIMIT)
+    assert sizer.pages == 20
+
+
+def test_slow_or_heavy_pages_shrink(et):
+    slow = et.AdaptivePageSizer(initial_size=100)
+    slow.record_success(et.PAGE_TARGET_SECONDS * 2, 1000)
+    heavy = et.AdaptivePageSizer(initial_size=100)
+    heavy.record_success(et.PAGE_TARGET_SECONDS / 10, et.PAGE_MAX_BYTES + 1)
+    assert slow.size == heavy.size == 70
+
+
+def test_pages_in_the_target_band_keep_their_size(et):
+    sizer = et.AdaptivePageSizer(initial_size=100)
+    sizer.record_success(et.PAGE_TARGET_SECONDS / 2, et.PAGE_MAX_BYTES // 2)
+    assert sizer.size == 100
+
+
+def test_timeouts_halve_the_page_down_to_the_minimum(et):
+    sizer = et.AdaptivePageSizer(initial_size=100)
+    for _ in range(10):
+        sizer.record_timeout()
+    assert sizer.size == et.MESSAGE_PAGE_SIZE_MINIMUM
+    assert sizer.timeouts == 10
+
+
+def test_timeout_scales_with_measured_time_per_message(et):
+    sizer = et.AdaptivePageSizer(initial_size=100)
+    assert sizer.timeout is et.FETCH_TIMEOUT
+    sizer.record_success(et.fetch_timeout_seconds / 100, 1000)
+    assert et.fetch_timeout_seconds <= sizer.timeout.total <= et.fetch_timeout_seconds * 4
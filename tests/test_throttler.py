@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from throttler_reference import ListRequestThrottler
+
+
+async def schedule(throttler, requests, cooldowns=None, hold_seconds=0.0):
+    """Zwraca (indeks, czas startu) żądań w kolejności ich startu."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    starts = []
+
+    async def worker(index):
+        async with throttler.slot() as throttle_slot:
+            starts.append((index, loop.time() - started))
+            if cooldowns and index in cooldowns:
+                await throttle_slot.extend_cooldown(cooldowns[index])
+            if hold_seconds:
+                await asyncio.sleep(hold_seconds)
+
+    await asyncio.gather(*(worker(index) for index in range(requests)))
+    return starts
+
+
+def test_requests_start_in_arrival_order_at_interval(et, run_virtual):
+    throttler = et.RequestThrottler(10, 0.5)
+    starts = run_virtual(schedule(throttler, 10))
+    assert [index for index, _ in starts] == list(range(10))
+    assert [start for _, start in starts] == pytest.approx([index * 0.5 for index in range(10)])
+
+
+def test_cooldown_delays_pending_requests_and_keeps_order(et, run_virtual):
+    throttler = et.RequestThrottler(20, 0.1)
+    starts = run_virtual(schedule(throttler, 20, cooldowns={4: 2.0}))
+    assert [index for index, _ in starts] == list(range(20))
+    start_times = [start for _, start in starts]
+    assert start_times[:5] == pytest.approx([0.0, 0.1, 0.2, 0.3, 0.4])
+    assert start_times[5] == pytest.approx(0.4 + 2.0)
+    assert [b - a for a, b in zip(start_times[5:], start_times[6:])] == pytest.approx(
+        [0.1] * 14
+    )
+
+
+def test_concurrency_limit_is_respected(et, run_virtual):
+    throttler = et.RequestThrottler(3, 0.0)
+    active = 0
+    peak = 0
+
+    async def worker():
+        nonlocal active, peak
+        async with throttler.slot():
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(1.0)
+            active -= 1
+
+    async def run():
+        await asyncio.gather(*(worker() for _ in range(10)))
+
+    run_virtual(run())
+    assert peak == 3
+
+
+@pytest.mark.parametrize(
+    "requests, cooldowns, hold_seconds",
+    [
+        (40, {10: 0.05}, 0.0),
+        (40, {3: 0.2, 5: 0.01, 20: 0.5}, 0.0),
+        (25, {0: 1.0, 24: 1.0}, 0.03),
+    ],
+)
+def test_schedule_matches_list_reference(et, run_virtual, requests, cooldowns, hold_seconds):
+    current = run_virtual(
+        schedule(et.RequestThrottler(requests, 0.005), requests, cooldowns, hold_seconds)
+    )
+    reference = run_virtual(
+        schedule(ListRequestThrottler(requests, 0.005), requests, cooldowns, hold_seconds)
+    )
+    assert [index for index, _ in current] == [index for index, _ in reference]
+    assert [start for _, start in current] == pytest.approx(
+        [start for _, start in reference], abs=1e-9
+    )
@@ -0,0 +1,95 @@
+"""Poprzednia implementacja `RequestThrottler` z listą oczekujących.
+
+Służy wyłącznie testom jako wzorzec harmonogramu: każdy cooldown przesuwa
+terminy wszystkich oczekujących i budzi je, a kolejność i odstępy startów
+żądań mają pozostać takie same w implementacji opartej na kopcu.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class _PendingWaiter:
+    __slots__ = ("deadline", "event")
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.event = asyncio.Event()
+
+
+class _ThrottleToken:
+    def __init__(self, throttler):
+        self._throttler = throttler
+
+    async def extend_cooldown(self, wait_seconds):
+        await self._throttler.apply_cooldown(wait_seconds)
+
+
+class ListRequestThrottler:
+    def __init__(self, concurrency_limit, base_interval_seconds, name="default"):
+        self.name = name
+        self._semaphore = asyncio.Semaphore(max(1, int(concurrency_limit)))
+        self._base_interval = max(float(base_interval_seconds), 0.0)
+        self._lock = asyncio.Lock()
+        self._next_available_time = 0.0
+        self._cooldown_until = 0.0
+        self._waiters = []
+
+    async def _reserve_window(self):
+        loop = asyncio.get_running_loop()
+        waiter = _PendingWaiter(0.0)
+        try:
+            async with self._lock:
+                now = loop.time()
+                scheduled_from = max(now, self._next_available_time, self._cooldown_until)
+                waiter.deadline = scheduled_from
+                self._next_available_time = scheduled_from + self._base_interval
+                self._waiters.append(waiter)
+
+            while True:
+                remaining = waiter.deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                else:
+                    waiter.event.clear()
+        finally:
+            async with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._semaphore.acquire()
+        try:
+            await self._reserve_window()
+            yield _ThrottleToken(self)
+        finally:
+            self._semaphore.release()
+
+    async def apply_cooldown(self, wait_seconds):
+        wait_value = float(wait_seconds)
+        if wait_value <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            new_cooldown_until = max(self._cooldown_until, loop.time() + wait_value)
+            if new_cooldown_until <= self._cooldown_until:
+                return
+            delta = 0.0
+            if self._waiters:
+                earliest_deadline = min(waiter.deadline for waiter in self._waiters)
+                if earliest_deadline < new_cooldown_until:
+                    delta = new_cooldown_until - earliest_deadline
+                    for waiter in self._waiters:
+                        waiter.deadline += delta
+                    self._next_available_time += delta
+            else:
+                self._next_available_time = max(self._next_available_time, new_cooldown_until)
+            self._cooldown_until = new_cooldown_until
+            waiters_to_wake = list(self._waiters) if delta > 0 else []
+        for waiter in waiters_to_wake:
+            waiter.event.set()